@@ -3,34 +3,28 @@ import json
 import logging
 from ..common import consts, phelper
 from ..common.models import PricingResult
-import tinydb
+from ..datatransfer import pricing as datatransferpricing
 
 log = logging.getLogger()
-regiondbs = {}
 indexMetadata = {}
 
 
 def calculate(pdim):
 
-  log.info("Calculating Lambda pricing with the following inputs: {}".format(str(pdim.__dict__)))
+  log.debug("Calculating Lambda pricing with the following inputs: {}".format(pdim.__dict__))
 
-  global regiondbs
   global indexMetadata
 
   ts = phelper.Timestamp()
   ts.start('totalCalculationAwsLambda')
 
   #Load On-Demand DB
-  dbs = regiondbs.get(consts.SERVICE_LAMBDA+pdim.region+pdim.termType,{})
-  if not dbs:
-    dbs, indexMetadata = phelper.loadDBs(consts.SERVICE_LAMBDA, phelper.get_partition_keys(consts.SERVICE_LAMBDA, pdim.region, consts.SCRIPT_TERM_TYPE_ON_DEMAND))
-    regiondbs[consts.SERVICE_LAMBDA+pdim.region+pdim.termType]=dbs
+  dbs, indexMetadata = phelper.loadDBs(consts.SERVICE_LAMBDA, phelper.get_partition_keys(consts.SERVICE_LAMBDA, pdim.region, consts.SCRIPT_TERM_TYPE_ON_DEMAND))
 
   cost = 0
   pricing_records = []
 
   awsPriceListApiVersion = indexMetadata['Version']
-  priceQuery = tinydb.Query()
 
   #TODO: add support to include/ignore free-tier (include a flag)
 
@@ -38,39 +32,32 @@ def calculate(pdim):
 
   #Requests
   if pdim.requestCount:
-    query = ((priceQuery['Group'] == 'AWS-Lambda-Requests'))
+    query = {'Group': 'AWS-Lambda-Requests'}
     pricing_records, cost = phelper.calculate_price(consts.SERVICE_LAMBDA, serverlessDb, query, pdim.requestCount, pricing_records, cost)
 
   #GB-s (aka compute time)
   if pdim.avgDurationMs:
-    query = ((priceQuery['Group'] == 'AWS-Lambda-Duration'))
+    query = {'Group': 'AWS-Lambda-Duration'}
     usageUnits = pdim.GBs
     pricing_records, cost = phelper.calculate_price(consts.SERVICE_LAMBDA, serverlessDb, query, usageUnits, pricing_records, cost)
 
-  #Data Transfer
-  dataTransferDb = dbs[phelper.create_file_key([consts.REGION_MAP[pdim.region], consts.TERM_TYPE_MAP[pdim.termType], consts.PRODUCT_FAMILY_DATA_TRANSFER])]
-
-  #To internet
-  if pdim.dataTransferOutInternetGb:
-    query = ((priceQuery['To Location'] == 'External') & (priceQuery['Transfer Type'] == 'AWS Outbound'))
-    pricing_records, cost = phelper.calculate_price(consts.SERVICE_LAMBDA, dataTransferDb, query, pdim.dataTransferOutInternetGb, pricing_records, cost)
-
-  #Intra-regional data transfer - in/out/between EC2 AZs or using IPs or ELB
-  if pdim.dataTransferOutIntraRegionGb:
-    query = ((priceQuery['Transfer Type'] == 'IntraRegion'))
-    pricing_records, cost = phelper.calculate_price(consts.SERVICE_LAMBDA, dataTransferDb, query, pdim.dataTransferOutIntraRegionGb, pricing_records, cost)
-
-  #Inter-regional data transfer - out to other AWS regions
-  if pdim.dataTransferOutInterRegionGb:
-    query = ((priceQuery['Transfer Type'] == 'InterRegion Outbound') & (priceQuery['To Location'] == consts.REGION_MAP[pdim.toRegion]))
-    pricing_records, cost = phelper.calculate_price(consts.SERVICE_LAMBDA, dataTransferDb, query, pdim.dataTransferOutInterRegionGb, pricing_records, cost)
+  #Data Transfer (from the AWSLambda index) - to internet, intra-regional (in/out/between EC2 AZs or using IPs or ELB) and inter-regional (out to other AWS regions)
+  pricing_records, cost = datatransferpricing.calculate_data_transfer(pdim.region, pricing_records, cost,
+                                                 outInternetGb=pdim.dataTransferOutInternetGb,
+                                                 intraRegionGb=pdim.dataTransferOutIntraRegionGb,
+                                                 interRegionGb=pdim.dataTransferOutInterRegionGb, toRegion=pdim.toRegion,
+                                                 service=consts.SERVICE_LAMBDA)
 
 
   extraargs = {'priceDimensions':pdim}
   pricing_result = PricingResult(awsPriceListApiVersion, pdim.region, cost, pricing_records, **extraargs)
-  log.debug(json.dumps(vars(pricing_result),sort_keys=False,indent=4))
+  if log.isEnabledFor(logging.DEBUG): log.debug(json.dumps(vars(pricing_result),sort_keys=False,indent=4))
 
   log.debug("Total time to compute: [{}]".format(ts.finish('totalCalculationAwsLambda')))
   return pricing_result.__dict__
 
 
+
+#Calculates prices for a list of price dimensions - see phelper.calculate_batch
+def calculate_batch(pdims, columnar=False):
+  return phelper.calculate_batch(calculate, pdims, columnar)
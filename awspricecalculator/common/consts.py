@@ -11,6 +11,27 @@ FORECAST_PERIOD_YEARLY = "yearly"
 
 HOURS_IN_MONTH = 720
 
+#Price tables kept in memory by all service modules - partitions are evicted (least recently used first) when either limit is reached
+PARTITION_CACHE_MAX_ENTRIES = int(os.environ.get('PARTITION_CACHE_MAX_ENTRIES',1000))
+PARTITION_CACHE_MAX_MB = int(os.environ.get('PARTITION_CACHE_MAX_MB',256))
+#Tier bands (prices by usage range) for each query that has been calculated
+TIER_BANDS_CACHE_MAX_ENTRIES = int(os.environ.get('TIER_BANDS_CACHE_MAX_ENTRIES',10000))
+#Compiled partitions (from CSV files) are also kept in local storage, by index version (0 disables the disk cache)
+DISK_CACHE_DIR = os.environ.get('DISK_CACHE_DIR','/tmp/awspricecalculator')
+DISK_CACHE_MAX_MB = int(os.environ.get('DISK_CACHE_MAX_MB',256))
+
+#Price comparisons (see utils.compare) calculate their scenarios in parallel processes when there are at least COMPARE_MIN_PARALLEL_SCENARIOS
+COMPARE_MAX_WORKERS = int(os.environ.get('COMPARE_MAX_WORKERS',os.cpu_count() or 1))
+COMPARE_MIN_PARALLEL_SCENARIOS = int(os.environ.get('COMPARE_MIN_PARALLEL_SCENARIOS',8))
+
+#List of the partitions that exist for a service, written by scripts/get-latest-index.py when the index is split
+PARTITION_MANIFEST_FILE = 'partitions.json'
+
+#Cross-region partitions have the records of the same partition (term type, product family, etc.) in all regions.
+#CROSS_REGION_PARTITION_FIELD has the key of the regional partition each record belongs to.
+CROSS_REGION_PARTITION_PREFIX = 'AllRegions'
+CROSS_REGION_PARTITION_FIELD = 'Partition'
+
 SERVICE_CODE_AWS_DATA_TRANSFER = 'AWSDataTransfer'
 
 REGION_MAP = {'us-east-1':'US East (N. Virginia)',
@@ -238,7 +259,8 @@ SUPPORTED_PRODUCT_FAMILIES_BY_SERVICE_DICT = {
                                                 PRODUCT_FAMILY_APPLICATION_LOAD_BALANCER,PRODUCT_FAMILY_NETWORK_LOAD_BALANCER,
                                                 PRODUCT_FAMILY_SNAPSHOT],
                                    SERVICE_RDS:[PRODUCT_FAMILY_DATABASE_INSTANCE, PRODUCT_FAMILY_DATA_TRANSFER,PRODUCT_FAMILY_FEE,
-                                                PRODUCT_FAMILY_DB_STORAGE,PRODUCT_FAMILY_DB_PIOPS,PRODUCT_FAMILY_SNAPSHOT ],
+                                                PRODUCT_FAMILY_DB_STORAGE,PRODUCT_FAMILY_DB_PIOPS,PRODUCT_FAMILY_SNAPSHOT,
+                                                PRODUCT_FAMILY_SYSTEM_OPERATION ],
                                    SERVICE_S3:[PRODUCT_FAMILY_STORAGE, PRODUCT_FAMILY_FEE,PRODUCT_FAMILY_API_REQUEST,PRODUCT_FAMILY_SYSTEM_OPERATION, PRODUCT_FAMILY_DATA_TRANSFER ],
                                    SERVICE_LAMBDA:[PRODUCT_FAMILY_SERVERLESS, PRODUCT_FAMILY_DATA_TRANSFER, PRODUCT_FAMILY_FEE,
                                                    PRODUCT_FAMILY_API_REQUEST],
@@ -251,6 +273,27 @@ SUPPORTED_PRODUCT_FAMILIES_BY_SERVICE_DICT = {
                                    }
 
 
+#Columns kept in the partition files for each service (see scripts/get-latest-index.py). Price calculations only use
+#the price columns, plus the columns each service module filters on. Splitting an index fails if one of them is missing.
+PARTITION_PRICE_COLUMNS = ['SKU', 'RateCode', 'PriceDescription', 'StartingRange', 'EndingRange', 'Unit', 'PricePerUnit']
+DATA_TRANSFER_COLUMNS = ['Transfer Type', 'To Location']
+
+PARTITION_COLUMNS_BY_SERVICE_DICT = {
+                                   SERVICE_EC2:PARTITION_PRICE_COLUMNS + ['Instance Type', 'Operating System', 'Pre Installed S/W', 'CapacityStatus',
+                                                                          'License Model', 'LeaseContractLength', 'Volume Type', 'Group', 'usageType', 'operation'],
+                                   SERVICE_RDS:PARTITION_PRICE_COLUMNS + ['Product Family', 'Instance Type', 'Database Engine', 'Database Edition',
+                                                                          'License Model', 'Deployment Option', 'OfferingClass', 'PurchaseOption',
+                                                                          'LeaseContractLength', 'Volume Type', 'Group', 'usageType'],
+                                   SERVICE_S3:PARTITION_PRICE_COLUMNS + ['Storage Class', 'Volume Type', 'Group'],
+                                   SERVICE_LAMBDA:PARTITION_PRICE_COLUMNS + ['Group'] + DATA_TRANSFER_COLUMNS,
+                                   SERVICE_KINESIS:PARTITION_PRICE_COLUMNS + ['Group'],
+                                   SERVICE_DYNAMODB:PARTITION_PRICE_COLUMNS + ['Group'],
+                                   SERVICE_EMR:PARTITION_PRICE_COLUMNS + ['Instance Type', 'Software Type'],
+                                   SERVICE_REDSHIFT:PARTITION_PRICE_COLUMNS + ['Instance Type', 'LeaseContractLength'],
+                                   SERVICE_DATA_TRANSFER:PARTITION_PRICE_COLUMNS + DATA_TRANSFER_COLUMNS
+                                   }
+
+
 INFINITY = 'Inf'
 
 SORT_CRITERIA_REGION = 'region'
@@ -0,0 +1,133 @@
+import os, shutil
+import tempfile
+import time
+import logging
+
+log = logging.getLogger()
+
+#Seconds after which the size of the cache is measured again, to include files written by other processes
+SIZE_SCAN_INTERVAL = 60
+#When the cache exceeds its size, files are removed until it's within this fraction of it, so it doesn't have to be
+#scanned again for every file that is added
+EVICTION_TARGET_RATIO = 0.9
+
+
+"""
+Files kept in local storage (i.e. /tmp in a Lambda container), so they're available to every process that runs in
+the same environment - including new invocations in a warm container after the in-memory caches were discarded.
+
+Files are stored by service and index version (<directory>/<service>/<version>/<name>). When a new index version is
+used for a service, the files for other versions are removed, so data from a previous index is never returned.
+Files are written to a temporary file and renamed, so readers never see a partially written file. When the
+size of the cache exceeds maxBytes, the least recently used files are removed. A maxBytes of 0 disables the cache.
+
+The size of the cache is measured once and then updated as files are written, so the directory is only scanned again
+when the size exceeds maxBytes or every SIZE_SCAN_INTERVAL seconds.
+"""
+class DiskCache():
+
+  def __init__(self, directory, maxBytes):
+    self.directory = directory
+    self.maxBytes = maxBytes
+    self.size = None
+    self.sizeTime = 0
+    self.versions = {} #index version last used for each service
+
+
+  def enabled(self):
+    return self.maxBytes > 0
+
+
+  def get_path(self, service, version, name):
+    return os.path.join(self.directory, service, str(version), name)
+
+
+  #Returns the path of a cached file, or None if the file is not in the cache
+  def get(self, service, version, name):
+    if not self.enabled(): return None
+    self.check_version(service, version)
+    path = self.get_path(service, version, name)
+    try:
+      #The modification time is used to find the least recently used files
+      os.utime(path, None)
+    except OSError:
+      return None
+    return path
+
+
+  """
+  Adds a file to the cache. writeFile is called with the name of a temporary file, which is renamed
+  when writeFile returns. Returns the path of the cached file, or None if it couldn't be written (the cache is
+  only an optimization, therefore errors such as a full disk are logged and ignored).
+  """
+  def put(self, service, version, name, writeFile):
+    if not self.enabled(): return None
+    self.check_version(service, version)
+    path = self.get_path(service, version, name)
+    directory = os.path.dirname(path)
+    try:
+      os.makedirs(directory, exist_ok=True)
+      fd, tmpfilename = tempfile.mkstemp(dir=directory, prefix='.' + name, suffix='.tmp')
+      os.close(fd)
+      try:
+        writeFile(tmpfilename)
+        fileSize = os.path.getsize(tmpfilename)
+        previousSize = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(tmpfilename, path)
+      except BaseException:
+        os.remove(tmpfilename)
+        raise
+    except (IOError, OSError) as e:
+      log.warning("Could not write file [{}] to disk cache - {}".format(path, e))
+      return None
+
+    if self.size is not None: self.size += fileSize - previousSize
+    if self.size is None or self.size > self.maxBytes or time.time() - self.sizeTime > SIZE_SCAN_INTERVAL:
+      self.evict(path)
+    return path
+
+
+  #Removes the files of other index versions the first time a version is used for a service
+  def check_version(self, service, version):
+    if self.versions.get(service) == str(version): return
+    self.versions[service] = str(version)
+    self.remove_versions(service, version)
+
+
+  #Removes the files of all index versions of a service, except the current one
+  def remove_versions(self, service, version):
+    servicedir = os.path.join(self.directory, service)
+    if not os.path.isdir(servicedir): return
+    for v in os.listdir(servicedir):
+      if v != str(version):
+        log.debug("Removing files for index version [{}] of service [{}] from disk cache".format(v, service))
+        shutil.rmtree(os.path.join(servicedir, v), ignore_errors=True)
+        self.size = None
+
+
+  #Measures the size of the cache and, if it exceeds maxBytes, removes the least recently used files until it's within
+  #EVICTION_TARGET_RATIO of maxBytes. The file in keepPath is never removed.
+  def evict(self, keepPath):
+    files = []
+    size = 0
+    for root, dirs, filenames in os.walk(self.directory):
+      for f in filenames:
+        path = os.path.join(root, f)
+        try:
+          st = os.stat(path)
+        except OSError:
+          continue
+        files.append((st.st_mtime, st.st_size, path))
+        size += st.st_size
+
+    if size > self.maxBytes:
+      for mtime, fileSize, path in sorted(files):
+        if size <= self.maxBytes * EVICTION_TARGET_RATIO: break
+        if path == keepPath: continue
+        try:
+          os.remove(path)
+          size -= fileSize
+        except OSError:
+          pass
+    self.size = size
+    self.sizeTime = time.time()
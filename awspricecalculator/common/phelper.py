@@ -4,23 +4,23 @@ import os, sys
 import datetime
 import logging
 import csv, json
+from collections import OrderedDict
 from .models import PricingRecord, PricingResult
-from .errors import NoDataFoundError
+from .errors import NoDataFoundError, ValidationError
+from .pricetable import PriceTable, TierBands, PACKED_FILE_FORMAT, write_packed
+from .diskcache import DiskCache
 
 
 log = logging.getLogger()
 log.setLevel(consts.LOG_LEVEL)
 
 __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
-site_pkgs = os.path.abspath(os.path.join(__location__, os.pardir, os.pardir,"lib", "python3.7", "site-packages" ))
-sys.path.append(site_pkgs)
-#print "site_pkgs: [{}]".format(site_pkgs)
-
-import tinydb
+#Directory with the index files created by get-latest-index.py (one sub-directory per service)
+datadirectory = os.path.split(__location__)[0] + '/data/'
 
 
 def get_data_directory(service):
-  result = os.path.split(__location__)[0] + '/data/' + service + '/'
+  result = datadirectory + service + '/'
   return result
 
 
@@ -42,33 +42,6 @@ def getBillableBand(priceDimensions, usageAmount):
   return billableBand
 
 
-def getBillableBandCsv(row, usageAmount):
-    billableBand = 0
-    pricePerUnit = 0
-    amt = 0
-
-    if not row['StartingRange']:beginRange = 0
-    else: beginRange = int(row['StartingRange'])
-    if not row['EndingRange']:endRange = consts.INFINITY
-    else: endRange = row['EndingRange']
-
-    pricePerUnit = float(row['PricePerUnit'])
-    if endRange == consts.INFINITY:
-      if beginRange < usageAmount:
-        billableBand = usageAmount - beginRange
-    else:
-      endRange = int(endRange)
-      if endRange >= usageAmount and beginRange < usageAmount:
-        billableBand = usageAmount - beginRange
-      if endRange < usageAmount:
-        billableBand = endRange - beginRange
-
-    if billableBand > 0: amt = pricePerUnit * billableBand
-
-    return billableBand, pricePerUnit, amt
-
-
-
 #Creates a table with all the SKUs that are part of the total price
 def buildSkuTable(evaluated_sku_desc):
   result = {}
@@ -91,7 +64,7 @@ def buildSkuTable(evaluated_sku_desc):
 Calculates the keys that will be used to partition big index files into smaller pieces.
 If no term is specified, the function will consider On-Demand and Reserved
 """
-#TODO: merge all 3 load balancers into a single file (to speed up DB file loading and number of open files
+#TODO: merge all 3 load balancers into a single partition (to speed up partition loading and number of open files
 def get_partition_keys(service, region, term, **extraArgs):
     result = []
     if region:
@@ -141,65 +114,349 @@ def create_file_key(indexDimensions):
 
 
 
+"""
+Returns the price tables for a list of partitions, along with the index metadata for the service.
+Each price table is a PartitionHandle, which loads the partition file only when it's queried for the first time.
+Price tables are shared by all service modules through the partition cache, so each partition file is loaded once.
+"""
 def loadDBs(service, indexFiles):
 
     dBs = {}
-    datadir = get_data_directory(service)
     indexMetadata = getIndexMetadata(service)
 
-    #Files in Lambda can only be created in the /tmp filesystem - If it doesn't exist, create it.
-    lambdaFileSystem = '/tmp/'+service+'/data'
-    if not os.path.exists(lambdaFileSystem):
-      os.makedirs(lambdaFileSystem)
-
     for i in indexFiles:
-      db = tinydb.TinyDB(lambdaFileSystem+'/'+i+'.json')
-      #TODO: remove circular dependency from utils, so I can use the method get_index_file_name
-      #TODO: initial tests show that is faster (by a few milliseconds) to populate the file from scratch). See if I should load from scratch all the time
-      #TODO:Create a file that is an index of those files that have been generated, so the code knows which files to look for and avoid creating unnecesary empty .json files
-      if len(db) == 0:
-        try:
-          #with open(datadir+i+'.csv', 'rb') as csvfile:
-          with open(datadir+i+'.csv', 'r') as csvfile:
-              pricelist = csv.DictReader(csvfile, delimiter=',', quotechar='"')
-              db.insert_multiple(pricelist)
-          #csvfile.close()#avoid " [Errno 24] Too many open files" exception
-        except IOError:
-          pass
-      dBs[i]=db
-      #db.close()#avoid " [Errno 24] Too many open files" exception
-
+      dBs[i] = PartitionHandle(service, i)
 
     return dBs, indexMetadata
 
 
 
+#Returns the price table for a single partition, identified by its index dimensions (region, term type, product family, etc.)
+def loadDB(service, indexDimensions):
+  return PartitionHandle(service, create_file_key(indexDimensions))
+
+
+
+def loadPriceTable(service, partitionKey):
+    datadir = get_data_directory(service)
+    #Partitions that are not in the manifest were not created when the index was split, so there's no file to open
+    if not partitionExists(service, partitionKey):
+      log.debug("Partition [{}] does not exist for service [{}]".format(partitionKey, service))
+      return PriceTable.from_rows(partitionKey, [], [])
+
+    #Partitions are loaded from the precompiled binary files created by get-latest-index.py. The CSV files are a fallback.
+    try:
+      return PriceTable.load(partitionKey, datadir+partitionKey+'.'+PACKED_FILE_FORMAT)
+    except (IOError, ValueError) as e:
+      log.debug("Could not load binary partition [{}] - {}".format(partitionKey, e))
+
+    #CSV partitions are compiled once and kept in the disk cache, for the current index version
+    version = getIndexMetadata(service).get('Version')
+    binFileName = partitionKey+'.'+PACKED_FILE_FORMAT
+    cachedFile = diskcache.get(service, version, binFileName)
+    if cachedFile:
+      try:
+        return PriceTable.load(partitionKey, cachedFile)
+      except (IOError, ValueError) as e:
+        log.debug("Could not load cached partition [{}] - {}".format(partitionKey, e))
+
+    rows = []
+    fields = []
+    try:
+      with open(datadir+partitionKey+'.csv', 'r') as csvfile:
+          pricelist = csv.DictReader(csvfile, delimiter=',', quotechar='"')
+          rows = list(pricelist)
+          fields = pricelist.fieldnames or []
+    except IOError:
+      pass
+
+    if rows:
+      cachedFile = diskcache.put(service, version, binFileName, lambda f: write_packed(f, fields, rows))
+      if cachedFile: return PriceTable.load(partitionKey, cachedFile)
+    return PriceTable.from_rows(partitionKey, fields, rows)
+
+
+
+"""
+The list of partitions created by get-latest-index.py for a service, or None when the data directory has no manifest
+(i.e. partitions created by older versions of the script). The manifest is read once per service.
+"""
+def getPartitionManifest(service):
+  if service not in partitionmanifests:
+    result = None
+    crossRegionPartitions = {}
+    try:
+      with open(get_data_directory(service)+consts.PARTITION_MANIFEST_FILE) as manifest:
+        manifestDict = json.load(manifest)
+        result = frozenset(manifestDict['partitions'])
+        crossRegionPartitions = manifestDict.get('crossRegionPartitions', {})
+    except IOError:
+      log.debug("No partition manifest found for service [{}]".format(service))
+    partitionmanifests[service] = (result, crossRegionPartitions)
+  return partitionmanifests[service][0]
+
+
+#Returns the key of the cross-region partition that includes the records of a regional partition, or None
+def getCrossRegionPartition(service, partitionKey):
+  getPartitionManifest(service)
+  return partitionmanifests[service][1].get(partitionKey)
+
+
+#Without a manifest, all partitions are assumed to exist and missing files are handled when they're loaded
+def partitionExists(service, partitionKey):
+  manifest = getPartitionManifest(service)
+  return manifest is None or partitionKey in manifest
+
+
+
+"""
+A price table that is loaded from the partition cache the first time it's used. Service modules get handles for
+all the partitions a calculation could need, but only the ones that are actually queried are opened.
+Queries are delegated to the PriceTable (search, get_tier_bands, get_column, etc.)
+"""
+class PartitionHandle():
+
+  def __init__(self, service, partitionKey):
+    self.service = service
+    self.partitionKey = partitionKey
+    self.table = None
+
+  def exists(self):
+    return partitionExists(self.service, self.partitionKey)
+
+  def get_table(self):
+    if self.table is None:
+      self.table = partitioncache.get(self.service, self.partitionKey)
+    return self.table
+
+  def __getattr__(self, name):
+    return getattr(self.get_table(), name)
+
+  def __len__(self):
+    return len(self.get_table())
+
+
+
+"""
+Price tables that are currently in memory, with one entry per partition file, shared by all service modules.
+When the number of entries or their estimated size exceed the configured limits, the least recently used
+partitions are evicted. The size of a table includes the indexes and decoded strings it creates after it's loaded,
+which are charged to the cache as they're created (see PriceTable.grow).
+"""
+class PartitionCache():
+
+  def __init__(self, maxEntries, maxBytes):
+    self.maxEntries = maxEntries
+    self.maxBytes = maxBytes
+    self.entries = OrderedDict()
+    self.size = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def __len__(self):
+    return len(self.entries)
+
+  def get(self, service, partitionKey):
+    key = (service, partitionKey)
+    table = self.entries.get(key)
+    if table is not None:
+      self.hits += 1
+      self.entries.move_to_end(key)
+      return table
+
+    self.misses += 1
+    table = loadPriceTable(service, partitionKey)
+    self.entries[key] = table
+    self.size += table.size
+    table.onGrow = self.charge
+    self.evict()
+    return table
+
+  #Adds the memory a cached table uses after it was loaded (indexes, decoded strings)
+  def charge(self, table, delta):
+    self.size += delta
+    self.evict()
+
+  def evict(self):
+    #The most recent entry is never evicted, since it's about to be used
+    while len(self.entries) > 1 and (len(self.entries) > self.maxEntries or self.size > self.maxBytes):
+      key, table = self.entries.popitem(last=False)
+      self.remove(table)
+      self.evictions += 1
+      log.debug("Evicted partition {} from cache - size:[{}]".format(key, table.size))
+
+  #Tables that are no longer in the cache (but may still be used by a PartitionHandle) are not charged anymore
+  def remove(self, table):
+    self.size -= table.size
+    table.onGrow = None
+
+  def clear(self):
+    for table in self.entries.values(): table.onGrow = None
+    self.entries.clear()
+    self.size = 0
+
+  #Removes the price tables of a service (i.e. after its index files are replaced)
+  def remove_service(self, service):
+    for key in [k for k in self.entries if k[0] == service]:
+      self.remove(self.entries.pop(key))
+
+  def stats(self):
+    return {'entries':len(self.entries), 'sizeBytes':self.size, 'hits':self.hits, 'misses':self.misses, 'evictions':self.evictions}
+
+
+"""
+Tier bands (the prices that apply to each usage range) for the queries that have been calculated, by service, index version,
+partition and query. Calculations that repeat a query (i.e. the same instance type every 5 minutes) only evaluate the usage
+against the cached bands, without loading or searching the partition again.
+
+When crossRegion is set (i.e. while comparing prices across regions), queries are resolved for all regions at once using
+the cross-region partition, so the calculations for the other regions find their tier bands in the cache.
+"""
+class TierBandsCache():
+
+  def __init__(self, maxEntries):
+    self.maxEntries = maxEntries
+    self.entries = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.crossRegion = False
+
+  def __len__(self):
+    return len(self.entries)
+
+  def get(self, db, query):
+    key = (db.service, getCheckedIndexVersion(db.service), db.partitionKey, tuple(sorted(query.items())))
+    bands = self.entries.get(key)
+    if bands is not None:
+      self.hits += 1
+      self.entries.move_to_end(key)
+      return bands
+
+    self.misses += 1
+    bands = None
+    if self.crossRegion:
+      bands = self.add_cross_region(db, key)
+    if bands is None:
+      bands = db.get_table().get_tier_bands(query)
+    self.add(key, bands)
+    return bands
+
+  def add(self, key, bands):
+    self.entries[key] = bands
+    while len(self.entries) > self.maxEntries:
+      self.entries.popitem(last=False)
+
+  """
+  Searches a query in the cross-region partition and adds the tier bands for every region that has matching records.
+  Returns the tier bands for the partition in key, or None if there's no cross-region partition or no matching records
+  for it (i.e. queries with values that are specific to a region, such as a usageType prefix).
+  """
+  def add_cross_region(self, db, key):
+    crossRegionKey = getCrossRegionPartition(db.service, db.partitionKey)
+    if crossRegionKey is None: return None
+    rowsByPartition = OrderedDict()
+    for r in partitioncache.get(db.service, crossRegionKey).search(dict(key[3])):
+      rowsByPartition.setdefault(r[consts.CROSS_REGION_PARTITION_FIELD], []).append(r)
+    for partitionKey, rows in rowsByPartition.items():
+      if partitionKey != db.partitionKey: self.add((key[0], key[1], partitionKey, key[3]), TierBands(rows))
+    rows = rowsByPartition.get(db.partitionKey)
+    return TierBands(rows) if rows else None
+
+  def remove_service(self, service):
+    for key in [k for k in self.entries if k[0] == service]:
+      del self.entries[key]
+
+  def clear(self):
+    self.entries.clear()
+
+  def stats(self):
+    return {'entries':len(self.entries), 'hits':self.hits, 'misses':self.misses}
+
+
+partitioncache = PartitionCache(consts.PARTITION_CACHE_MAX_ENTRIES, consts.PARTITION_CACHE_MAX_MB * 1024 * 1024)
+tierbandscache = TierBandsCache(consts.TIER_BANDS_CACHE_MAX_ENTRIES)
+diskcache = DiskCache(consts.DISK_CACHE_DIR, consts.DISK_CACHE_MAX_MB * 1024 * 1024)
+indexmetadatas = {}
+partitionmanifests = {}
+batchbands = None
+
+
+
+"""
+Index metadata is read again only when index_metadata.json is modified (i.e. the index files are downloaded again).
+When the index version changes, the price tables and tier bands that were cached for the service are discarded.
+"""
 def getIndexMetadata(service):
+  filename = get_data_directory(service)+"index_metadata.json"
+  mtime = os.stat(filename).st_mtime
+  cached = indexmetadatas.get(service)
+  if cached is not None and cached[0] == mtime: return cached[1]
+
   ts = Timestamp()
   ts.start('getIndexMetadata')
   result = {}
-  #datadir = get_data_directory(service)
-  with open(get_data_directory(service)+"index_metadata.json") as index_metadata:
+  with open(filename) as index_metadata:
     result = json.load(index_metadata)
-  index_metadata.close()
   ts.finish('getIndexMetadata')
   log.debug("Time to load indexMetadata: [{}]".format(ts.elapsed('getIndexMetadata')))
+
+  if cached is not None and cached[1].get('Version') != result.get('Version'):
+    log.info("Index version for service [{}] changed from [{}] to [{}]".format(service, cached[1].get('Version'), result.get('Version')))
+    invalidateService(service)
+  indexmetadatas[service] = (mtime, result)
   return result
 
 
+"""
+Index version of a service as of the last time getIndexMetadata checked index_metadata.json. Calculations check it once,
+when they start (see loadDBs), so the lookups within a calculation don't read the file's modification time again.
+"""
+def getCheckedIndexVersion(service):
+  cached = indexmetadatas.get(service)
+  if cached is None: return getIndexMetadata(service).get('Version')
+  return cached[1].get('Version')
+
+
+#Discards everything that was loaded from the index files of a service
+def invalidateService(service):
+  partitioncache.remove_service(service)
+  tierbandscache.remove_service(service)
+  partitionmanifests.pop(service, None)
+
+
+"""
+Tier bands for partitions that are accessed through a PartitionHandle are kept in tierbandscache. While a batch is
+being calculated (see calculate_batch), the bands for each query are also kept in batchbands, so every distinct query
+in a partition group is resolved only once, regardless of the size of tierbandscache.
+"""
+def get_tier_bands(db, query):
+  if not isinstance(db, PartitionHandle): return db.get_tier_bands(query)
+  if batchbands is None: return tierbandscache.get(db, query)
+  key = (db.service, db.partitionKey, tuple(sorted(query.items())))
+  bands = batchbands.get(key)
+  if bands is None:
+    bands = tierbandscache.get(db, query)
+    batchbands[key] = bands
+  return bands
+
+
 def calculate_price(service, db, query, usageAmount, pricingRecords, cost):
   ts = Timestamp()
-  ts.start('tinyDbSeachCalculatePrice')
+  ts.start('priceTableSearchCalculatePrice')
+
+  bands = get_tier_bands(db, query)
+
+  ts.finish('priceTableSearchCalculatePrice')
+  log.debug("Time to search {} pricing DB for query [{}] : [{}] ".format(service, query, ts.elapsed('priceTableSearchCalculatePrice')))
 
-  resultSet = db.search(query)
+  return calculate_bands_price(service, bands, query, usageAmount, pricingRecords, cost)
 
-  ts.finish('tinyDbSeachCalculatePrice')
-  log.debug("Time to search {} pricing DB for query [{}] : [{}] ".format(service, query, ts.elapsed('tinyDbSeachCalculatePrice')))
 
-  if not resultSet: raise NoDataFoundError("Could not find data for service:[{}] - query:[{}]".format(service, query))
-  #print("resultSet:[{}]".format(json.dumps(resultSet,indent=4)))
-  for r in resultSet:
-    billableUsage, pricePerUnit, amt = getBillableBandCsv(r, usageAmount)
+#Same as calculate_price, for tier bands that have already been resolved (the query is only used for error messages)
+def calculate_bands_price(service, bands, query, usageAmount, pricingRecords, cost):
+  if not bands: raise NoDataFoundError("Could not find data for service:[{}] - query:[{}]".format(service, query))
+  for r, billableUsage, pricePerUnit, amt in bands.evaluate(usageAmount):
     cost = cost + amt
     if billableUsage:
       #TODO: calculate rounding dynamically - don't set to 4 - use description to set the right rounding
@@ -209,6 +466,80 @@ def calculate_price(service, db, query, usageAmount, pricingRecords, cost):
   return pricingRecords, cost
 
 
+"""
+Calculates the cost of multiple usage amounts for the same price records in a single pass (i.e. a sweep of S3 storage
+sizes). Returns an array with the total cost for each usage amount.
+"""
+def calculate_tiered_cost(service, db, query, usageAmounts):
+  bands = get_tier_bands(db, query)
+  if not bands: raise NoDataFoundError("Could not find data for service:[{}] - query:[{}]".format(service, query))
+  billable, amounts = bands.evaluate_array(usageAmounts)
+  return amounts
+
+
+"""
+Calculates prices for a list of price dimensions, using the calculate function of a service module.
+Price dimensions are grouped by partition (region, term type, tenancy, etc.) and each group is calculated in one pass:
+the tier bands for each distinct query are resolved once and reused by the rest of the group (see get_tier_bands).
+Identical price dimensions are only calculated once.
+
+Errors are returned for each price dimension instead of being raised, so a combination that doesn't exist in the
+Price List API or an invalid input doesn't abort the rest of the batch. Returns a tuple (pricing result, error type,
+error message) for each price dimension, in the same order as pdims. When columnar is set, the results are returned
+as a dict of lists instead: pricingResults, totalCosts, errorTypes and errorMessages.
+"""
+def calculate_batch(calculate, pdims, columnar=False):
+  global batchbands
+  ts = Timestamp()
+  ts.start('calculateBatch')
+  result = [None] * len(pdims)
+
+  partitionGroups = {}
+  for i, p in enumerate(pdims):
+    partitionGroups.setdefault(get_pdim_partition(p), OrderedDict()).setdefault(get_pdim_key(p), []).append(i)
+
+  distinctCount = 0
+  errorCount = 0
+  for partition in sorted(partitionGroups):
+    batchbands = {}
+    try:
+      for positions in partitionGroups[partition].values():
+        pdimResult = calculate_batch_pdim(calculate, pdims[positions[0]])
+        distinctCount += 1
+        if pdimResult[1]: errorCount += 1
+        for i in positions: result[i] = pdimResult
+    finally:
+      batchbands = None
+
+  log.info("Calculated [{}] price dimensions ([{}] distinct, [{}] partition groups, [{}] errors) in [{}]".format(
+           len(pdims), distinctCount, len(partitionGroups), errorCount, ts.finish('calculateBatch')))
+
+  if columnar:
+    return {'pricingResults': [r[0] for r in result],
+            'totalCosts': [r[0]['totalCost'] if r[0] else None for r in result],
+            'errorTypes': [r[1] for r in result],
+            'errorMessages': [r[2] for r in result]}
+  return result
+
+
+#Same error handling as utils.calculate_scenario: errors from the errors module are returned as (error type, message)
+def calculate_batch_pdim(calculate, pdim):
+  try:
+    return calculate(pdim), None, None
+  except (NoDataFoundError, ValidationError) as e:
+    log.debug(e.message)
+    return None, type(e).__name__, e.message
+
+
+#Returns a key that identifies price dimensions with the same values
+def get_pdim_key(pdim):
+  return tuple(sorted((k, repr(v)) for k, v in vars(pdim).items()))
+
+
+#Returns the attributes that determine which partitions are used to calculate a price dimension
+def get_pdim_partition(pdim):
+  return tuple(str(getattr(pdim, a, '')) for a in ('region', 'termType', 'tenancy', 'offeringClass', 'offeringType'))
+
 
 
 class Timestamp():
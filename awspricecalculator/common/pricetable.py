@@ -0,0 +1,339 @@
+import logging
+import sys
+import json, struct, mmap
+from array import array
+import numpy
+from . import consts
+
+log = logging.getLogger()
+
+
+#Binary partition format - see write_packed for a description of the file layout
+PACKED_FILE_FORMAT = 'bin'
+PACKED_MAGIC = b'AWSP'
+PACKED_FORMAT_VERSION = 1
+PACKED_PREAMBLE = struct.Struct('<4sHI') #magic, format version, header length
+PACKED_ALIGNMENT = 8
+CODE_TYPE = 'I' #unsigned 32-bit codes into the string table
+#Estimated bytes for each row number in an index and each entry in the decoded strings dict (besides the objects' own size)
+INDEX_ROW_SIZE = 36
+DECODED_STRING_ENTRY_SIZE = 100
+
+
+"""
+In-memory representation of a single price list partition (i.e. all On-Demand Compute Instance records for a region).
+
+Records are stored in columnar format: every distinct value in the partition is interned in a string table
+and each column is an array of integer codes into that table. Instead of scanning every record for every query,
+the table builds a composite-key hash index the first time a particular combination of attributes is queried
+(i.e. 'Instance Type' + 'Operating System' + 'License Model' ...) and reuses it for every subsequent lookup,
+which turns each query into a dictionary probe. Records are only decoded into dicts when they match a query.
+
+Tables loaded from binary partitions are memory-mapped: columns are read in place from the mapped file and strings
+are only decoded when a query or a matching record needs them, so a partition is never fully held in memory.
+"""
+class PriceTable():
+
+  def __init__(self, name, fields, strings, columns, rowCount, size=0):
+    self.name = name
+    self.size = size #estimated number of bytes used by the table
+    self.fields = list(fields)
+    self.strings = strings
+    self.columns = dict(zip(self.fields, columns))
+    self.rowCount = rowCount
+    self.codes = None
+    self.indexes = {}
+    #Called with the table and the number of bytes it grows by when indexes are built or strings are decoded, so
+    #the owner of the table (see phelper.PartitionCache) can account for them
+    self.onGrow = None
+    if isinstance(strings, PackedStrings): strings.onGrow = self.grow
+
+
+  #Creates a table from a list of dicts (i.e. the output of csv.DictReader)
+  @classmethod
+  def from_rows(cls, name, fields, rows):
+    fields = list(fields)
+    codes = {}
+    strings = []
+    columns = [array(CODE_TYPE) for f in fields]
+    rowCount = 0
+    for r in rows:
+      for f, col in zip(fields, columns):
+        v = r.get(f)
+        if v is None: v = ''
+        c = codes.get(v)
+        if c is None:
+          c = codes[v] = len(strings)
+          strings.append(v)
+        col.append(c)
+      rowCount += 1
+    size = sum(len(s) for s in strings) + (rowCount * len(fields) * columns[0].itemsize if fields else 0)
+    table = cls(name, fields, strings, columns, rowCount, size)
+    table.codes = codes
+    return table
+
+
+  #Loads a table from a file created by write_packed. The file is memory-mapped and used read-only.
+  @classmethod
+  def load(cls, name, filename):
+    with open(filename, 'rb') as f:
+      buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    header, stringOffsets, stringData, columns = read_packed(buf)
+    return cls(name, header['fields'], PackedStrings(stringOffsets, stringData), columns, header['rowCount'], len(buf))
+
+
+  def __len__(self):
+    return self.rowCount
+
+
+  def get_code(self, value):
+    if self.codes is not None: return self.codes.get(value)
+    return self.strings.find(value)
+
+
+  def get_row(self, i):
+    return {f:self.strings[self.columns[f][i]] for f in self.fields}
+
+
+  #Returns the decoded values of a column, for all records in the table
+  def get_column(self, field):
+    if field not in self.columns: return [''] * self.rowCount
+    return [self.strings[c] for c in self.columns[field]]
+
+
+  #Query format: {'<field name>':<value>, ...} - all conditions must match (equivalent to a logical AND)
+  def search(self, query):
+    fields = tuple(sorted(query.keys()))
+    key = []
+    for f in fields:
+      c = self.get_code(query[f])
+      #Fields or values that don't exist in the partition can never match
+      if f not in self.columns or c is None: return []
+      key.append(c)
+    index = self.indexes.get(fields)
+    if index is None: index = self.build_index(fields)
+    return [self.get_row(i) for i in index.get(tuple(key), [])]
+
+
+  #Returns the tier bands for the records that match a query. Bands are not kept in the table, they're cached by the
+  #caller (see phelper.TierBandsCache), so there's a single bounded cache for all partitions.
+  def get_tier_bands(self, query):
+    return TierBands(self.search(query))
+
+
+  def build_index(self, fields):
+    index = {}
+    for i, key in enumerate(zip(*[self.columns[f] for f in fields])):
+      index.setdefault(key, []).append(i)
+    self.indexes[fields] = index
+    self.grow(get_index_size(index, self.rowCount))
+    log.debug("Created index on {} for partition [{}] - distinct keys:[{}]".format(fields, self.name, len(index)))
+    return index
+
+
+  def grow(self, delta):
+    self.size += delta
+    if self.onGrow: self.onGrow(self, delta)
+
+
+
+#Estimated number of bytes used by an index: the dict, its key tuples and row lists, and the row numbers in the lists
+def get_index_size(index, rowCount):
+  return sys.getsizeof(index) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in index.items()) + INDEX_ROW_SIZE * rowCount
+
+
+
+
+"""
+Numeric representation of the price bands in a group of price records (i.e. all the tiers for S3 Standard storage
+in a region). StartingRange, EndingRange and PricePerUnit are parsed once when the bands are created,
+so evaluating a usage amount doesn't require any string parsing or comparisons against the 'Inf' sentinel.
+"""
+class TierBands():
+
+  def __init__(self, rows):
+    self.rows = rows
+    self.begin = []
+    self.end = []
+    self.price = []
+    for r in rows:
+      self.begin.append(int(r['StartingRange']) if r['StartingRange'] else 0)
+      #None means the band has no upper limit
+      endRange = r['EndingRange']
+      self.end.append(None if not endRange or endRange == consts.INFINITY else int(endRange))
+      self.price.append(float(r['PricePerUnit']))
+
+    #Arrays used to evaluate multiple usage amounts in a single pass
+    self.beginArray = numpy.array(self.begin, dtype=numpy.float64)
+    self.endArray = numpy.array([numpy.inf if e is None else e for e in self.end], dtype=numpy.float64)
+    self.priceArray = numpy.array(self.price, dtype=numpy.float64)
+
+
+  def __len__(self):
+    return len(self.rows)
+
+
+  #Returns (row, billable usage, price per unit, amount) for each band, for a single usage amount
+  def evaluate(self, usageAmount):
+    result = []
+    for r, beginRange, endRange, pricePerUnit in zip(self.rows, self.begin, self.end, self.price):
+      billableBand = 0
+      amt = 0
+      if endRange is None or endRange >= usageAmount:
+        if beginRange < usageAmount: billableBand = usageAmount - beginRange
+      else:
+        billableBand = endRange - beginRange
+      if billableBand > 0: amt = pricePerUnit * billableBand
+      result.append((r, billableBand, pricePerUnit, amt))
+    return result
+
+
+  """
+  Evaluates an array of usage amounts against all bands at once.
+  Returns a (usage amounts x bands) matrix with the billable usage in each band and an array with the total amount
+  for each usage amount.
+  """
+  def evaluate_array(self, usageAmounts):
+    usage = numpy.asarray(usageAmounts, dtype=numpy.float64).reshape(-1, 1)
+    billable = numpy.clip(numpy.minimum(usage, self.endArray) - self.beginArray, 0, None)
+    return billable, billable.dot(self.priceArray)
+
+
+
+
+"""
+Read-only view of the sorted string table in a binary partition.
+Strings are decoded on first access and cached; lookups by value use a binary search on the encoded strings
+(sorting by code point is equivalent to sorting the UTF-8 bytes), so no dictionary of all values is ever built.
+"""
+class PackedStrings():
+
+  def __init__(self, offsets, data):
+    self.offsets = offsets
+    self.data = data
+    self.decoded = {}
+    self.onGrow = None #called with the number of bytes used by each decoded string (see PriceTable.grow)
+
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+
+  def __getitem__(self, i):
+    s = self.decoded.get(i)
+    if s is None:
+      s = self.decoded[i] = self.get_bytes(i).decode('utf-8')
+      if self.onGrow: self.onGrow(sys.getsizeof(s) + DECODED_STRING_ENTRY_SIZE)
+    return s
+
+
+  def get_bytes(self, i):
+    return bytes(self.data[self.offsets[i]:self.offsets[i+1]])
+
+
+  #Returns the code for a value, or None if the value is not in the table
+  def find(self, value):
+    if not isinstance(value, str): return None
+    target = value.encode('utf-8')
+    lo, hi = 0, len(self)
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self.get_bytes(mid) < target: lo = mid + 1
+      else: hi = mid
+    if lo < len(self) and self.get_bytes(lo) == target: return lo
+    return None
+
+
+
+
+"""
+Writes a partition in a precompiled binary format, so it can be loaded without parsing CSV records.
+File layout (little-endian):
+  - preamble: magic (4 bytes), format version (uint16), header length (uint32)
+  - header: JSON document with field names, number of records and number of strings
+  - string table: (stringCount + 1) uint32 offsets, followed by the UTF-8 encoded strings in sorted order
+  - columns: one array of rowCount uint32 codes per field, in the same order as the field names
+Sections are aligned to 8 bytes, so columns can be used in place without copying them.
+"""
+def write_packed(filename, fields, rows):
+  fields = list(fields)
+
+  #rows is read once, so it can be an iterable that reads records from a file instead of a list. Strings are coded in
+  #the order they're found and the codes are remapped to the sorted string table at the end.
+  codes = {}
+  columns = [array(CODE_TYPE) for f in fields]
+  rowCount = 0
+  for r in rows:
+    for f, col in zip(fields, columns):
+      v = r.get(f) or ''
+      c = codes.get(v)
+      if c is None: c = codes[v] = len(codes)
+      col.append(c)
+    rowCount += 1
+
+  strings = sorted(codes)
+  sortedCodes = array(CODE_TYPE, [0]) * len(strings)
+  for i, v in enumerate(strings): sortedCodes[codes[v]] = i
+  columns = [array(CODE_TYPE, (sortedCodes[c] for c in col)) for col in columns]
+
+  stringOffsets = array(CODE_TYPE, [0])
+  stringData = bytearray()
+  for s in strings:
+    stringData += s.encode('utf-8')
+    stringOffsets.append(len(stringData))
+
+  header = json.dumps({'fields':fields, 'rowCount':rowCount, 'stringCount':len(strings),
+                     'stringDataLength':len(stringData)}).encode('utf-8')
+
+  with open(filename, 'wb') as f:
+    write_aligned(f, PACKED_PREAMBLE.pack(PACKED_MAGIC, PACKED_FORMAT_VERSION, len(header)) + header)
+    write_aligned(f, to_little_endian(stringOffsets).tobytes())
+    write_aligned(f, bytes(stringData))
+    for col in columns:
+      f.write(to_little_endian(col).tobytes())
+
+
+def write_aligned(f, data):
+  f.write(data)
+  padding = -len(data) % PACKED_ALIGNMENT
+  if padding: f.write(b'\0' * padding)
+
+
+def to_little_endian(a):
+  if sys.byteorder != 'little': a.byteswap()
+  return a
+
+
+"""
+Parses a buffer with the contents of a file created by write_packed.
+Returns the header, the string offsets, the string data and the columns, all of them as views on the original buffer.
+"""
+def read_packed(buf):
+  view = memoryview(buf)
+  magic, version, headerLength = PACKED_PREAMBLE.unpack_from(view, 0)
+  if magic != PACKED_MAGIC or version != PACKED_FORMAT_VERSION:
+    raise ValueError("Unsupported partition format - magic:[{}] version:[{}]".format(magic, version))
+  if sys.byteorder != 'little' or array(CODE_TYPE).itemsize != 4:
+    raise ValueError("Packed partitions are not supported on this platform")
+
+  offset = PACKED_PREAMBLE.size
+  header = json.loads(bytes(view[offset:offset+headerLength]).decode('utf-8'))
+  offset = align(offset + headerLength)
+
+  stringCount = header['stringCount']
+  rowCount = header['rowCount']
+  stringOffsets = view[offset:offset+(stringCount+1)*4].cast(CODE_TYPE)
+  offset = align(offset + (stringCount+1)*4)
+  stringData = view[offset:offset+header['stringDataLength']]
+  offset = align(offset + header['stringDataLength'])
+
+  columns = []
+  for f in header['fields']:
+    columns.append(view[offset:offset+rowCount*4].cast(CODE_TYPE))
+    offset += rowCount*4
+
+  return header, stringOffsets, stringData, columns
+
+
+def align(offset):
+  return offset + (-offset % PACKED_ALIGNMENT)
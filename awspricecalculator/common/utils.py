@@ -1,6 +1,7 @@
 import json, logging
-from . import consts, models
+from . import consts, models, phelper
 import datetime
+from concurrent.futures import ProcessPoolExecutor
 
 from ..ec2 import pricing as ec2pricing
 from ..s3 import pricing as s3pricing
@@ -10,7 +11,8 @@ from ..redshift import pricing as redshiftpricing
 from ..awslambda import pricing as lambdapricing
 from ..dynamodb import pricing as ddbpricing
 from ..kinesis import pricing as kinesispricing
-from . errors import NoDataFoundError
+from ..datatransfer import pricing as datatransferpricing
+from . errors import NoDataFoundError, ValidationError
 
 log = logging.getLogger()
 
@@ -31,6 +33,73 @@ def buildSkuTable(evaluated_sku_desc):
   return result
 
 
+"""
+Calculates prices for a list of price dimensions for a service (i.e. a list of Ec2PriceDimension for an entire fleet).
+Returns a tuple (pricing result, error type, error message) for each price dimension, or a dict of lists when columnar
+is set - see phelper.calculate_batch.
+"""
+def calculate_batch(service, pdims, columnar=False):
+  BATCH_CALCULATORS = {consts.SERVICE_EC2: ec2pricing, consts.SERVICE_EMR: emrpricing, consts.SERVICE_REDSHIFT: redshiftpricing,
+                       consts.SERVICE_S3: s3pricing, consts.SERVICE_RDS: rdspricing, consts.SERVICE_LAMBDA: lambdapricing,
+                       consts.SERVICE_DYNAMODB: ddbpricing, consts.SERVICE_KINESIS: kinesispricing,
+                       consts.SERVICE_DATA_TRANSFER: datatransferpricing}
+  if service not in BATCH_CALCULATORS:
+    raise ValidationError("Service [{}] is not supported for batch calculations".format(service))
+  return BATCH_CALCULATORS[service].calculate_batch(pdims, columnar)
+
+
+"""
+Calculates the price for a list of price dimension arguments (scenarios) for a service. Unless they're scenarios for
+multiple regions (crossRegion), when there are enough scenarios they're calculated in a pool of processes.
+Consecutive scenarios are assigned to the same process, since they usually use the same partitions (i.e. all instance
+types in a region), so each process loads them once and keeps them in its partition cache. If the pool can't be
+created (i.e. in environments without shared memory, like AWS Lambda), scenarios are calculated in the current process.
+Returns a tuple (pricing result, error type, error message) for each scenario, in the same order as the scenarios.
+"""
+def calculate_scenarios(service, scenarios, crossRegion=False):
+  #Scenarios for multiple regions are calculated in the current process, since all regions are resolved with a single
+  #search in the cross-region partitions (see phelper.TierBandsCache)
+  if crossRegion:
+    phelper.tierbandscache.crossRegion = True
+    try:
+      return [calculate_scenario(service, s) for s in scenarios]
+    finally:
+      phelper.tierbandscache.crossRegion = False
+
+  workers = min(consts.COMPARE_MAX_WORKERS, len(scenarios))
+  executor = None
+  if workers > 1 and len(scenarios) >= consts.COMPARE_MIN_PARALLEL_SCENARIOS:
+    try:
+      executor = ProcessPoolExecutor(max_workers=workers)
+    except (OSError, NotImplementedError) as e:
+      log.warning("Could not calculate scenarios in parallel, using a single process - {}".format(e))
+
+  if executor is None:
+    return [calculate_scenario(service, s) for s in scenarios]
+
+  #Errors other than the ones in the errors module (see calculate_scenario) are raised from the pool, the same way they
+  #are in the current process. If a pool process dies, BrokenProcessPool is raised.
+  chunksize = -(-len(scenarios) // workers)
+  with executor:
+    return list(executor.map(calculate_scenario, [service] * len(scenarios), scenarios, chunksize=chunksize))
+
+
+"""
+Calculates the price for a single scenario. Errors are returned as (error type, message) instead of being raised,
+since the exceptions in the errors module can't be sent back from a process pool.
+"""
+def calculate_scenario(service, kwargs):
+  COMPARE_CALCULATORS = {consts.SERVICE_EC2: (models.Ec2PriceDimension, ec2pricing), consts.SERVICE_EMR: (models.EmrPriceDimension, emrpricing),
+                         consts.SERVICE_REDSHIFT: (models.RedshiftPriceDimension, redshiftpricing), consts.SERVICE_S3: (models.S3PriceDimension, s3pricing),
+                         consts.SERVICE_RDS: (models.RdsPriceDimension, rdspricing), consts.SERVICE_LAMBDA: (models.LambdaPriceDimension, lambdapricing),
+                         consts.SERVICE_DYNAMODB: (models.DynamoDBPriceDimension, ddbpricing), consts.SERVICE_KINESIS: (models.KinesisPriceDimension, kinesispricing)}
+  pdimClass, pricing = COMPARE_CALCULATORS[service]
+  try:
+    return pricing.calculate(pdimClass(**kwargs)), None, None
+  except (NoDataFoundError, ValidationError) as e:
+    return None, type(e).__name__, e.message
+
+
 #It calculates price based on a variable price dimension. For example: by region, os, instance type, etc.
 #TODO:include sortCriteria in the parameters for this function, instead of having it in kwargs (which are meant for priceDimensions only)
 def compare(**kwargs):
@@ -45,6 +114,12 @@ def compare(**kwargs):
 
 
 
+  #Each scenario is a tuple (criteria value, price dimension arguments). Scenarios are calculated after the loops below.
+  #Combinations that don't exist in the PriceList API are skipped (skipNoData) and, for some criteria,
+  #results without pricing records are excluded (requireRecords).
+  skipNoData = True
+  requireRecords = False
+
   #Sort by AWS Region - Total Cost and To-region (for sorting by destination - find which regions are cheaper for backups)
   if sortCriteria in [consts.SORT_CRITERIA_REGION, consts.SORT_CRITERIA_TO_REGION]:
     tableCriteriaHeader = "Sorted by total cost by region\nRegion code\tRegion name\t"
@@ -62,30 +137,9 @@ def compare(**kwargs):
       if kwargs.get('dataTransferOutInterRegionGb',0) > 0 and kwargs['region'] == kwargs['toRegion']:
         kwargs.pop('dataTransferOutInterRegionGb',0)
 
-      try:
-        if service == consts.SERVICE_EC2:
-          p = ec2pricing.calculate(models.Ec2PriceDimension(**kwargs))
-        if service == consts.SERVICE_EMR:
-          p = emrpricing.calculate(models.EmrPriceDimension(**kwargs))
-        if service == consts.SERVICE_REDSHIFT:
-          p = redshiftpricing.calculate(models.RedshiftPriceDimension(**kwargs))
-        if service == consts.SERVICE_S3:
-          p = s3pricing.calculate(models.S3PriceDimension(**kwargs))
-        if service == consts.SERVICE_RDS:
-          p = rdspricing.calculate(models.RdsPriceDimension(**kwargs))
-        if service == consts.SERVICE_LAMBDA:
-          p = lambdapricing.calculate(models.LambdaPriceDimension(**kwargs))
-        if service == consts.SERVICE_DYNAMODB:
-          p = ddbpricing.calculate(models.DynamoDBPriceDimension(**kwargs))
-        if service == consts.SERVICE_KINESIS:
-          p = kinesispricing.calculate(models.KinesisPriceDimension(**kwargs))
-
-      except NoDataFoundError:
-        continue
-
-      log.debug ("PricingResult: [{}]".format(json.dumps(p)))
-      #Only append records for those combinations that exist in the PriceList API
-      if p['pricingRecords']: result.append((p['totalCost'],r,p))
+      scenarioArray.append((r, kwargs))
+    #Only append records for those combinations that exist in the PriceList API
+    requireRecords = True
 
  #Sort by Instance Type (EC2, EMR, Redshift, etc.)
   if sortCriteria == consts.SORT_CRITERIA_INSTANCE_TYPE:
@@ -95,37 +149,20 @@ def compare(**kwargs):
     else: instanceTypes=consts.SUPPORTED_INSTANCE_TYPES_MAP[service]
     log.info("instanceTypes: [{}]".format(instanceTypes))
     for t in instanceTypes:
-      kwargs['instanceType']=t
-      try:
-        if service == consts.SERVICE_EC2: p = ec2pricing.calculate(models.Ec2PriceDimension(**kwargs))
-        if service == consts.SERVICE_EMR: p = emrpricing.calculate(models.EmrPriceDimension(**kwargs))
-        if service == consts.SERVICE_REDSHIFT: p = redshiftpricing.calculate(models.RedshiftPriceDimension(**kwargs))
-        result.append((p['totalCost'],t,p))
-      except NoDataFoundError:
-        pass
+      scenarioArray.append((t, dict(kwargs, instanceType=t)))
 
  #Sort by EC2 Operating System
   if sortCriteria == consts.SORT_CRITERIA_OS:
     tableCriteriaHeader = "Total cost sorted by Operating System in region ["+kwargs['region']+"]\nOS\t"
     for o in consts.SUPPORTED_EC2_OPERATING_SYSTEMS:
-      kwargs['operatingSystem']=o
-      try:
-        p = ec2pricing.calculate(models.Ec2PriceDimension(**kwargs))
-        result.append((p['totalCost'],o,p))
-      except NoDataFoundError:
-        pass
+      scenarioArray.append((o, dict(kwargs, operatingSystem=o)))
 
 
   #Sort by RDS DB Instance Class
   if sortCriteria == consts.SORT_CRITERIA_DB_INSTANCE_CLASS:
     tableCriteriaHeader = "Total cost sorted by DB Instance Class in region ["+kwargs['region']+"]\nDB Instance Class\t"
     for ic in consts.SUPPORTED_RDS_INSTANCE_CLASSES:
-      kwargs['dbInstanceClass']=ic
-      try:
-        p = rdspricing.calculate(models.RdsPriceDimension(**kwargs))
-        result.append((p['totalCost'],ic,p))
-      except NoDataFoundError:
-        pass
+      scenarioArray.append((ic, dict(kwargs, dbInstanceClass=ic)))
 
   #Sort by RDS DB Engine
   if sortCriteria == consts.SORT_CRITERIA_DB_ENGINE:
@@ -139,20 +176,16 @@ def compare(**kwargs):
           #SCRIPT_RDS_LICENSE_MODEL_PUBLIC is the only applicable license model for open source engines
           if lm == consts.SCRIPT_RDS_LICENSE_MODEL_PUBLIC: kwargs['licenseModel'] = consts.SCRIPT_RDS_LICENSE_MODEL_PUBLIC
           else: continue
-        try:
-          p = rdspricing.calculate(models.RdsPriceDimension(**kwargs))
-          result.append((p['totalCost'],"{} - {}".format(e,lm),p))
-        except NoDataFoundError:
-          pass
+        scenarioArray.append(("{} - {}".format(e,lm), dict(kwargs)))
 
 
   #Sort by Lambda memory
   if sortCriteria == consts.SORT_CRITERIA_LAMBDA_MEMORY:
     tableCriteriaHeader = "Total cost sorted Allocated Memory in region ["+kwargs['region']+"]\nMemory\t"
     for m in consts.LAMBDA_MEM_SIZES:
-      kwargs['memoryMb']=m
-      p = lambdapricing.calculate(models.LambdaPriceDimension(**kwargs))
-      if p['pricingRecords']: result.append((p['totalCost'],m,p))
+      scenarioArray.append((m, dict(kwargs, memoryMb=m)))
+    skipNoData = False
+    requireRecords = True
 
 
   #Sort by S3 Storage Class
@@ -161,24 +194,16 @@ def compare(**kwargs):
     tableCriteriaHeader = "Tocal cost sorted by S3 Storage Class in region ["+kwargs['region']+"]\nStorage Class\t"
     criteria_array = consts.SUPPORTED_S3_STORAGE_CLASSES
     for c in criteria_array:
-      kwargs['storageClass']=c
-      try:
-        p = s3pricing.calculate(models.S3PriceDimension(**kwargs))
-        if p['pricingRecords']: result.append((p['totalCost'],c,p))
-      except NoDataFoundError:
-        pass
+      scenarioArray.append((c, dict(kwargs, storageClass=c)))
+    requireRecords = True
 
   #Sort by S3 Storage Size (this implies that a comma-separated list of values is supplied for storage-size-gb
   if sortCriteria == consts.SORT_CRITERIA_S3_STORAGE_SIZE_GB:
     tableCriteriaHeader = "Tocal cost sorted by S3 Storage Size (GB) in region ["+kwargs['region']+"]\nStorage Size GB\t"
     criteria_array = kwargs.get('storageSizeGb','').split(consts.SORT_CRITERIA_VALUE_SEPARATOR)
     for c in criteria_array:
-      kwargs['storageSizeGb']=int(c)
-      try:
-        p = s3pricing.calculate(models.S3PriceDimension(**kwargs))
-        if p['pricingRecords']: result.append((p['totalCost'],c,p))
-      except NoDataFoundError:
-        pass
+      scenarioArray.append((c, dict(kwargs, storageSizeGb=int(c))))
+    requireRecords = True
 
   #Sort by S3 Data Retrieval GB (this implies that a comma-separated list of values is supplied for data-retrieval-gb)
   #For now, it excludes data transfer out to the internet. #TODO: include a parameter for data transfer out, proportional to data retrieval
@@ -186,12 +211,8 @@ def compare(**kwargs):
     tableCriteriaHeader = "Tocal cost sorted by S3 Data Retrieval (GB) for Storage Class [{}] in region [{}]\nData Retrieval GB\t".format(kwargs['storageClass'],kwargs['region'])
     criteria_array = kwargs.get('dataRetrievalGb','').split(consts.SORT_CRITERIA_VALUE_SEPARATOR)
     for c in criteria_array:
-      kwargs['dataRetrievalGb']=int(c)
-      try:
-        p = s3pricing.calculate(models.S3PriceDimension(**kwargs))
-        if p['pricingRecords']: result.append((p['totalCost'],c,p))
-      except NoDataFoundError:
-        pass
+      scenarioArray.append((c, dict(kwargs, dataRetrievalGb=int(c))))
+    requireRecords = True
 
 
   #Sort by S3 Data Retrieval GB AND Storage Class (this implies that a comma-separated list of values is supplied for data-retrieval-gb)
@@ -201,13 +222,19 @@ def compare(**kwargs):
     criteria_array = kwargs.get('dataRetrievalGb','').split(consts.SORT_CRITERIA_VALUE_SEPARATOR)
     for sc in consts.SUPPORTED_S3_STORAGE_CLASSES:
       for c in criteria_array:
-        kwargs['storageClass'] = sc
-        kwargs['dataRetrievalGb']=int(c)
-        try:
-          p = s3pricing.calculate(models.S3PriceDimension(**kwargs))
-          if p['pricingRecords']: result.append((p['totalCost'],"{}_{}GB".format(sc,c),p))
-        except NoDataFoundError:
-          pass
+        scenarioArray.append(("{}_{}GB".format(sc,c), dict(kwargs, storageClass=sc, dataRetrievalGb=int(c))))
+    requireRecords = True
+
+  #Results are merged in the same order as the scenarios, regardless of the order in which they were calculated
+  crossRegion = sortCriteria == consts.SORT_CRITERIA_REGION
+  for (c, scenarioKwargs), (p, errorType, message) in zip(scenarioArray, calculate_scenarios(service, [k for c, k in scenarioArray], crossRegion)):
+    if errorType == ValidationError.__name__: raise ValidationError(message)
+    if errorType == NoDataFoundError.__name__:
+      if skipNoData: continue
+      raise NoDataFoundError(message)
+    log.debug ("PricingResult: [{}]".format(json.dumps(p)))
+    if requireRecords and not p['pricingRecords']: continue
+    result.append((p['totalCost'],c,p))
 
   sorted_result = sorted(result)
   log.debug ("sorted_result: {}".format(sorted_result))
@@ -1,68 +1,122 @@
 
 import json
 import logging
+import weakref
 from ..common import consts, phelper
 from ..common.models import PricingResult
-import tinydb
+from ..common.pricetable import TierBands
 
 log = logging.getLogger()
-regiondbs = {}
 indexMetadata = {}
+datatransfertables = weakref.WeakKeyDictionary()
+
+OUTBOUND_QUERY = {'To Location': 'External', 'Transfer Type': 'AWS Outbound'}
+INTRA_REGION_QUERY = {'Transfer Type': 'IntraRegion'}
+INTER_REGION_TRANSFER_TYPE = 'InterRegion Outbound'
 
 
 def calculate(pdim):
 
-  log.info("Calculating AWSDataTransfer pricing with the following inputs: {}".format(str(pdim.__dict__)))
+  log.debug("Calculating AWSDataTransfer pricing with the following inputs: {}".format(pdim.__dict__))
 
   ts = phelper.Timestamp()
   ts.start('totalCalculation')
-  ts.start('tinyDbLoadOnDemand')
+  ts.start('priceTableLoadOnDemand')
 
   awsPriceListApiVersion = ''
   cost = 0
   pricing_records = []
-  priceQuery = tinydb.Query()
 
-  global regiondbs
   global indexMetadata
 
   #Load On-Demand DBs
-  indexArgs = {}
-  tmpDbKey = consts.SERVICE_DATA_TRANSFER+pdim.region+pdim.termType+pdim.tenancy
-  dbs = regiondbs.get(tmpDbKey,{})
-  if not dbs:
-    dbs, indexMetadata = phelper.loadDBs(consts.SERVICE_DATA_TRANSFER, phelper.get_partition_keys(consts.SERVICE_DATA_TRANSFER, pdim.region, consts.SCRIPT_TERM_TYPE_ON_DEMAND, **indexArgs))
-    regiondbs[tmpDbKey]=dbs
-
-  ts.finish('tinyDbLoadOnDemand')
-  log.debug("Time to load OnDemand DB files: [{}]".format(ts.elapsed('tinyDbLoadOnDemand')))
-
-  #Data Transfer
-  dataTransferDb = dbs[phelper.create_file_key((consts.REGION_MAP[pdim.region], consts.TERM_TYPE_MAP[pdim.termType], consts.PRODUCT_FAMILY_DATA_TRANSFER))]
-
-  #Out to the Internet
-  if pdim.dataTransferOutInternetGb:
-    ts.start('searchDataTransfer')
-    query = ((priceQuery['To Location'] == 'External') & (priceQuery['Transfer Type'] == 'AWS Outbound'))
-    pricing_records, cost = phelper.calculate_price(consts.SERVICE_DATA_TRANSFER, dataTransferDb, query, pdim.dataTransferOutInternetGb, pricing_records, cost)
-    log.debug("Time to search AWSDataTransfer data transfer Out: [{}]".format(ts.finish('searchDataTransfer')))
-
-  #Intra-regional data transfer - in/out/between AZs or using EIPs or ELB
-  if pdim.dataTransferOutIntraRegionGb:
-    query = ((priceQuery['Transfer Type'] == 'IntraRegion'))
-    pricing_records, cost = phelper.calculate_price(consts.SERVICE_DATA_TRANSFER, dataTransferDb, query, pdim.dataTransferOutIntraRegionGb, pricing_records, cost)
-
-  #Inter-regional data transfer - out to other AWS regions
-  if pdim.dataTransferOutInterRegionGb:
-    query = ((priceQuery['Transfer Type'] == 'InterRegion Outbound') & (priceQuery['To Location'] == consts.REGION_MAP[pdim.toRegion]))
-    pricing_records, cost = phelper.calculate_price(consts.SERVICE_DATA_TRANSFER, dataTransferDb, query, pdim.dataTransferOutInterRegionGb, pricing_records, cost)
-
-
-  log.debug("regiondbs:[{}]".format(regiondbs.keys()))
+  indexMetadata = phelper.getIndexMetadata(consts.SERVICE_DATA_TRANSFER)
+
+  ts.finish('priceTableLoadOnDemand')
+  log.debug("Time to load OnDemand price tables: [{}]".format(ts.elapsed('priceTableLoadOnDemand')))
+
+  #Out to the Internet, intra-regional (in/out/between AZs or using EIPs or ELB) and inter-regional (out to other AWS regions)
+  pricing_records, cost = calculate_data_transfer(pdim.region, pricing_records, cost,
+                                                  outInternetGb=pdim.dataTransferOutInternetGb,
+                                                  intraRegionGb=pdim.dataTransferOutIntraRegionGb,
+                                                  interRegionGb=pdim.dataTransferOutInterRegionGb, toRegion=pdim.toRegion)
+
+
   awsPriceListApiVersion = indexMetadata['Version']
   extraargs = {'priceDimensions':pdim}
   pricing_result = PricingResult(awsPriceListApiVersion, pdim.region, cost, pricing_records, **extraargs)
-  log.debug(json.dumps(vars(pricing_result),sort_keys=False,indent=4))
+  if log.isEnabledFor(logging.DEBUG): log.debug(json.dumps(vars(pricing_result),sort_keys=False,indent=4))
 
   log.debug("Total time: [{}]".format(ts.finish('totalCalculation')))
   return pricing_result.__dict__
+
+
+
+#Calculates prices for a list of price dimensions - see phelper.calculate_batch
+def calculate_batch(pdims, columnar=False):
+  return phelper.calculate_batch(calculate, pdims, columnar)
+
+
+
+"""
+Data transfer prices for a region, shared by all service modules that calculate data transfer costs.
+Outbound (to the internet) and intra-regional bands are resolved when the object is created, and inter-regional
+bands are grouped by destination, so calculations don't need to query the price table.
+"""
+class DataTransferPricing():
+
+  def __init__(self, dataTransferDb):
+    self.outbound = dataTransferDb.get_tier_bands(OUTBOUND_QUERY)
+    self.intraRegion = dataTransferDb.get_tier_bands(INTRA_REGION_QUERY)
+    interRegionRows = {}
+    for r in dataTransferDb.search({'Transfer Type': INTER_REGION_TRANSFER_TYPE}):
+      interRegionRows.setdefault(r['To Location'], []).append(r)
+    self.interRegion = {l:TierBands(rows) for l, rows in interRegionRows.items()}
+
+
+  """
+  Adds the data transfer cost for the usage amounts (in GB) to pricing records and cost.
+  The service is used to label the pricing records (i.e. AWSLambda records data transfer as part of the Lambda service).
+  """
+  def calculate(self, service, pricingRecords, cost, outInternetGb=0, intraRegionGb=0, interRegionGb=0, toRegion=''):
+    if outInternetGb:
+      pricingRecords, cost = phelper.calculate_bands_price(service, self.outbound, OUTBOUND_QUERY, outInternetGb, pricingRecords, cost)
+
+    if intraRegionGb:
+      pricingRecords, cost = phelper.calculate_bands_price(service, self.intraRegion, INTRA_REGION_QUERY, intraRegionGb, pricingRecords, cost)
+
+    if interRegionGb:
+      toLocation = consts.REGION_MAP[toRegion]
+      query = {'Transfer Type': INTER_REGION_TRANSFER_TYPE, 'To Location': toLocation}
+      pricingRecords, cost = phelper.calculate_bands_price(service, self.interRegion.get(toLocation), query, interRegionGb, pricingRecords, cost)
+
+    return pricingRecords, cost
+
+
+
+"""
+Adds the data transfer cost for the usage amounts (in GB) in a region to pricing records and cost.
+Prices are only loaded if there's data transfer usage. Pricing records are labeled with the service that has the
+prices (see get_data_transfer_pricing).
+"""
+def calculate_data_transfer(region, pricingRecords, cost, outInternetGb=0, intraRegionGb=0, interRegionGb=0, toRegion='',
+                            service=consts.SERVICE_DATA_TRANSFER):
+  if not (outInternetGb or intraRegionGb or interRegionGb): return pricingRecords, cost
+  return get_data_transfer_pricing(region, service).calculate(service, pricingRecords, cost, outInternetGb=outInternetGb,
+                                                              intraRegionGb=intraRegionGb, interRegionGb=interRegionGb,
+                                                              toRegion=toRegion)
+
+
+"""
+Returns the data transfer prices for a region. By default prices come from the AWSDataTransfer index, but services
+that include data transfer in their own index (i.e. AWSLambda) can use their own partition.
+The index version of the service is checked first, so prices from a previous index are discarded when it changes.
+Instances are kept as long as their price table is in the partition cache.
+"""
+def get_data_transfer_pricing(region, service=consts.SERVICE_DATA_TRANSFER):
+  phelper.getIndexMetadata(service)
+  dataTransferDb = phelper.loadDB(service, (consts.REGION_MAP[region], consts.TERM_TYPE_MAP[consts.SCRIPT_TERM_TYPE_ON_DEMAND], consts.PRODUCT_FAMILY_DATA_TRANSFER)).get_table()
+  result = datatransfertables.get(dataTransferDb)
+  if result is None:
+    result = datatransfertables[dataTransferDb] = DataTransferPricing(dataTransferDb)
+  return result
@@ -0,0 +1,149 @@
+import logging
+import numpy
+from ..common import consts, phelper
+from ..common.errors import ValidationError
+from . import pricing as ec2pricing
+
+
+log = logging.getLogger()
+pricematrices = {}
+
+
+"""
+Vectorized On-Demand compute pricing for large EC2 inventories.
+
+A price matrix holds the hourly On-Demand price for every combination of [tenancy, instance type, operating system,
+license model] in a region. Instances are encoded as integer codes against the matrix dimensions and their cost is
+calculated with a single gather on the matrix, instead of calling ec2pricing.calculate for each instance.
+Only Compute Instance hours are included (no EBS, data transfer or load balancers), for instances with no
+pre-installed software and Capacity Reservation status 'Used', which is what Ec2PriceDimension supports.
+Combinations that don't exist in the Price List API have a price of NaN.
+"""
+class Ec2PriceMatrix():
+
+  def __init__(self, region):
+    self.region = region
+    self.tenancies = list(consts.EC2_TENANCY_MAP.keys())
+    self.operatingSystems = sorted(set(consts.EC2_OPERATING_SYSTEMS_MAP.values()))
+    self.licenseModels = sorted(set(consts.EC2_LICENSE_MODEL_MAP.values()))
+
+    tables = []
+    instanceTypes = set()
+    for t in self.tenancies:
+      dbFileKey = phelper.create_file_key((consts.REGION_MAP[region], consts.TERM_TYPE_MAP[consts.SCRIPT_TERM_TYPE_ON_DEMAND],
+                                           consts.PRODUCT_FAMILY_COMPUTE_INSTANCE, consts.EC2_TENANCY_MAP[t]))
+      computeDb = ec2pricing.get_ondemand_dbs(region, t)[dbFileKey]
+      tables.append(computeDb)
+      instanceTypes.update(computeDb.get_column('Instance Type'))
+    instanceTypes.discard('')
+    self.instanceTypes = sorted(instanceTypes)
+
+    self.tenancyCodes = {v:i for i, v in enumerate(self.tenancies)}
+    self.instanceTypeCodes = {v:i for i, v in enumerate(self.instanceTypes)}
+    self.operatingSystemCodes = {v:i for i, v in enumerate(self.operatingSystems)}
+    self.licenseModelCodes = {v:i for i, v in enumerate(self.licenseModels)}
+
+    self.prices = numpy.full((len(self.tenancies), len(self.instanceTypes), len(self.operatingSystems), len(self.licenseModels)), numpy.nan)
+    for tc, computeDb in enumerate(tables):
+      self.add_prices(tc, computeDb)
+
+    log.debug("Created EC2 price matrix for region [{}] - dimensions:{}".format(region, self.prices.shape))
+
+
+  def add_prices(self, tenancyCode, computeDb):
+    columns = zip(computeDb.get_column('Instance Type'), computeDb.get_column('Operating System'),
+                  computeDb.get_column('License Model'), computeDb.get_column('Pre Installed S/W'),
+                  computeDb.get_column('CapacityStatus'), computeDb.get_column('StartingRange'),
+                  computeDb.get_column('EndingRange'), computeDb.get_column('PricePerUnit'))
+    excluded = set()
+    for instanceType, operatingSystem, licenseModel, preInstalledSw, capacityStatus, beginRange, endRange, price in columns:
+      if preInstalledSw != consts.NOT_APPLICABLE or capacityStatus != consts.EC2_CAPACITY_RESERVATION_STATUS_USED: continue
+      if instanceType not in self.instanceTypeCodes: continue
+      if operatingSystem not in self.operatingSystemCodes or licenseModel not in self.licenseModelCodes: continue
+      cell = (tenancyCode, self.instanceTypeCodes[instanceType], self.operatingSystemCodes[operatingSystem], self.licenseModelCodes[licenseModel])
+      #On-Demand instance hours have a single price band; anything else can't be represented as a single price
+      if beginRange not in ('', '0') or endRange not in ('', consts.INFINITY):
+        log.warning("Price records with multiple bands for {} in region [{}] - excluded from price matrix".format(cell, self.region))
+        excluded.add(cell)
+        continue
+      #Multiple records for the same combination are added up, the same way calculate_price does it
+      if numpy.isnan(self.prices[cell]): self.prices[cell] = 0
+      self.prices[cell] += float(price)
+    for cell in excluded: self.prices[cell] = numpy.nan
+
+
+  #Converts an array of values to an array of codes for a matrix dimension. Unknown values are encoded as -1.
+  def encode(self, values, codes, valueMap=None):
+    if valueMap: values = [valueMap.get(v) for v in values]
+    return numpy.fromiter((codes.get(v, -1) for v in values), dtype=numpy.int64, count=len(values))
+
+  def encode_tenancies(self, tenancies):
+    return self.encode(tenancies, self.tenancyCodes)
+
+  def encode_instance_types(self, instanceTypes):
+    return self.encode(instanceTypes, self.instanceTypeCodes)
+
+  def encode_operating_systems(self, operatingSystems):
+    return self.encode(operatingSystems, self.operatingSystemCodes, consts.EC2_OPERATING_SYSTEMS_MAP)
+
+  def encode_license_models(self, licenseModels):
+    return self.encode(licenseModels, self.licenseModelCodes, consts.EC2_LICENSE_MODEL_MAP)
+
+
+  """
+  Calculates the cost for arrays of encoded instances (see encode_* methods) and instance hours.
+  Returns an array with the cost of each instance - NaN for instances with codes that don't have a price.
+  """
+  def calculate_codes(self, tenancyCodes, instanceTypeCodes, operatingSystemCodes, licenseModelCodes, instanceHours):
+    codes = (numpy.asarray(tenancyCodes), numpy.asarray(instanceTypeCodes), numpy.asarray(operatingSystemCodes), numpy.asarray(licenseModelCodes))
+    valid = numpy.logical_and.reduce([c >= 0 for c in codes])
+    prices = numpy.full(valid.shape, numpy.nan)
+    prices[valid] = self.prices[tuple(c[valid] for c in codes)]
+    return prices * numpy.asarray(instanceHours, dtype=numpy.float64)
+
+
+  #Same as calculate_codes, using script values (i.e. tenancy='shared', operatingSystem='linux', licenseModel='none-required')
+  def calculate(self, tenancies, instanceTypes, operatingSystems, licenseModels, instanceHours):
+    return self.calculate_codes(self.encode_tenancies(tenancies), self.encode_instance_types(instanceTypes),
+                                self.encode_operating_systems(operatingSystems), self.encode_license_models(licenseModels),
+                                instanceHours)
+
+
+
+#Returns the price matrix for a region, creating it if it's not in memory yet (or if the index version changed)
+def get_price_matrix(region):
+  global pricematrices
+  version = phelper.getIndexMetadata(consts.SERVICE_EC2).get('Version')
+  matrix = pricematrices.get((region, version))
+  if matrix is None:
+    pricematrices = {k:v for k, v in pricematrices.items() if k[1] == version}
+    matrix = pricematrices[(region, version)] = Ec2PriceMatrix(region)
+  return matrix
+
+
+
+"""
+Calculates the On-Demand compute cost for a list of Ec2PriceDimension (i.e. an entire inventory).
+Returns an array with the cost of each price dimension. Raises ValidationError for price dimensions the price matrix
+doesn't cover (terms other than On-Demand, pre-installed software or Capacity Reservations that are not 'Used').
+"""
+def calculate_fleet(pdims):
+  result = numpy.full(len(pdims), numpy.nan)
+  regions = {}
+  for i, p in enumerate(pdims):
+    if p.termType != consts.SCRIPT_TERM_TYPE_ON_DEMAND:
+      raise ValidationError("Fleet pricing only supports term-type [{}]".format(consts.SCRIPT_TERM_TYPE_ON_DEMAND))
+    #The price matrix only has prices for instances with no pre-installed software and Capacity Reservation status 'Used'
+    if p.preInstalledSoftware != consts.NOT_APPLICABLE:
+      raise ValidationError("Fleet pricing doesn't support pre-installed software [{}]".format(p.preInstalledSoftware))
+    if p.capacityReservationStatus != consts.SCRIPT_EC2_CAPACITY_RESERVATION_STATUS_USED:
+      raise ValidationError("Fleet pricing only supports capacity reservation status [{}]".format(consts.SCRIPT_EC2_CAPACITY_RESERVATION_STATUS_USED))
+    regions.setdefault(p.region, []).append(i)
+
+  for r, positions in regions.items():
+    matrix = get_price_matrix(r)
+    rpdims = [pdims[i] for i in positions]
+    result[positions] = matrix.calculate([p.tenancy for p in rpdims], [p.instanceType for p in rpdims],
+                                         [p.operatingSystem for p in rpdims], [p.licenseModel for p in rpdims],
+                                         [p.instanceHours for p in rpdims])
+  return result
@@ -3,52 +3,35 @@ import json
 import logging
 from ..common import consts, phelper, utils
 from ..common.models import PricingResult
+from ..datatransfer import pricing as datatransferpricing
 #import psutil
-import tinydb
 
 log = logging.getLogger()
-regiondbs = {}
 indexMetadata = {}
 
 
 def calculate(pdim):
 
-  log.info("Calculating EC2 pricing with the following inputs: {}".format(str(pdim.__dict__)))
+  log.debug("Calculating EC2 pricing with the following inputs: {}".format(pdim.__dict__))
 
   ts = phelper.Timestamp()
   ts.start('totalCalculation')
-  ts.start('tinyDbLoadOnDemand')
-  ts.start('tinyDbLoadReserved')
+  ts.start('priceTableLoadOnDemand')
+  ts.start('priceTableLoadReserved')
 
   awsPriceListApiVersion = ''
   cost = 0
   pricing_records = []
-  priceQuery = tinydb.Query()
 
-  global regiondbs
   global indexMetadata
 
-
-  #DBs for Data Transfer
-  tmpDtDbKey = consts.SERVICE_DATA_TRANSFER+pdim.region+pdim.termType
-  dtdbs = regiondbs.get(tmpDtDbKey,{})
-  if not dtdbs:
-    dtdbs, dtIndexMetadata = phelper.loadDBs(consts.SERVICE_DATA_TRANSFER, phelper.get_partition_keys(consts.SERVICE_DATA_TRANSFER, pdim.region, consts.SCRIPT_TERM_TYPE_ON_DEMAND, **{}))
-    regiondbs[tmpDtDbKey]=dtdbs
-
   #_/_/_/_/_/ ON-DEMAND PRICING _/_/_/_/_/
   if pdim.termType == consts.SCRIPT_TERM_TYPE_ON_DEMAND:
     #Load On-Demand DBs
-    indexArgs = {'tenancies':[consts.EC2_TENANCY_MAP[pdim.tenancy]]}
-    tmpDbKey = consts.SERVICE_EC2+pdim.region+pdim.termType+pdim.tenancy
+    dbs = get_ondemand_dbs(pdim.region, pdim.tenancy)
 
-    dbs = regiondbs.get(tmpDbKey,{})
-    if not dbs:
-      dbs, indexMetadata = phelper.loadDBs(consts.SERVICE_EC2, phelper.get_partition_keys(consts.SERVICE_EC2, pdim.region, consts.SCRIPT_TERM_TYPE_ON_DEMAND, **indexArgs))
-      regiondbs[tmpDbKey]=dbs
-
-    ts.finish('tinyDbLoadOnDemand')
-    log.debug("Time to load OnDemand DB files: [{}]".format(ts.elapsed('tinyDbLoadOnDemand')))
+    ts.finish('priceTableLoadOnDemand')
+    log.debug("Time to load OnDemand price tables: [{}]".format(ts.elapsed('priceTableLoadOnDemand')))
 
     #TODO: Move common operations to a common module, and leave only EC2-specific operations in ec2/pricing.py (create a class)
     #TODO: support all tenancy types (Host and Dedicated)
@@ -58,47 +41,34 @@ def calculate(pdim):
                                                consts.PRODUCT_FAMILY_COMPUTE_INSTANCE, consts.EC2_TENANCY_MAP[pdim.tenancy]))
       log.debug('DB File key: [{}]'.format(dbFileKey))
       computeDb = dbs[dbFileKey]
-      ts.start('tinyDbSearchComputeFile')
-      query = ((priceQuery['Instance Type'] == pdim.instanceType) &
-              (priceQuery['Operating System'] == consts.EC2_OPERATING_SYSTEMS_MAP[pdim.operatingSystem]) &
-              #(priceQuery['Tenancy'] == consts.EC2_TENANCY_SHARED) & #removed since it's redundant with the file name
-              (priceQuery['Pre Installed S/W'] == pdim.preInstalledSoftware) &
-              (priceQuery['CapacityStatus'] == consts.EC2_CAPACITY_RESERVATION_STATUS_MAP[pdim.capacityReservationStatus]) &
-              (priceQuery['License Model'] == consts.EC2_LICENSE_MODEL_MAP[pdim.licenseModel]))# &
-              #(priceQuery['OfferingClass'] == pdim.offeringClass) &
-              #(priceQuery['PurchaseOption'] == purchaseOption ))
+      ts.start('priceTableSearchCompute')
+      query = {'Instance Type': pdim.instanceType,
+               'Operating System': consts.EC2_OPERATING_SYSTEMS_MAP[pdim.operatingSystem],
+               #'Tenancy': consts.EC2_TENANCY_SHARED, #removed since it's redundant with the file name
+               'Pre Installed S/W': pdim.preInstalledSoftware,
+               'CapacityStatus': consts.EC2_CAPACITY_RESERVATION_STATUS_MAP[pdim.capacityReservationStatus],
+               'License Model': consts.EC2_LICENSE_MODEL_MAP[pdim.licenseModel]}
+               #'OfferingClass': pdim.offeringClass,
+               #'PurchaseOption': purchaseOption
 
       pricing_records, cost = phelper.calculate_price(consts.SERVICE_EC2, computeDb, query, pdim.instanceHours, pricing_records, cost)
-      log.debug("Time to search compute:[{}]".format(ts.finish('tinyDbSearchComputeFile')))
-
+      log.debug("Time to search compute:[{}]".format(ts.finish('priceTableSearchCompute')))
 
-    #Data Transfer
-    dataTransferDb = dtdbs[phelper.create_file_key((consts.REGION_MAP[pdim.region], consts.TERM_TYPE_MAP[pdim.termType], consts.PRODUCT_FAMILY_DATA_TRANSFER))]
 
-    #Out to the Internet
-    if pdim.dataTransferOutInternetGb:
-      ts.start('searchDataTransfer')
-      query = ((priceQuery['To Location'] == 'External') & (priceQuery['Transfer Type'] == 'AWS Outbound'))
-      pricing_records, cost = phelper.calculate_price(consts.SERVICE_DATA_TRANSFER, dataTransferDb, query, pdim.dataTransferOutInternetGb, pricing_records, cost)
-      log.debug("Time to search AWS Data Transfer Out: [{}]".format(ts.finish('searchDataTransfer')))
-
-    #Intra-regional data transfer - in/out/between EC2 AZs or using EIPs or ELB
-    if pdim.dataTransferOutIntraRegionGb:
-      query = ((priceQuery['Transfer Type'] == 'IntraRegion'))
-      pricing_records, cost = phelper.calculate_price(consts.SERVICE_DATA_TRANSFER, dataTransferDb, query, pdim.dataTransferOutIntraRegionGb, pricing_records, cost)
-
-
-    #Inter-regional data transfer - out to other AWS regions
-    if pdim.dataTransferOutInterRegionGb:
-      query = ((priceQuery['Transfer Type'] == 'InterRegion Outbound') & (priceQuery['To Location'] == consts.REGION_MAP[pdim.toRegion]))
-      pricing_records, cost = phelper.calculate_price(consts.SERVICE_DATA_TRANSFER, dataTransferDb, query, pdim.dataTransferOutInterRegionGb, pricing_records, cost)
+    #Data Transfer - out to the Internet, intra-regional (in/out/between EC2 AZs or using EIPs or ELB) and inter-regional (out to other AWS regions)
+    ts.start('searchDataTransfer')
+    pricing_records, cost = datatransferpricing.calculate_data_transfer(pdim.region, pricing_records, cost,
+                                                   outInternetGb=pdim.dataTransferOutInternetGb,
+                                                   intraRegionGb=pdim.dataTransferOutIntraRegionGb,
+                                                   interRegionGb=pdim.dataTransferOutInterRegionGb, toRegion=pdim.toRegion)
+    log.debug("Time to calculate AWS Data Transfer: [{}]".format(ts.finish('searchDataTransfer')))
 
 
     #EBS Storage
     if pdim.ebsStorageGbMonth:
       #storageDb = dbs[phelper.create_file_key(consts.REGION_MAP[pdim.region], consts.TERM_TYPE_MAP[pdim.termType], consts.PRODUCT_FAMILY_STORAGE)]
       storageDb = dbs[phelper.create_file_key((consts.REGION_MAP[pdim.region], consts.TERM_TYPE_MAP[pdim.termType], consts.PRODUCT_FAMILY_STORAGE))]
-      query = ((priceQuery['Volume Type'] == pdim.volumeType))
+      query = {'Volume Type': pdim.volumeType}
       pricing_records, cost = phelper.calculate_price(consts.SERVICE_EBS, storageDb, query, pdim.ebsStorageGbMonth, pricing_records, cost)
 
 
@@ -106,39 +76,39 @@ def calculate(pdim):
     if pdim.volumeType == consts.EBS_VOLUME_TYPE_PIOPS and pdim.pIops:
       #storageDb = dbs[phelper.create_file_key(consts.REGION_MAP[pdim.region], consts.TERM_TYPE_MAP[pdim.termType], consts.PRODUCT_FAMILY_SYSTEM_OPERATION)]
       storageDb = dbs[phelper.create_file_key((consts.REGION_MAP[pdim.region], consts.TERM_TYPE_MAP[pdim.termType], consts.PRODUCT_FAMILY_SYSTEM_OPERATION))]
-      query = ((priceQuery['Group'] == 'EBS IOPS'))
+      query = {'Group': 'EBS IOPS'}
       pricing_records, cost = phelper.calculate_price(consts.SERVICE_EBS, storageDb, query, pdim.pIops, pricing_records, cost)
 
     #Snapshot Storage
     if pdim.ebsSnapshotGbMonth:
       #snapshotDb = dbs[phelper.create_file_key(consts.REGION_MAP[pdim.region], consts.TERM_TYPE_MAP[pdim.termType], consts.PRODUCT_FAMILY_SNAPSHOT)]
       snapshotDb = dbs[phelper.create_file_key((consts.REGION_MAP[pdim.region], consts.TERM_TYPE_MAP[pdim.termType], consts.PRODUCT_FAMILY_SNAPSHOT))]
-      query = ((priceQuery['usageType'] == consts.REGION_PREFIX_MAP[pdim.region]+'EBS:SnapshotUsage'))#EBS:SnapshotUsage comes with a prefix in the PriceList API file (i.e. EU-EBS:SnapshotUsage)
+      query = {'usageType': consts.REGION_PREFIX_MAP[pdim.region]+'EBS:SnapshotUsage'}#EBS:SnapshotUsage comes with a prefix in the PriceList API file (i.e. EU-EBS:SnapshotUsage)
       pricing_records, cost = phelper.calculate_price(consts.SERVICE_EBS, snapshotDb, query, pdim.ebsSnapshotGbMonth, pricing_records, cost)
 
     #Classic Load Balancer
     if pdim.elbHours:
       #elbDb = dbs[phelper.create_file_key(consts.REGION_MAP[pdim.region], consts.TERM_TYPE_MAP[pdim.termType], consts.PRODUCT_FAMILY_LOAD_BALANCER)]
       elbDb = dbs[phelper.create_file_key((consts.REGION_MAP[pdim.region], consts.TERM_TYPE_MAP[pdim.termType], consts.PRODUCT_FAMILY_LOAD_BALANCER))]
-      query = ((priceQuery['usageType'] == consts.REGION_PREFIX_MAP[pdim.region]+'LoadBalancerUsage') & (priceQuery['operation'] == 'LoadBalancing'))
+      query = {'usageType': consts.REGION_PREFIX_MAP[pdim.region]+'LoadBalancerUsage', 'operation': 'LoadBalancing'}
       pricing_records, cost = phelper.calculate_price(consts.SERVICE_ELB, elbDb, query, pdim.elbHours, pricing_records, cost)
 
     if pdim.elbDataProcessedGb:
       #elbDb = dbs[phelper.create_file_key(consts.REGION_MAP[pdim.region], consts.TERM_TYPE_MAP[pdim.termType], consts.PRODUCT_FAMILY_LOAD_BALANCER)]
       elbDb = dbs[phelper.create_file_key((consts.REGION_MAP[pdim.region], consts.TERM_TYPE_MAP[pdim.termType], consts.PRODUCT_FAMILY_LOAD_BALANCER))]
-      query = ((priceQuery['usageType'] == consts.REGION_PREFIX_MAP[pdim.region]+'DataProcessing-Bytes') & (priceQuery['operation'] == 'LoadBalancing'))
+      query = {'usageType': consts.REGION_PREFIX_MAP[pdim.region]+'DataProcessing-Bytes', 'operation': 'LoadBalancing'}
       pricing_records, cost = phelper.calculate_price(consts.SERVICE_ELB, elbDb, query, pdim.elbDataProcessedGb, pricing_records, cost)
 
     #Application Load Balancer
     #TODO: add support for Network Load Balancer
     if pdim.albHours:
       albDb = dbs[phelper.create_file_key((consts.REGION_MAP[pdim.region], consts.TERM_TYPE_MAP[pdim.termType], consts.PRODUCT_FAMILY_APPLICATION_LOAD_BALANCER))]
-      query = ((priceQuery['usageType'] == consts.REGION_PREFIX_MAP[pdim.region]+'LoadBalancerUsage') & (priceQuery['operation'] == 'LoadBalancing:Application'))
+      query = {'usageType': consts.REGION_PREFIX_MAP[pdim.region]+'LoadBalancerUsage', 'operation': 'LoadBalancing:Application'}
       pricing_records, cost = phelper.calculate_price(consts.SERVICE_ELB, albDb, query, pdim.albHours, pricing_records, cost)
 
     if pdim.albLcus:
       albDb = dbs[phelper.create_file_key((consts.REGION_MAP[pdim.region], consts.TERM_TYPE_MAP[pdim.termType], consts.PRODUCT_FAMILY_APPLICATION_LOAD_BALANCER))]
-      query = ((priceQuery['usageType'] == consts.REGION_PREFIX_MAP[pdim.region]+'LCUUsage') & (priceQuery['operation'] == 'LoadBalancing:Application'))
+      query = {'usageType': consts.REGION_PREFIX_MAP[pdim.region]+'LCUUsage', 'operation': 'LoadBalancing:Application'}
       pricing_records, cost = phelper.calculate_price(consts.SERVICE_ELB, albDb, query, pdim.albLcus, pricing_records, cost)
 
 
@@ -155,36 +125,30 @@ def calculate(pdim):
     #Load all values for offeringClasses, tenancies and purchaseOptions
     #indexArgs = {'offeringClasses':consts.EC2_OFFERING_CLASS_MAP.values(),
     #             'tenancies':consts.EC2_TENANCY_MAP.values(), 'purchaseOptions':consts.EC2_PURCHASE_OPTION_MAP.values()}
-    tmpDbKey = consts.SERVICE_EC2+pdim.region+pdim.termType+pdim.offeringClass+consts.EC2_TENANCY_MAP[pdim.tenancy]+pdim.offeringType
-    #tmpDbKey = consts.SERVICE_EC2+pdim.region+pdim.termType
-    dbs = regiondbs.get(tmpDbKey,{})
-    if not dbs:
-      dbs, indexMetadata = phelper.loadDBs(consts.SERVICE_EC2, phelper.get_partition_keys(consts.SERVICE_EC2, pdim.region, consts.SCRIPT_TERM_TYPE_RESERVED, **indexArgs))
-      #regiondbs[consts.SERVICE_EC2+pdim.region+pdim.termType]=dbs
-      regiondbs[tmpDbKey]=dbs
+    dbs, indexMetadata = phelper.loadDBs(consts.SERVICE_EC2, phelper.get_partition_keys(consts.SERVICE_EC2, pdim.region, consts.SCRIPT_TERM_TYPE_RESERVED, **indexArgs))
 
     log.debug("dbs keys:{}".format(dbs.keys()))
 
-    ts.finish('tinyDbLoadReserved')
-    log.debug("Time to load Reserved DB files: [{}]".format(ts.elapsed('tinyDbLoadReserved')))
+    ts.finish('priceTableLoadReserved')
+    log.debug("Time to load Reserved price tables: [{}]".format(ts.elapsed('priceTableLoadReserved')))
 
 
     computeDb = dbs[phelper.create_file_key((consts.REGION_MAP[pdim.region], consts.TERM_TYPE_MAP[pdim.termType],
                                              consts.PRODUCT_FAMILY_COMPUTE_INSTANCE, pdim.offeringClass,
                                              consts.EC2_TENANCY_MAP[pdim.tenancy], consts.EC2_PURCHASE_OPTION_MAP[pdim.offeringType]))]
 
-    ts.start('tinyDbSearchComputeFileReserved')
-    query = ((priceQuery['Instance Type'] == pdim.instanceType) &
-            (priceQuery['Operating System'] == consts.EC2_OPERATING_SYSTEMS_MAP[pdim.operatingSystem]) &
-            #(priceQuery['Tenancy'] == consts.EC2_TENANCY_SHARED) &   #removed since it's redundant with the DB file name
-            (priceQuery['Pre Installed S/W'] == pdim.preInstalledSoftware) &
-            (priceQuery['License Model'] == consts.EC2_LICENSE_MODEL_MAP[pdim.licenseModel]) &
-            #(priceQuery['OfferingClass'] == consts.EC2_OFFERING_CLASS_MAP[pdim.offeringClass]) &
-            #(priceQuery['PurchaseOption'] == consts.EC2_PURCHASE_OPTION_MAP[pdim.offeringType] ) &
-            (priceQuery['LeaseContractLength'] == consts.EC2_RESERVED_YEAR_MAP["{}".format(pdim.years)] ))
+    ts.start('priceTableSearchComputeReserved')
+    query = {'Instance Type': pdim.instanceType,
+             'Operating System': consts.EC2_OPERATING_SYSTEMS_MAP[pdim.operatingSystem],
+             #'Tenancy': consts.EC2_TENANCY_SHARED,   #removed since it's redundant with the partition name
+             'Pre Installed S/W': pdim.preInstalledSoftware,
+             'License Model': consts.EC2_LICENSE_MODEL_MAP[pdim.licenseModel],
+             #'OfferingClass': consts.EC2_OFFERING_CLASS_MAP[pdim.offeringClass],
+             #'PurchaseOption': consts.EC2_PURCHASE_OPTION_MAP[pdim.offeringType],
+             'LeaseContractLength': consts.EC2_RESERVED_YEAR_MAP["{}".format(pdim.years)]}
 
-    hrsQuery = query & (priceQuery['Unit'] == 'Hrs' )
-    qtyQuery = query & (priceQuery['Unit'] == 'Quantity' )
+    hrsQuery = dict(query, Unit='Hrs')
+    qtyQuery = dict(query, Unit='Quantity')
 
     if pdim.offeringType in (consts.SCRIPT_EC2_PURCHASE_OPTION_ALL_UPFRONT, consts.SCRIPT_EC2_PURCHASE_OPTION_PARTIAL_UPFRONT):
       pricing_records, cost = phelper.calculate_price(consts.SERVICE_EC2, computeDb, qtyQuery, pdim.instanceCount, pricing_records, cost)
@@ -195,17 +159,33 @@ def calculate(pdim):
       pricing_records, cost = phelper.calculate_price(consts.SERVICE_EC2, computeDb, hrsQuery, reservedInstanceHours, pricing_records, cost)
 
 
-    log.debug("Time to search:[{}]".format(ts.finish('tinyDbSearchComputeFileReserved')))
+    log.debug("Time to search:[{}]".format(ts.finish('priceTableSearchComputeReserved')))
 
 
-  log.debug("regiondbs:[{}]".format(regiondbs.keys()))
   awsPriceListApiVersion = indexMetadata['Version']
   extraargs = {'priceDimensions':pdim}
   pricing_result = PricingResult(awsPriceListApiVersion, pdim.region, cost, pricing_records, **extraargs)
-  log.debug(json.dumps(vars(pricing_result),sort_keys=False,indent=4))
+  if log.isEnabledFor(logging.DEBUG): log.debug(json.dumps(vars(pricing_result),sort_keys=False,indent=4))
 
   #proc = psutil.Process()
   #log.debug("open_files: {}".format(proc.open_files()))
 
   log.debug("Total time: [{}]".format(ts.finish('totalCalculation')))
   return pricing_result.__dict__
+
+
+
+#Returns the On-Demand price tables for a region and tenancy, loading them if they're not in memory yet
+def get_ondemand_dbs(region, tenancy):
+  global indexMetadata
+
+  indexArgs = {'tenancies':[consts.EC2_TENANCY_MAP[tenancy]]}
+
+  dbs, indexMetadata = phelper.loadDBs(consts.SERVICE_EC2, phelper.get_partition_keys(consts.SERVICE_EC2, region, consts.SCRIPT_TERM_TYPE_ON_DEMAND, **indexArgs))
+  return dbs
+
+
+
+#Calculates prices for a list of price dimensions - see phelper.calculate_batch
+def calculate_batch(pdims, columnar=False):
+  return phelper.calculate_batch(calculate, pdims, columnar)
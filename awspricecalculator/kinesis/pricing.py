@@ -3,14 +3,13 @@ import json
 import logging
 from ..common import consts, phelper
 from ..common.models import PricingResult
-import tinydb
 
 log = logging.getLogger()
 
 
 def calculate(pdim):
 
-  log.info("Calculating DynamoDB pricing with the following inputs: {}".format(str(pdim.__dict__)))
+  log.debug("Calculating DynamoDB pricing with the following inputs: {}".format(pdim.__dict__))
 
   ts = phelper.Timestamp()
   ts.start('totalCalculationKinesis')
@@ -21,20 +20,19 @@ def calculate(pdim):
   pricing_records = []
 
   awsPriceListApiVersion = indexMetadata['Version']
-  priceQuery = tinydb.Query()
 
   kinesisDb = dbs[phelper.create_file_key([consts.REGION_MAP[pdim.region], consts.TERM_TYPE_MAP[pdim.termType], consts.PRODUCT_FAMILY_KINESIS_STREAMS])]
 
   #Shard Hours
-  query = ((priceQuery['Group'] == 'Provisioned shard hour'))
+  query = {'Group': 'Provisioned shard hour'}
   pricing_records, cost = phelper.calculate_price(consts.SERVICE_KINESIS, kinesisDb, query, pdim.shardHours, pricing_records, cost)
 
   #PUT Payload Units
-  query = ((priceQuery['Group'] == 'Payload Units'))
+  query = {'Group': 'Payload Units'}
   pricing_records, cost = phelper.calculate_price(consts.SERVICE_KINESIS, kinesisDb, query, pdim.putPayloadUnits, pricing_records, cost)
 
   #Extended Retention Hours
-  query = ((priceQuery['Group'] == 'Addon shard hour'))
+  query = {'Group': 'Addon shard hour'}
   pricing_records, cost = phelper.calculate_price(consts.SERVICE_KINESIS, kinesisDb, query, pdim.extendedDataRetentionHours, pricing_records, cost)
 
   #TODO: add Enhanced (shard-level) metrics
@@ -43,7 +41,13 @@ def calculate(pdim):
   #Note there is no charge for data transfer in Kinesis as per https://aws.amazon.com/kinesis/streams/pricing/
   extraargs = {'priceDimensions':pdim}
   pricing_result = PricingResult(awsPriceListApiVersion, pdim.region, cost, pricing_records, **extraargs)
-  log.debug(json.dumps(vars(pricing_result),sort_keys=False,indent=4))
+  if log.isEnabledFor(logging.DEBUG): log.debug(json.dumps(vars(pricing_result),sort_keys=False,indent=4))
 
   log.debug("Total time to compute: [{}]".format(ts.finish('totalCalculationKinesis')))
   return pricing_result.__dict__
+
+
+
+#Calculates prices for a list of price dimensions - see phelper.calculate_batch
+def calculate_batch(pdims, columnar=False):
+  return phelper.calculate_batch(calculate, pdims, columnar)
@@ -3,32 +3,28 @@ import json
 import logging
 from ..common import consts, phelper, utils
 from ..common.models import PricingResult
-import tinydb
+from ..datatransfer import pricing as datatransferpricing
 
 log = logging.getLogger()
-regiondbs = {}
 indexMetadata = {}
 
 
 def calculate(pdim):
   ts = phelper.Timestamp()
   ts.start('totalCalculation')
-  ts.start('tinyDbLoadOnDemand')
-  ts.start('tinyDbLoadReserved')
+  ts.start('priceTableLoadReserved')
 
-  global regiondbs
   global indexMetadata
 
 
-  log.info("Calculating RDS pricing with the following inputs: {}".format(str(pdim.__dict__)))
+  log.debug("Calculating RDS pricing with the following inputs: {}".format(pdim.__dict__))
 
-  #Load On-Demand DBs
-  dbs, indexMetadata = phelper.loadDBs(consts.SERVICE_RDS, phelper.get_partition_keys(consts.SERVICE_RDS, pdim.region, consts.SCRIPT_TERM_TYPE_ON_DEMAND))
+  #Partitions are loaded on first use (only the product families needed for this calculation) - see get_db
+  indexMetadata = phelper.getIndexMetadata(consts.SERVICE_RDS)
   cost = 0
   pricing_records = []
 
   awsPriceListApiVersion = indexMetadata['Version']
-  priceQuery = tinydb.Query()
 
 
 
@@ -47,96 +43,64 @@ def calculate(pdim):
   #if 'sqlserver' in pdim.engine and pdim.deploymentOption == consts.RDS_DEPLOYMENT_OPTION_MULTI_AZ:
   #  deploymentOptionCondition = consts.RDS_DEPLOYMENT_OPTION_MULTI_AZ_MIRROR
 
-  #DBs for Data Transfer
-  tmpDtDbKey = consts.SERVICE_DATA_TRANSFER+pdim.region+pdim.termType
-  dtdbs = regiondbs.get(tmpDtDbKey,{})
-  if not dtdbs:
-    dtdbs, dtIndexMetadata = phelper.loadDBs(consts.SERVICE_DATA_TRANSFER, phelper.get_partition_keys(consts.SERVICE_DATA_TRANSFER, pdim.region, consts.SCRIPT_TERM_TYPE_ON_DEMAND, **{}))
-    regiondbs[tmpDtDbKey]=dtdbs
-
-
   #_/_/_/_/_/ ON-DEMAND PRICING _/_/_/_/_/
   if pdim.termType == consts.SCRIPT_TERM_TYPE_ON_DEMAND:
-    #Load On-Demand DBs
-    dbs = regiondbs.get(consts.SERVICE_RDS+pdim.region+pdim.termType,{})
-    if not dbs:
-        dbs, indexMetadata = phelper.loadDBs(consts.SERVICE_RDS, phelper.get_partition_keys(consts.SERVICE_RDS, pdim.region, consts.SCRIPT_TERM_TYPE_ON_DEMAND))
-        regiondbs[consts.SERVICE_RDS+pdim.region+pdim.termType]=dbs
-
-    ts.finish('tinyDbLoadOnDemand')
-    log.debug("Time to load OnDemand DB files: [{}]".format(ts.elapsed('tinyDbLoadOnDemand')))
-
     #DB Instance
     if pdim.instanceHours:
-      instanceDb = dbs[phelper.create_file_key((consts.REGION_MAP[pdim.region], consts.TERM_TYPE_MAP[pdim.termType], consts.PRODUCT_FAMILY_DATABASE_INSTANCE))]
+      instanceDb = get_db(pdim.region, pdim.termType, consts.PRODUCT_FAMILY_DATABASE_INSTANCE)
 
 
-      ts.start('tinyDbSearchComputeFile')
-      query = ((priceQuery['Product Family'] == consts.PRODUCT_FAMILY_DATABASE_INSTANCE) &
-              (priceQuery['Instance Type'] == pdim.dbInstanceClass) &
-              (priceQuery['Database Engine'] == skuEngine) &
-              (priceQuery['Database Edition'] == skuEngineEdition) &
-              (priceQuery['License Model'] == skuLicenseModel) &
-              (priceQuery['Deployment Option'] == deploymentOptionCondition)
-              )
+      ts.start('priceTableSearchCompute')
+      query = {'Product Family': consts.PRODUCT_FAMILY_DATABASE_INSTANCE,
+               'Instance Type': pdim.dbInstanceClass,
+               'Database Engine': skuEngine,
+               'Database Edition': skuEngineEdition,
+               'License Model': skuLicenseModel,
+               'Deployment Option': deploymentOptionCondition
+               }
 
-      log.debug("Time to search DB instance compute:[{}]".format(ts.finish('tinyDbSearchComputeFile')))
+      log.debug("Time to search DB instance compute:[{}]".format(ts.finish('priceTableSearchCompute')))
       pricing_records, cost = phelper.calculate_price(consts.SERVICE_RDS, instanceDb, query, pdim.instanceHours, pricing_records, cost)
 
-    #Data Transfer
-    #To internet
-    if pdim.dataTransferOutInternetGb:
-      dataTransferDb = dtdbs[phelper.create_file_key((consts.REGION_MAP[pdim.region], consts.TERM_TYPE_MAP[pdim.termType], consts.PRODUCT_FAMILY_DATA_TRANSFER))]
-      query = ((priceQuery['serviceCode'] == consts.SERVICE_CODE_AWS_DATA_TRANSFER) &
-              (priceQuery['To Location'] == 'External') &
-              (priceQuery['Transfer Type'] == 'AWS Outbound'))
-
-      pricing_records, cost = phelper.calculate_price(consts.SERVICE_DATA_TRANSFER, dataTransferDb, query, pdim.dataTransferOutInternetGb, pricing_records, cost)
-
-
-    #Inter-regional data transfer - to other AWS regions
-    if pdim.dataTransferOutInterRegionGb:
-      dataTransferDb = dtdbs[phelper.create_file_key((consts.REGION_MAP[pdim.region], consts.TERM_TYPE_MAP[pdim.termType], consts.PRODUCT_FAMILY_DATA_TRANSFER))]
-      query = ((priceQuery['serviceCode'] == consts.SERVICE_CODE_AWS_DATA_TRANSFER) &
-              (priceQuery['To Location'] == consts.REGION_MAP[pdim.toRegion]) &
-              (priceQuery['Transfer Type'] == 'InterRegion Outbound'))
-
-      pricing_records, cost = phelper.calculate_price(consts.SERVICE_DATA_TRANSFER, dataTransferDb, query, pdim.dataTransferOutInterRegionGb, pricing_records, cost)
+    #Data Transfer - to internet and to other AWS regions
+    pricing_records, cost = datatransferpricing.calculate_data_transfer(pdim.region, pricing_records, cost,
+                                                   outInternetGb=pdim.dataTransferOutInternetGb,
+                                                   interRegionGb=pdim.dataTransferOutInterRegionGb, toRegion=pdim.toRegion)
 
     #Storage (magnetic, SSD, PIOPS)
     if pdim.storageGbMonth:
       engineCondition = 'Any'
       if skuEngine == consts.RDS_DB_ENGINE_SQL_SERVER: engineCondition = consts.RDS_DB_ENGINE_SQL_SERVER
-      storageDb = dbs[phelper.create_file_key([consts.REGION_MAP[pdim.region], consts.TERM_TYPE_MAP[pdim.termType], consts.PRODUCT_FAMILY_DB_STORAGE])]
-      query = ((priceQuery['Volume Type'] == pdim.volumeType) &
-               (priceQuery['Database Engine'] == engineCondition) &
-               (priceQuery['Deployment Option'] == pdim.deploymentOption))
+      storageDb = get_db(pdim.region, pdim.termType, consts.PRODUCT_FAMILY_DB_STORAGE)
+      query = {'Volume Type': pdim.volumeType,
+               'Database Engine': engineCondition,
+               'Deployment Option': pdim.deploymentOption}
 
       pricing_records, cost = phelper.calculate_price(consts.SERVICE_RDS, storageDb, query, pdim.storageGbMonth, pricing_records, cost)
 
     #Provisioned IOPS
     if pdim.storageType == consts.SCRIPT_RDS_STORAGE_TYPE_IO1:
-      iopsDb = dbs[phelper.create_file_key([consts.REGION_MAP[pdim.region], consts.TERM_TYPE_MAP[pdim.termType], consts.PRODUCT_FAMILY_DB_PIOPS])]
-      query = ((priceQuery['Deployment Option'] == pdim.deploymentOption))
+      iopsDb = get_db(pdim.region, pdim.termType, consts.PRODUCT_FAMILY_DB_PIOPS)
+      query = {'Deployment Option': pdim.deploymentOption}
       pricing_records, cost = phelper.calculate_price(consts.SERVICE_RDS, iopsDb, query, pdim.iops, pricing_records, cost)
 
     #Consumed IOPS (I/O rate)
     if pdim.ioRequests:
-      sysopsDb = dbs[phelper.create_file_key([consts.REGION_MAP[pdim.region], consts.TERM_TYPE_MAP[pdim.termType], consts.PRODUCT_FAMILY_SYSTEM_OPERATION])]
+      sysopsDb = get_db(pdim.region, pdim.termType, consts.PRODUCT_FAMILY_SYSTEM_OPERATION)
       dbEngineCondition = 'Any'
       if pdim.engine in (consts.RDS_DB_ENGINE_POSTGRESQL, consts.RDS_DB_ENGINE_AURORA_MYSQL):
         dbEngineCondition = pdim.engine
 
-      query = ((priceQuery['Group'] == 'Aurora I/O Operation')&
-               (priceQuery['Database Engine'] == dbEngineCondition)
-               )
+      query = {'Group': 'Aurora I/O Operation',
+               'Database Engine': dbEngineCondition
+               }
       pricing_records, cost = phelper.calculate_price(consts.SERVICE_RDS, sysopsDb, query, pdim.ioRequests, pricing_records, cost)
 
 
     #Snapshot Storage
     if pdim.backupStorageGbMonth:
-      snapshotDb = dbs[phelper.create_file_key([consts.REGION_MAP[pdim.region], consts.TERM_TYPE_MAP[pdim.termType], consts.PRODUCT_FAMILY_SNAPSHOT])]
-      query = ((priceQuery['usageType'] == 'RDS:ChargedBackupUsage'))
+      snapshotDb = get_db(pdim.region, pdim.termType, consts.PRODUCT_FAMILY_SNAPSHOT)
+      query = {'usageType': 'RDS:ChargedBackupUsage'}
       pricing_records, cost = phelper.calculate_price(consts.SERVICE_RDS, snapshotDb, query, pdim.backupStorageGbMonth, pricing_records, cost)
 
 
@@ -144,40 +108,28 @@ def calculate(pdim):
 
   #_/_/_/_/_/ RESERVED PRICING _/_/_/_/_/
   if pdim.termType == consts.SCRIPT_TERM_TYPE_RESERVED:
-    #Load Reserved DBs
-
-    indexArgs = {'offeringClasses':consts.EC2_OFFERING_CLASS_MAP.values(),
-                 'tenancies':[consts.EC2_TENANCY_SHARED], 'purchaseOptions':consts.EC2_PURCHASE_OPTION_MAP.values()}
-
-    dbs = regiondbs.get(consts.SERVICE_RDS+pdim.region+pdim.termType,{})
-    if not dbs:
-        dbs, indexMetadata = phelper.loadDBs(consts.SERVICE_RDS, phelper.get_partition_keys(consts.SERVICE_RDS, pdim.region, consts.SCRIPT_TERM_TYPE_RESERVED, **indexArgs))
-        regiondbs[consts.SERVICE_RDS+pdim.region+pdim.termType]=dbs
-    ts.finish('tinyDbLoadReserved')
-    log.debug("Time to load Reserved DB files: [{}]".format(ts.elapsed('tinyDbLoadReserved')))
-    log.debug("regiondbs keys:[{}]".format(regiondbs))
-
     #DB Instance
     #RDS only supports standard
-    instanceDb = dbs[phelper.create_file_key((consts.REGION_MAP[pdim.region], consts.TERM_TYPE_MAP[pdim.termType],
-                                             consts.PRODUCT_FAMILY_DATABASE_INSTANCE, consts.EC2_OFFERING_CLASS_STANDARD,
-                                             consts.EC2_TENANCY_SHARED, consts.EC2_PURCHASE_OPTION_MAP[pdim.offeringType]))]
-
-
-    ts.start('tinyDbSearchComputeFileReserved')
-    query = ((priceQuery['Product Family'] == consts.PRODUCT_FAMILY_DATABASE_INSTANCE) &
-            (priceQuery['Instance Type'] == pdim.dbInstanceClass) &
-            (priceQuery['Database Engine'] == skuEngine) &
-            (priceQuery['Database Edition'] == skuEngineEdition) &
-            (priceQuery['License Model'] == skuLicenseModel) &
-            (priceQuery['Deployment Option'] == deploymentOptionCondition) &
-            (priceQuery['OfferingClass'] == consts.EC2_OFFERING_CLASS_MAP[pdim.offeringClass]) &
-            (priceQuery['PurchaseOption'] == consts.EC2_PURCHASE_OPTION_MAP[pdim.offeringType]) &
-            (priceQuery['LeaseContractLength'] == consts.EC2_RESERVED_YEAR_MAP["{}".format(pdim.years)])
-            )
-
-    hrsQuery = query & (priceQuery['Unit'] == 'Hrs' )
-    qtyQuery = query & (priceQuery['Unit'] == 'Quantity' )
+    instanceDb = get_db(pdim.region, pdim.termType, consts.PRODUCT_FAMILY_DATABASE_INSTANCE, consts.EC2_OFFERING_CLASS_STANDARD,
+                        consts.EC2_TENANCY_SHARED, consts.EC2_PURCHASE_OPTION_MAP[pdim.offeringType])
+    ts.finish('priceTableLoadReserved')
+    log.debug("Time to load Reserved price tables: [{}]".format(ts.elapsed('priceTableLoadReserved')))
+
+
+    ts.start('priceTableSearchComputeReserved')
+    query = {'Product Family': consts.PRODUCT_FAMILY_DATABASE_INSTANCE,
+             'Instance Type': pdim.dbInstanceClass,
+             'Database Engine': skuEngine,
+             'Database Edition': skuEngineEdition,
+             'License Model': skuLicenseModel,
+             'Deployment Option': deploymentOptionCondition,
+             'OfferingClass': consts.EC2_OFFERING_CLASS_MAP[pdim.offeringClass],
+             'PurchaseOption': consts.EC2_PURCHASE_OPTION_MAP[pdim.offeringType],
+             'LeaseContractLength': consts.EC2_RESERVED_YEAR_MAP["{}".format(pdim.years)]
+             }
+
+    hrsQuery = dict(query, Unit='Hrs')
+    qtyQuery = dict(query, Unit='Quantity')
 
     #TODO: use RDS-specific constants, not EC2 constants
     if pdim.offeringType in (consts.SCRIPT_EC2_PURCHASE_OPTION_ALL_UPFRONT, consts.SCRIPT_EC2_PURCHASE_OPTION_PARTIAL_UPFRONT):
@@ -187,7 +139,7 @@ def calculate(pdim):
       reservedInstanceHours = utils.calculate_instance_hours_year(pdim.instanceCount, pdim.years)
       pricing_records, cost = phelper.calculate_price(consts.SERVICE_RDS, instanceDb, hrsQuery, reservedInstanceHours, pricing_records, cost)
 
-    log.debug("Time to search DB instance compute:[{}]".format(ts.finish('tinyDbSearchComputeFileReserved')))
+    log.debug("Time to search DB instance compute:[{}]".format(ts.finish('priceTableSearchComputeReserved')))
 
 
 
@@ -196,5 +148,18 @@ def calculate(pdim):
   log.debug("Total time to calculate price: [{}]".format(ts.finish('totalCalculation')))
   extraargs = {'priceDimensions':pdim}
   pricing_result = PricingResult(awsPriceListApiVersion, pdim.region, cost, pricing_records, **extraargs)
-  log.debug(json.dumps(vars(pricing_result),sort_keys=False,indent=4))
+  if log.isEnabledFor(logging.DEBUG): log.debug(json.dumps(vars(pricing_result),sort_keys=False,indent=4))
   return pricing_result.__dict__
+
+
+
+#Returns the price table for an RDS partition. Only the partition that is needed is loaded (i.e. Database Storage)
+#and it's kept in the shared partition cache, so subsequent calculations don't load it again.
+def get_db(region, termType, productFamily, *reservedDimensions):
+  return phelper.loadDB(consts.SERVICE_RDS, (consts.REGION_MAP[region], consts.TERM_TYPE_MAP[termType], productFamily) + reservedDimensions)
+
+
+
+#Calculates prices for a list of price dimensions - see phelper.calculate_batch
+def calculate_batch(pdims, columnar=False):
+  return phelper.calculate_batch(calculate, pdims, columnar)
@@ -4,7 +4,10 @@ import json
 import logging,traceback
 import math
 import os
+import random
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 
 import boto3
@@ -49,6 +52,22 @@ METRIC_DELAY = 10
 #Note: make sure this is at least 5, unless you have detailed metrics enabled in CloudWatch
 METRIC_WINDOW = 5
 
+#Maximum number of concurrent calls to AWS APIs when collecting resource details and metrics
+COLLECTION_MAX_WORKERS = int(os.environ.get('COLLECTION_MAX_WORKERS', 16))
+
+#Maximum number of values for a tag key in a single Resource Groups Tagging API call
+MAX_TAG_FILTER_VALUES = 20
+
+#Maximum number of metrics that can be requested in a single GetMetricData call
+MAX_METRIC_DATA_QUERIES = 500
+
+#Maximum number of datapoints that can be published in a single PutMetricData call
+MAX_PUT_METRIC_DATA = 1000
+#Retries for PutMetricData calls that are throttled, with exponential backoff starting at PUT_METRIC_DATA_RETRY_DELAY seconds
+PUT_METRIC_DATA_MAX_RETRIES = 5
+PUT_METRIC_DATA_RETRY_DELAY = 0.5
+THROTTLING_ERROR_CODES = ('Throttling', 'ThrottlingException', 'RequestLimitExceeded')
+
 FORECAST_PERIOD_MONTHLY = 'monthly'
 FORECAST_PERIOD_HOURLY = 'hourly'
 DEFAULT_FORECAST_PERIOD = FORECAST_PERIOD_MONTHLY
@@ -67,9 +86,22 @@ CW_METRIC_DIMENSION_SERVICE_NAME_LAMBDA = 'lambda'
 CW_METRIC_DIMENSION_SERVICE_NAME_DYNAMODB = 'dynamodb'
 CW_METRIC_DIMENSION_SERVICE_NAME_KINESIS = 'kinesis'
 CW_METRIC_DIMENSION_SERVICE_NAME_TOTAL = 'total'
+CW_METRIC_DIMENSION_SERVICE_NAMES = (CW_METRIC_DIMENSION_SERVICE_NAME_EC2, CW_METRIC_DIMENSION_SERVICE_NAME_RDS,
+                                    CW_METRIC_DIMENSION_SERVICE_NAME_LAMBDA, CW_METRIC_DIMENSION_SERVICE_NAME_DYNAMODB,
+                                    CW_METRIC_DIMENSION_SERVICE_NAME_KINESIS)
 CW_METRIC_DIMENSION_CURRENCY_USD = 'USD'
 
 
+#CloudWatch metrics used to calculate usage - (namespace, metric name, dimension name, statistic)
+METRIC_EC2_NETWORK_IN = ('AWS/EC2', 'NetworkIn', 'InstanceId', 'Sum')
+METRIC_EC2_NETWORK_OUT = ('AWS/EC2', 'NetworkOut', 'InstanceId', 'Sum')
+METRIC_ALB_CONSUMED_LCUS = ('AWS/ApplicationELB', 'ConsumedLCUs', 'LoadBalancer', 'Sum')
+METRIC_LAMBDA_INVOCATIONS = ('AWS/Lambda', 'Invocations', 'FunctionName', 'Sum')
+METRIC_LAMBDA_DURATION = ('AWS/Lambda', 'Duration', 'FunctionName', 'Average')
+METRIC_KINESIS_INCOMING_RECORDS = ('AWS/Kinesis', 'IncomingRecords', 'StreamName', 'Sum')
+METRIC_KINESIS_INCOMING_BYTES = ('AWS/Kinesis', 'IncomingBytes', 'StreamName', 'Average')
+
+
 SERVICE_EC2 = 'ec2'
 SERVICE_RDS = 'rds'
 SERVICE_ELB = 'elasticloadbalancing'
@@ -104,290 +136,376 @@ def handler(event, context):
     log.setLevel(consts.LOG_LEVEL)
     log.info("Received event {}".format(json.dumps(event)))
 
+    result = {}
     try:
         init_clients(context)
 
-        result = {}
-        pricing_records = []
-        ec2Cost = 0
-        rdsCost = 0
-        lambdaCost = 0
-        ddbCost = 0
-        kinesisCost = 0
-        totalCost = 0
+        #First, get the tags we'll be searching for, from the CloudWatch scheduled event.
+        #Events can have a single tag {"tag":{"key":..,"value":..}} or a list of tags {"tags":[{"key":..,"value":..}, ...]}
+        tags = get_event_tags(event)
+        if not tags:
+            log.error("No tags specified, aborting function!")
+            return {}
 
+        #Resources for all tags are found and their details and metrics are collected once. Costs are then calculated for each tag.
+        resource_manager = ResourceManager(tags)
 
-        #First, get the tags we'll be searching for, from the CloudWatch scheduled event
-        tagkey = ""
-        tagvalue = ""
-        if 'tag' in event:
-          tagkey = event['tag']['key']
-          tagvalue = event['tag']['value']
-          if tagkey == "" or tagvalue == "":
-              log.error("No tags specified, aborting function!")
-              return {}
+        start, end = calculate_time_range()
 
-          log.info("Will search resources with the following tag:["+tagkey+"] - value["+tagvalue+"]")
+        #All AWS API calls are made in the collection stage. Calculations in the pricing stage don't call any AWS APIs.
+        usage = collect_usage(resource_manager, tags, start, end)
 
-        resource_manager = ResourceManager(tagkey, tagvalue)
+        emitter = MetricEmitter()
+        tagresults = []
+        for tagkey, tagvalue in tags:
+            tagresult = {}
+            pricing_records, costs = calculate_costs(get_tag_usage(usage, resource_manager, (tagkey, tagvalue)))
 
-        start, end = calculate_time_range()
+            #Do this after all calculations for all supported services have concluded
+            totalCost = sum(costs.values())
+            tagresult['pricingRecords'] = pricing_records
+            tagresult['totalCost'] = round(totalCost,2)
+            tagresult['forecastPeriod']=DEFAULT_FORECAST_PERIOD
+            tagresult['currency'] = CW_METRIC_DIMENSION_CURRENCY_USD
 
-        elb_hours = 0
-        elb_data_processed_gb = 0
-        elb_instances = {}
-        alb_hours = 0
-        alb_lcus = 0
-
-        #Get tagged ELB(s) and their registered instances
-        #taggedelbs = find_elbs(tagkey, tagvalue)
-        taggedelbs = resource_manager.get_resource_ids(SERVICE_ELB, RESOURCE_ELB)
-        taggedalbs = resource_manager.get_resource_ids(SERVICE_ELB, RESOURCE_ALB)
-        taggednlbs = resource_manager.get_resource_ids(SERVICE_ELB, RESOURCE_NLB)
-        if taggedelbs:
-            log.info("Found tagged Classic ELBs:{}".format(taggedelbs))
-            elb_instances = get_elb_instances(taggedelbs)#TODO:add support to find registered instances for ALB and NLB
-            #Get all EC2 instances registered with each tagged ELB, so we can calculate ELB data processed
-            #Registered instances will be used for data processed calculation, and not for instance hours, unless they're tagged.
-        if taggedalbs:
-            log.info("Found tagged Application Load Balancers:{}".format(taggedalbs))
-        if taggednlbs:
-            log.info("Found tagged Network Load Balancers:{}".format(taggednlbs))
-
-        #TODO: once pricing for ALB and NLB is added to awspricecalculator, separate hours by ELB type
-        elb_hours += (len(taggedelbs)+len(taggednlbs))*HOURS_DICT[DEFAULT_FORECAST_PERIOD]
-        alb_hours += len(taggedalbs)*HOURS_DICT[DEFAULT_FORECAST_PERIOD]
-
-
-        if elb_instances:
-            try:
-                log.info("Found registered EC2 instances to tagged ELBs [{}]:{}".format(taggedelbs, elb_instances.keys()))
-                elb_data_processed_gb = calculate_elb_data_processed(start, end, elb_instances)*calculate_forecast_factor() / (10**9)
-            except Exception as failure:
-                log.error('Error calculating costs for tagged ELBs: %s', failure)
-        else:
-          log.info("Didn't find any EC2 instances registered to tagged ELBs [{}]".format(taggedelbs))
-        #else:
-        #    log.info("No tagged ELBs found")
-
-        #Get tagged EC2 instances
-        ec2_instances = get_ec2_instances_by_tag(tagkey, tagvalue)
-        if ec2_instances:
-            log.info("Tagged EC2 instances:{}".format(ec2_instances.keys()))
-        else:
-            log.info("Didn't find any tagged, running EC2 instances")
-
-        #Calculate Classic ELB cost
-        if elb_hours:
-            elb_cost = ec2pricing.calculate(data.Ec2PriceDimension(region=region, elbHours=elb_hours,elbDataProcessedGb=elb_data_processed_gb))
-            if 'pricingRecords' in elb_cost:
-                pricing_records.extend(elb_cost['pricingRecords'])
-                ec2Cost = ec2Cost + elb_cost['totalCost']
-
-        #Calculate Application Load Balancer cost
-        if alb_hours:
-            alb_lcus = calculate_alb_lcus(start, end, taggedalbs)*calculate_forecast_factor()
-            alb_cost = ec2pricing.calculate(data.Ec2PriceDimension(region=region, albHours=alb_hours, albLcus=alb_lcus))
-            if 'pricingRecords' in alb_cost:
-                pricing_records.extend(alb_cost['pricingRecords'])
-                ec2Cost = ec2Cost + alb_cost['totalCost']
-
-
-
-        #Calculate EC2 compute time for ALL instance types found (subscribed to ELB or not) - group by instance types
-        all_instance_dict = {}
-        all_instance_dict.update(ec2_instances)
-        all_instance_types = get_instance_type_count(all_instance_dict)
-        log.info("All instance types:{}".format(all_instance_types))
-
-        #Calculate EC2 compute time cost
-        #TODO: add support for all available OS
-        for instance_type in all_instance_types:
-            try:
-                ec2_compute_cost = ec2pricing.calculate(data.Ec2PriceDimension(region=region, instanceType=instance_type, instanceHours=all_instance_types[instance_type]*HOURS_DICT[DEFAULT_FORECAST_PERIOD]))
-                if 'pricingRecords' in ec2_compute_cost: pricing_records.extend(ec2_compute_cost['pricingRecords'])
-                ec2Cost = ec2Cost + ec2_compute_cost['totalCost']
-            except Exception as failure:
-                log.error('Error processing %s: %s', instance_type, failure)
-
-        #Get provisioned storage by volume type, and provisioned IOPS (if applicable)
-        ebs_storage_dict, piops = get_storage_by_ebs_type(all_instance_dict)
-
-        #Calculate EBS storagecost
-        for k in ebs_storage_dict.keys():
-            if k == 'io1': pricing_piops = piops
-            else: pricing_piops = 0
-            try:
-                ebs_storage_cost = ec2pricing.calculate(data.Ec2PriceDimension(region=region, ebsVolumeType=k, ebsStorageGbMonth=ebs_storage_dict[k], pIops=pricing_piops))
-                if 'pricingRecords' in ebs_storage_cost: pricing_records.extend(ebs_storage_cost['pricingRecords'])
-                ec2Cost = ec2Cost + ebs_storage_cost['totalCost']
-            except Exception as failure:
-                log.error('Error processing ebs storage costs: %s', failure)
-
-
-        #Get tagged RDS DB instances
-        #db_instances = get_db_instances_by_tag(tagkey, tagvalue)
-        db_instances = get_db_instances_by_tag(resource_manager.get_resource_ids(SERVICE_RDS, RESOURCE_RDS_DB_INSTANCE))
-        if db_instances:
-            log.info("Found the following tagged DB instances:{}".format(db_instances.keys()))
-        else:
-            log.info("Didn't find any tagged RDS DB instances")
+            #Publish metrics to CloudWatch using the default namespace
 
-        #Calculate RDS instance time for ALL instance types found - group by DB instance types
-        all_db_instance_dict = {}
-        all_db_instance_dict.update(db_instances)
-        all_db_instance_types = get_db_instance_type_count(all_db_instance_dict)
-        all_db_storage_types = get_db_storage_type_count(all_db_instance_dict)
+            if tagkey:
+              for service in CW_METRIC_DIMENSION_SERVICE_NAMES:
+                emitter.add(get_cw_metric_datum(end, costs[service], service, tagkey, tagvalue))
+              emitter.add(get_cw_metric_datum(end, totalCost, CW_METRIC_DIMENSION_SERVICE_NAME_TOTAL, tagkey, tagvalue))
 
-        #TODO: add support for read replicas
+            log.info("Estimated monthly cost for resources tagged with key={},value={} : [{}]".format(tagkey, tagvalue, json.dumps(tagresult,sort_keys=False,indent=4)))
+            tagresults.append(tagresult)
 
-        #Calculate RDS instance time cost
-        rds_instance_cost = {}
-        for db_instance_type in all_db_instance_types:
-            try:
-                dbInstanceClass = db_instance_type.split("|")[0]
-                engine = db_instance_type.split("|")[1]
-                licenseModel= db_instance_type.split("|")[2]
-                multiAz= bool(int(db_instance_type.split("|")[3]))
-                log.info("Calculating RDS DB Instance compute time")
-                rds_instance_cost = rdspricing.calculate(data.RdsPriceDimension(region=region, dbInstanceClass=dbInstanceClass, multiAz=multiAz,
-                                                engine=engine, licenseModel=licenseModel, instanceHours=all_db_instance_types[db_instance_type]*HOURS_DICT[DEFAULT_FORECAST_PERIOD]))
-
-                if 'pricingRecords' in rds_instance_cost: pricing_records.extend(rds_instance_cost['pricingRecords'])
-                rdsCost = rdsCost + rds_instance_cost['totalCost']
-            except Exception as failure:
-                log.error('Error processing RDS instance time costs: %s', failure)
-
-        #Calculate RDS storage cost
-        #TODO: add support for Aurora operations
-        rds_storage_cost = {}
-        for storage_key in all_db_storage_types.keys():
-            try:
-                storageType = storage_key.split("|")[0]
-                multiAz = bool(int(storage_key.split("|")[1]))
-                storageGbMonth = all_db_storage_types[storage_key]['AllocatedStorage']
-                iops = all_db_storage_types[storage_key]['Iops']
-                log.info("Calculating RDS DB Instance Storage")
-                rds_storage_cost = rdspricing.calculate(data.RdsPriceDimension(region=region, storageType=storageType,
-                                                                                multiAz=multiAz, storageGbMonth=storageGbMonth,
-                                                                                iops=iops))
-
-                if 'pricingRecords' in rds_storage_cost: pricing_records.extend(rds_storage_cost['pricingRecords'])
-                rdsCost = rdsCost + rds_storage_cost['totalCost']
-            except Exception as failure:
-                log.error('Error processing RDS storage costs: %s', failure)
-
-        #RDS Data Transfer - the Lambda function will assume all data transfer happens between RDS and EC2 instances
+        emitter.flush()
 
-        #Lambda functions
-        #TODO: add support for lambda function qualifiers
-        #TODO: calculate data ingested into CloudWatch Logs
-        lambdafunctions = resource_manager.get_resources(SERVICE_LAMBDA, RESOURCE_LAMBDA_FUNCTION)
-        for func in lambdafunctions:
-          executions = calculate_lambda_executions(start, end, func)
-          avgduration = calculate_lambda_duration(start, end, func)
-          funcname = ''
-          qualifier = ''
-          fullname = ''
-          funcname = func.id
-          fullname = funcname
-          #if 'qualifier' in func:
-          #    qualifier = func['qualifier']
-          #    fullname += ":"+qualifier
-          memory = get_lambda_memory(funcname,qualifier)
-          log.info("Executions for Lambda function [{}]: [{}] - Memory:[{}] - Avg Duration:[{}]".format(funcname,executions,memory, avgduration))
-          if executions and avgduration:
-              try:
-                  #Note we're setting data transfer = 0, since we don't have a way to calculate it based on CW metrics alone
-                  #TODO:call a single time and include a GB-s price dimension to the Lambda calculator
-                  lambdapdim = data.LambdaPriceDimension(region=region, requestCount=executions*calculate_forecast_factor(),
-                                                    avgDurationMs=avgduration, memoryMb=memory, dataTranferOutInternetGb=0,
-                                                    dataTranferOutIntraRegionGb=0, dataTranferOutInterRegionGb=0, toRegion='')
-                  lambda_func_cost = lambdapricing.calculate(lambdapdim)
-                  if 'pricingRecords' in lambda_func_cost: pricing_records.extend(lambda_func_cost['pricingRecords'])
-                  lambdaCost = lambdaCost + lambda_func_cost['totalCost']
-
-              except Exception as failure:
-                  log.error('Error processing Lambda costs: %s', failure)
-          else:
-              log.info("Skipping pricing calculation for function [{}] - qualifier [{}] due to lack of executions in [{}-minute] time window".format(fullname, qualifier, METRIC_WINDOW))
+        if 'tags' in event:
+            for (tagkey, tagvalue), tagresult in zip(tags, tagresults): tagresult['tag'] = {'key':tagkey, 'value':tagvalue}
+            result['tags'] = tagresults
+        else:
+            result = tagresults[0]
 
+    except NoDataFoundError as ndf:
+        log.error ("NoDataFoundError [{}]".format(ndf))
 
-        #DynamoDB
-        totalRead = 0
-        totalWrite = 0
-        ddbtables = resource_manager.get_resources(SERVICE_DYNAMODB, RESOURCE_DDB_TABLE)
-        #Provisioned Capacity Units
-        for t in ddbtables:
-            read, write = get_ddb_capacity_units(t.id)
-            log.info("Dynamo DB Provisioned Capacity Units - Table:{} Read:{} Write:{}".format(t.id, read, write))
-            totalRead += read
-            totalWrite += write
-        #TODO: add support for storage
-        if totalRead and totalWrite:
-            ddbpdim = data.DynamoDBPriceDimension(region=region, readCapacityUnitHours=totalRead*HOURS_DICT[FORECAST_PERIOD_MONTHLY],
-                                                                 writeCapacityUnitHours=totalWrite*HOURS_DICT[FORECAST_PERIOD_MONTHLY])
-            ddbtable_cost = ddbpricing.calculate(ddbpdim)
-            if 'pricingRecords' in ddbtable_cost: pricing_records.extend(ddbtable_cost['pricingRecords'])
-            ddbCost = ddbCost + ddbtable_cost['totalCost']
+    except Exception as e:
+        traceback.print_exc()
+        log.error("Exception message:["+str(e)+"]")
 
 
-        #Kinesis Streams
-        streams = resource_manager.get_resources(SERVICE_KINESIS, RESOURCE_STREAM)
-        totalShards = 0
-        totalExtendedRetentionCount = 0
-        totalPutPayloadUnits = 0
-        for s in streams:
-            log.info("Stream:[{}]".format(s.id))
-            tmpShardCount, tmpExtendedRetentionCount = get_kinesis_stream_shards(s.id)
-            totalShards += tmpShardCount
-            totalExtendedRetentionCount += tmpExtendedRetentionCount
+    return result
 
-            totalPutPayloadUnits += calculate_kinesis_put_payload_units(start, end, s.id)
 
-        if totalShards:
-            kinesispdim = data.KinesisPriceDimension(region=region,
-                                                     shardHours=totalShards*HOURS_DICT[FORECAST_PERIOD_MONTHLY],
-                                                     extendedDataRetentionHours=totalExtendedRetentionCount*HOURS_DICT[FORECAST_PERIOD_MONTHLY],
-                                                     putPayloadUnits=totalPutPayloadUnits*calculate_forecast_factor())
-            stream_cost = kinesispricing.calculate(kinesispdim)
-            if 'pricingRecords' in stream_cost: pricing_records.extend(stream_cost['pricingRecords'])
+#Returns a list of (tag key, tag value) tuples, or an empty list if any of the tags in the event is empty
+def get_event_tags(event):
+    result = []
+    eventtags = event.get('tags', [])
+    if 'tag' in event: eventtags = [event['tag']]
+    for t in eventtags:
+        if t['key'] == "" or t['value'] == "": return []
+        if (t['key'], t['value']) not in result: result.append((t['key'], t['value']))
+        log.info("Will search resources with the following tag:["+t['key']+"] - value["+t['value']+"]")
+    #Events without tags search resources without a tag filter
+    if not eventtags: result.append(("", ""))
+    return result
 
-            kinesisCost = kinesisCost + stream_cost['totalCost']
 
+"""
+Collection stage: gets the details and CloudWatch metrics of all tagged resources, which are needed to calculate
+their cost. Calls to AWS APIs are independent of each other, therefore they're made concurrently in a pool of threads
+(boto3 clients can be shared by multiple threads). Calls that need the result of a previous call (i.e. metrics for
+the instances registered to an ELB) are submitted to the pool as soon as that result is available.
+Metrics for all resources are requested together, in as few GetMetricData calls as possible (see MetricCollector).
+Details are collected once for the resources of all tags and returned by resource, so they can be assigned to
+each tag by get_tag_usage.
+"""
+def collect_usage(resource_manager, tags, start, end):
+    usage = {}
+
+    #Get tagged ELB(s) and their registered instances
+    taggedelbs = resource_manager.get_resource_ids(SERVICE_ELB, RESOURCE_ELB)
+    taggedalbs = resource_manager.get_resource_ids(SERVICE_ELB, RESOURCE_ALB)
+    taggednlbs = resource_manager.get_resource_ids(SERVICE_ELB, RESOURCE_NLB)
+    if taggedelbs:
+        log.info("Found tagged Classic ELBs:{}".format(taggedelbs))
+    if taggedalbs:
+        log.info("Found tagged Application Load Balancers:{}".format(taggedalbs))
+    if taggednlbs:
+        log.info("Found tagged Network Load Balancers:{}".format(taggednlbs))
+
+    with ThreadPoolExecutor(max_workers=COLLECTION_MAX_WORKERS) as executor:
+        #Get all EC2 instances registered with each tagged ELB, so we can calculate ELB data processed
+        #Registered instances will be used for data processed calculation, and not for instance hours, unless they're tagged.
+        elbInstancesFuture = executor.submit(get_elb_instances, taggedelbs) if taggedelbs else None#TODO:add support to find registered instances for ALB and NLB
+        ec2InstancesFuture = executor.submit(get_ec2_instances_by_tag, tags)
+        dbInstancesFuture = executor.submit(get_db_instances_by_tag, resource_manager.get_resource_ids(SERVICE_RDS, RESOURCE_RDS_DB_INSTANCE))
+
+        metrics = MetricCollector(start, end)
+        for a in taggedalbs: metrics.add(METRIC_ALB_CONSUMED_LCUS, "app/{}".format(a))
 
+        #Lambda functions
+        #TODO: add support for lambda function qualifiers
+        #TODO: calculate data ingested into CloudWatch Logs
+        lambdaFutures = {}
+        for func in resource_manager.get_resources(SERVICE_LAMBDA, RESOURCE_LAMBDA_FUNCTION):
+            metrics.add(METRIC_LAMBDA_INVOCATIONS, func.id)
+            metrics.add(METRIC_LAMBDA_DURATION, func.id)
+            lambdaFutures[func.id] = executor.submit(get_lambda_memory, func.id, '')
 
+        #DynamoDB
+        ddbFutures = {t.id:executor.submit(get_ddb_capacity_units, t.id)
+                      for t in resource_manager.get_resources(SERVICE_DYNAMODB, RESOURCE_DDB_TABLE)}
 
-        #Do this after all calculations for all supported services have concluded
-        totalCost = ec2Cost + rdsCost + lambdaCost + ddbCost + kinesisCost
-        result['pricingRecords'] = pricing_records
-        result['totalCost'] = round(totalCost,2)
-        result['forecastPeriod']=DEFAULT_FORECAST_PERIOD
-        result['currency'] = CW_METRIC_DIMENSION_CURRENCY_USD
+        #Kinesis Streams
+        kinesisFutures = {}
+        for s in resource_manager.get_resources(SERVICE_KINESIS, RESOURCE_STREAM):
+            metrics.add(METRIC_KINESIS_INCOMING_RECORDS, s.id)
+            metrics.add(METRIC_KINESIS_INCOMING_BYTES, s.id)
+            kinesisFutures[s.id] = executor.submit(get_kinesis_stream_shards, s.id)
 
-        #Publish metrics to CloudWatch using the default namespace
+        #Get tagged EC2 instances and their EBS volumes
+        usage['ec2Instances'] = ec2InstancesFuture.result()
+        ebsVolumesFuture = executor.submit(get_ebs_volumes, usage['ec2Instances'])
 
-        if tagkey:
-          put_cw_metric_data(end, ec2Cost, CW_METRIC_DIMENSION_SERVICE_NAME_EC2, tagkey, tagvalue)
-          put_cw_metric_data(end, rdsCost, CW_METRIC_DIMENSION_SERVICE_NAME_RDS, tagkey, tagvalue)
-          put_cw_metric_data(end, lambdaCost, CW_METRIC_DIMENSION_SERVICE_NAME_LAMBDA, tagkey, tagvalue)
-          put_cw_metric_data(end, ddbCost, CW_METRIC_DIMENSION_SERVICE_NAME_DYNAMODB, tagkey, tagvalue)
-          put_cw_metric_data(end, kinesisCost, CW_METRIC_DIMENSION_SERVICE_NAME_KINESIS, tagkey, tagvalue)
-          put_cw_metric_data(end, totalCost, CW_METRIC_DIMENSION_SERVICE_NAME_TOTAL, tagkey, tagvalue)
+        usage['elbInstances'] = elbInstancesFuture.result() if elbInstancesFuture else {}
+        for instances in usage['elbInstances'].values():
+            for instance_id in instances.keys():
+                metrics.add(METRIC_EC2_NETWORK_IN, instance_id)
+                metrics.add(METRIC_EC2_NETWORK_OUT, instance_id)
 
+        metrics.collect(executor)
+        usage['metrics'] = metrics
 
+        usage['ebsVolumes'] = ebsVolumesFuture.result()
+        usage['dbInstances'] = dbInstancesFuture.result()
+        usage['lambdaMemory'] = {f:future.result() for f, future in lambdaFutures.items()}
+        usage['ddbCapacityUnits'] = {t:future.result() for t, future in ddbFutures.items()}
+        usage['kinesisShards'] = {s:future.result() for s, future in kinesisFutures.items()}
 
-        log.info("Estimated monthly cost for resources tagged with key={},value={} : [{}]".format(tagkey, tagvalue, json.dumps(result,sort_keys=False,indent=4)))
+    return usage
 
-    except NoDataFoundError as ndf:
-        log.error ("NoDataFoundError [{}]".format(ndf))
 
-    except Exception as e:
-        traceback.print_exc()
-        log.error("Exception message:["+str(e)+"]")
+"""
+Returns the usage of the resources with a tag, from the details collected for all tags by collect_usage.
+Resources with more than one of the tags are included in the usage of each of them.
+"""
+def get_tag_usage(usage, resource_manager, tag):
+    tagusage = {'elbDataProcessedGb':0, 'albLcus':0}
+    tagkey, tagvalue = tag
+
+    taggedelbs = resource_manager.get_resource_ids(SERVICE_ELB, RESOURCE_ELB, tag)
+    taggedalbs = resource_manager.get_resource_ids(SERVICE_ELB, RESOURCE_ALB, tag)
+    taggednlbs = resource_manager.get_resource_ids(SERVICE_ELB, RESOURCE_NLB, tag)
+
+    #TODO: once pricing for ALB and NLB is added to awspricecalculator, separate hours by ELB type
+    tagusage['elbHours'] = (len(taggedelbs)+len(taggednlbs))*HOURS_DICT[DEFAULT_FORECAST_PERIOD]
+    tagusage['albHours'] = len(taggedalbs)*HOURS_DICT[DEFAULT_FORECAST_PERIOD]
+
+    metrics = usage['metrics']
+    elb_instances = {}
+    for elbname in taggedelbs: elb_instances.update(usage['elbInstances'].get(elbname, {}))
+    if elb_instances:
+        try:
+            log.info("Found registered EC2 instances to tagged ELBs [{}]:{}".format(taggedelbs, elb_instances.keys()))
+            tagusage['elbDataProcessedGb'] = calculate_elb_data_processed(metrics, elb_instances)*calculate_forecast_factor() / (10**9)
+        except Exception as failure:
+            log.error('Error calculating costs for tagged ELBs: %s', failure)
+    else:
+      log.info("Didn't find any EC2 instances registered to tagged ELBs [{}]".format(taggedelbs))
+
+    if taggedalbs: tagusage['albLcus'] = calculate_alb_lcus(metrics, taggedalbs)*calculate_forecast_factor()
+
+    #Get tagged EC2 instances
+    ec2_instances = {}
+    for i in usage['ec2Instances'].values():
+        if tagkey == "" or {'Key':tagkey, 'Value':tagvalue} in i.get('Tags', []): ec2_instances[i['InstanceId']] = i
+    if ec2_instances:
+        log.info("Tagged EC2 instances:{}".format(ec2_instances.keys()))
+    else:
+        log.info("Didn't find any tagged, running EC2 instances")
+
+    #Calculate EC2 compute time for ALL instance types found (subscribed to ELB or not) - group by instance types
+    tagusage['ec2InstanceTypes'] = get_instance_type_count(ec2_instances)
+    log.info("All instance types:{}".format(tagusage['ec2InstanceTypes']))
+
+    #Get provisioned storage by volume type, and provisioned IOPS (if applicable)
+    tagusage['ebsStorage'], tagusage['piops'] = get_storage_by_ebs_type(ec2_instances, usage['ebsVolumes'])
+
+    #Get tagged RDS DB instances
+    dbIds = resource_manager.get_resource_ids(SERVICE_RDS, RESOURCE_RDS_DB_INSTANCE, tag)
+    db_instances = {k:d for k, d in usage['dbInstances'].items() if d['DBInstanceIdentifier'] in dbIds}
+    if db_instances:
+        log.info("Found the following tagged DB instances:{}".format(db_instances.keys()))
+    else:
+        log.info("Didn't find any tagged RDS DB instances")
+    tagusage['dbInstanceTypes'] = get_db_instance_type_count(db_instances)
+    tagusage['dbStorageTypes'] = get_db_storage_type_count(db_instances)
+
+    tagusage['lambdaFunctions'] = []
+    for func in resource_manager.get_resources(SERVICE_LAMBDA, RESOURCE_LAMBDA_FUNCTION, tag):
+        tagusage['lambdaFunctions'].append((func.id, calculate_lambda_executions(metrics, func),
+                                            calculate_lambda_duration(metrics, func), usage['lambdaMemory'][func.id]))
+
+    #Provisioned Capacity Units
+    tagusage['ddbCapacityUnits'] = []
+    for t in resource_manager.get_resources(SERVICE_DYNAMODB, RESOURCE_DDB_TABLE, tag):
+        read, write = usage['ddbCapacityUnits'][t.id]
+        log.info("Dynamo DB Provisioned Capacity Units - Table:{} Read:{} Write:{}".format(t.id, read, write))
+        tagusage['ddbCapacityUnits'].append((t.id, read, write))
+
+    tagusage['kinesisStreams'] = []
+    for s in resource_manager.get_resources(SERVICE_KINESIS, RESOURCE_STREAM, tag):
+        log.info("Stream:[{}]".format(s.id))
+        shardCount, extendedRetentionCount = usage['kinesisShards'][s.id]
+        tagusage['kinesisStreams'].append((s.id, shardCount, extendedRetentionCount, calculate_kinesis_put_payload_units(metrics, s.id)))
+
+    return tagusage
 
 
-    return result
+"""
+Pricing stage: calculates the cost of the usage of a tag, returned by get_tag_usage.
+Returns the pricing records and a dict with the total cost for each service (see CW_METRIC_DIMENSION_SERVICE_NAMES).
+"""
+def calculate_costs(usage):
+    pricing_records = []
+    ec2Cost = 0
+    rdsCost = 0
+    lambdaCost = 0
+    ddbCost = 0
+    kinesisCost = 0
+
+    #Calculate Classic ELB cost
+    if usage['elbHours']:
+        elb_cost = ec2pricing.calculate(data.Ec2PriceDimension(region=region, elbHours=usage['elbHours'],elbDataProcessedGb=usage['elbDataProcessedGb']))
+        if 'pricingRecords' in elb_cost:
+            pricing_records.extend(elb_cost['pricingRecords'])
+            ec2Cost = ec2Cost + elb_cost['totalCost']
+
+    #Calculate Application Load Balancer cost
+    if usage['albHours']:
+        alb_cost = ec2pricing.calculate(data.Ec2PriceDimension(region=region, albHours=usage['albHours'], albLcus=usage['albLcus']))
+        if 'pricingRecords' in alb_cost:
+            pricing_records.extend(alb_cost['pricingRecords'])
+            ec2Cost = ec2Cost + alb_cost['totalCost']
+
+    #Calculate EC2 compute time cost
+    #TODO: add support for all available OS
+    all_instance_types = usage['ec2InstanceTypes']
+    for instance_type in all_instance_types:
+        try:
+            ec2_compute_cost = ec2pricing.calculate(data.Ec2PriceDimension(region=region, instanceType=instance_type, instanceHours=all_instance_types[instance_type]*HOURS_DICT[DEFAULT_FORECAST_PERIOD]))
+            if 'pricingRecords' in ec2_compute_cost: pricing_records.extend(ec2_compute_cost['pricingRecords'])
+            ec2Cost = ec2Cost + ec2_compute_cost['totalCost']
+        except Exception as failure:
+            log.error('Error processing %s: %s', instance_type, failure)
+
+    #Calculate EBS storagecost
+    ebs_storage_dict = usage['ebsStorage']
+    for k in ebs_storage_dict.keys():
+        if k == 'io1': pricing_piops = usage['piops']
+        else: pricing_piops = 0
+        try:
+            ebs_storage_cost = ec2pricing.calculate(data.Ec2PriceDimension(region=region, ebsVolumeType=k, ebsStorageGbMonth=ebs_storage_dict[k], pIops=pricing_piops))
+            if 'pricingRecords' in ebs_storage_cost: pricing_records.extend(ebs_storage_cost['pricingRecords'])
+            ec2Cost = ec2Cost + ebs_storage_cost['totalCost']
+        except Exception as failure:
+            log.error('Error processing ebs storage costs: %s', failure)
+
+    #TODO: add support for read replicas
+
+    #Calculate RDS instance time cost
+    all_db_instance_types = usage['dbInstanceTypes']
+    rds_instance_cost = {}
+    for db_instance_type in all_db_instance_types:
+        try:
+            dbInstanceClass = db_instance_type.split("|")[0]
+            engine = db_instance_type.split("|")[1]
+            licenseModel= db_instance_type.split("|")[2]
+            multiAz= bool(int(db_instance_type.split("|")[3]))
+            log.info("Calculating RDS DB Instance compute time")
+            rds_instance_cost = rdspricing.calculate(data.RdsPriceDimension(region=region, dbInstanceClass=dbInstanceClass, multiAz=multiAz,
+                                            engine=engine, licenseModel=licenseModel, instanceHours=all_db_instance_types[db_instance_type]*HOURS_DICT[DEFAULT_FORECAST_PERIOD]))
+
+            if 'pricingRecords' in rds_instance_cost: pricing_records.extend(rds_instance_cost['pricingRecords'])
+            rdsCost = rdsCost + rds_instance_cost['totalCost']
+        except Exception as failure:
+            log.error('Error processing RDS instance time costs: %s', failure)
+
+    #Calculate RDS storage cost
+    #TODO: add support for Aurora operations
+    all_db_storage_types = usage['dbStorageTypes']
+    rds_storage_cost = {}
+    for storage_key in all_db_storage_types.keys():
+        try:
+            storageType = storage_key.split("|")[0]
+            multiAz = bool(int(storage_key.split("|")[1]))
+            storageGbMonth = all_db_storage_types[storage_key]['AllocatedStorage']
+            iops = all_db_storage_types[storage_key]['Iops']
+            log.info("Calculating RDS DB Instance Storage")
+            rds_storage_cost = rdspricing.calculate(data.RdsPriceDimension(region=region, storageType=storageType,
+                                                                            multiAz=multiAz, storageGbMonth=storageGbMonth,
+                                                                            iops=iops))
+
+            if 'pricingRecords' in rds_storage_cost: pricing_records.extend(rds_storage_cost['pricingRecords'])
+            rdsCost = rdsCost + rds_storage_cost['totalCost']
+        except Exception as failure:
+            log.error('Error processing RDS storage costs: %s', failure)
+
+    #RDS Data Transfer - the Lambda function will assume all data transfer happens between RDS and EC2 instances
+
+    #Lambda functions
+    for funcname, executions, avgduration, memory in usage['lambdaFunctions']:
+      qualifier = ''
+      fullname = funcname
+      log.info("Executions for Lambda function [{}]: [{}] - Memory:[{}] - Avg Duration:[{}]".format(funcname,executions,memory, avgduration))
+      if executions and avgduration:
+          try:
+              #Note we're setting data transfer = 0, since we don't have a way to calculate it based on CW metrics alone
+              #TODO:call a single time and include a GB-s price dimension to the Lambda calculator
+              lambdapdim = data.LambdaPriceDimension(region=region, requestCount=executions*calculate_forecast_factor(),
+                                                avgDurationMs=avgduration, memoryMb=memory, dataTranferOutInternetGb=0,
+                                                dataTranferOutIntraRegionGb=0, dataTranferOutInterRegionGb=0, toRegion='')
+              lambda_func_cost = lambdapricing.calculate(lambdapdim)
+              if 'pricingRecords' in lambda_func_cost: pricing_records.extend(lambda_func_cost['pricingRecords'])
+              lambdaCost = lambdaCost + lambda_func_cost['totalCost']
+
+          except Exception as failure:
+              log.error('Error processing Lambda costs: %s', failure)
+      else:
+          log.info("Skipping pricing calculation for function [{}] - qualifier [{}] due to lack of executions in [{}-minute] time window".format(fullname, qualifier, METRIC_WINDOW))
+
+
+    #DynamoDB
+    totalRead = sum(read for t, read, write in usage['ddbCapacityUnits'])
+    totalWrite = sum(write for t, read, write in usage['ddbCapacityUnits'])
+    #TODO: add support for storage
+    if totalRead and totalWrite:
+        ddbpdim = data.DynamoDBPriceDimension(region=region, readCapacityUnitHours=totalRead*HOURS_DICT[FORECAST_PERIOD_MONTHLY],
+                                                             writeCapacityUnitHours=totalWrite*HOURS_DICT[FORECAST_PERIOD_MONTHLY])
+        ddbtable_cost = ddbpricing.calculate(ddbpdim)
+        if 'pricingRecords' in ddbtable_cost: pricing_records.extend(ddbtable_cost['pricingRecords'])
+        ddbCost = ddbCost + ddbtable_cost['totalCost']
+
+
+    #Kinesis Streams
+    totalShards = sum(s[1] for s in usage['kinesisStreams'])
+    totalExtendedRetentionCount = sum(s[2] for s in usage['kinesisStreams'])
+    totalPutPayloadUnits = sum(s[3] for s in usage['kinesisStreams'])
+    if totalShards:
+        kinesispdim = data.KinesisPriceDimension(region=region,
+                                                 shardHours=totalShards*HOURS_DICT[FORECAST_PERIOD_MONTHLY],
+                                                 extendedDataRetentionHours=totalExtendedRetentionCount*HOURS_DICT[FORECAST_PERIOD_MONTHLY],
+                                                 putPayloadUnits=totalPutPayloadUnits*calculate_forecast_factor())
+        stream_cost = kinesispricing.calculate(kinesispdim)
+        if 'pricingRecords' in stream_cost: pricing_records.extend(stream_cost['pricingRecords'])
+
+        kinesisCost = kinesisCost + stream_cost['totalCost']
+
+    costs = {CW_METRIC_DIMENSION_SERVICE_NAME_EC2:ec2Cost, CW_METRIC_DIMENSION_SERVICE_NAME_RDS:rdsCost,
+             CW_METRIC_DIMENSION_SERVICE_NAME_LAMBDA:lambdaCost, CW_METRIC_DIMENSION_SERVICE_NAME_DYNAMODB:ddbCost,
+             CW_METRIC_DIMENSION_SERVICE_NAME_KINESIS:kinesisCost}
+    return pricing_records, costs
 
 #TODO: calculate data transfer for instances that are not registered with the ELB
 #TODO: Support different OS for EC2 instances (see how engine and license combinations are calculated for RDS)
@@ -401,12 +519,8 @@ def handler(event, context):
 #TODO: add support for Spot and Reserved. Function only supports On-demand instances at the time
 
 
-def put_cw_metric_data(timestamp, cost, service, tagkey, tagvalue):
-
-    response = cwclient.put_metric_data(
-        Namespace=CW_NAMESPACE,
-        MetricData=[
-            {
+def get_cw_metric_datum(timestamp, cost, service, tagkey, tagvalue):
+    return {
                 'MetricName': CW_METRIC_NAME_ESTIMATEDCHARGES,
                 'Dimensions': [{'Name': CW_METRIC_DIMENSION_SERVICE_NAME,'Value': service},
                                {'Name': CW_METRIC_DIMENSION_PERIOD,'Value': DEFAULT_FORECAST_PERIOD},
@@ -417,39 +531,37 @@ def put_cw_metric_data(timestamp, cost, service, tagkey, tagvalue):
                 'Value': cost,
                 'Unit': 'Count'
             }
-        ]
-    )
 
 
+#Returns the EC2 instances registered to each ELB - {elb name: {instance id: instance}}
 def get_elb_instances(elbnames):
     result = {}
-    instance_ids = []
-    elbs = elbclient.describe_load_balancers(LoadBalancerNames=elbnames)
-    if 'LoadBalancerDescriptions' in elbs:
-        for e in elbs['LoadBalancerDescriptions']:
-            if 'Instances' in e:
-              instances = e['Instances']
-              for i in instances:
-                  instance_ids.append(i['InstanceId'])
+    instance_ids = {}
+    for e in paginate(elbclient, 'describe_load_balancers', 'LoadBalancerDescriptions', LoadBalancerNames=elbnames):
+        result[e['LoadBalancerName']] = {}
+        if 'Instances' in e:
+          instances = e['Instances']
+          for i in instances:
+              instance_ids.setdefault(i['InstanceId'], []).append(e['LoadBalancerName'])
 
     if instance_ids:
-        response = ec2client.describe_instances(InstanceIds=instance_ids)
-        if 'Reservations' in response:
-            for r in response['Reservations']:
-                if 'Instances' in r:
-                    for i in r['Instances']:
-                        result[i['InstanceId']]=i
+        for r in paginate(ec2client, 'describe_instances', 'Reservations', InstanceIds=list(instance_ids.keys())):
+            if 'Instances' in r:
+                for i in r['Instances']:
+                    for elbname in instance_ids[i['InstanceId']]: result[elbname][i['InstanceId']]=i
 
     return result
 
 
-def get_ec2_instances_by_tag(tagkey, tagvalue):
+#Returns the running EC2 instances with any of the tags. Tags with the same key are searched in a single call.
+def get_ec2_instances_by_tag(tags):
     result = {}
-    response = ec2client.describe_instances(Filters=[{'Name': 'tag:'+tagkey, 'Values':[tagvalue]},
-                                                     {'Name': 'instance-state-name', 'Values': ['running',]}])
-    if 'Reservations' in response:
-        reservations = response['Reservations']
-        for r in reservations:
+    tagvalues = {}
+    for tagkey, tagvalue in tags: tagvalues.setdefault(tagkey, []).append(tagvalue)
+    for tagkey, values in tagvalues.items():
+        for r in paginate(ec2client, 'describe_instances', 'Reservations',
+                          Filters=[{'Name': 'tag:'+tagkey, 'Values':values},
+                                   {'Name': 'instance-state-name', 'Values': ['running',]}]):
             if 'Instances' in r:
                 for i in r['Instances']:
                     result[i['InstanceId']]=i
@@ -460,26 +572,19 @@ def get_ec2_instances_by_tag(tagkey, tagvalue):
 
 def get_db_instances_by_tag(dbIds):
     result = {}
-    #TODO: paginate
     if dbIds:
-        response = rdsclient.describe_db_instances(Filters=[{'Name':'db-instance-id','Values':dbIds}])
-        if 'DBInstances' in response:
-            dbInstances = response['DBInstances']
-            for d in dbInstances:
-                result[d['DbiResourceId']]=d
+        for d in paginate(rdsclient, 'describe_db_instances', 'DBInstances', Filters=[{'Name':'db-instance-id','Values':dbIds}]):
+            result[d['DbiResourceId']]=d
     return result
 
 
 
 def get_non_elb_instances_by_tag(tagkey, tagvalue, elb_instances):
     result = {}
-    response = ec2client.describe_instances(Filters=[{'Name': 'tag:'+tagkey, 'Values':[tagvalue]}])
-    if 'Reservations' in response:
-        reservations = response['Reservations']
-        for r in reservations:
-            if 'Instances' in r:
-                for i in r['Instances']:
-                    if i['InstanceId'] not in elb_instances: result[i['InstanceId']]=i
+    for r in paginate(ec2client, 'describe_instances', 'Reservations', Filters=[{'Name': 'tag:'+tagkey, 'Values':[tagvalue]}]):
+        if 'Instances' in r:
+            for i in r['Instances']:
+                if i['InstanceId'] not in elb_instances: result[i['InstanceId']]=i
 
     return result
 
@@ -539,9 +644,7 @@ def get_db_storage_type_count(db_instance_dict):
 
 
 
-def get_storage_by_ebs_type(instance_dict):
-    result = {}
-    iops = 0
+def get_ebs_volume_ids(instance_dict):
     ebs_ids = []
     for key in instance_dict:
         block_mappings = instance_dict[key]['BlockDeviceMappings']
@@ -549,27 +652,39 @@ def get_storage_by_ebs_type(instance_dict):
             if 'Ebs' in bm:
                 if 'VolumeId' in bm['Ebs']:
                     ebs_ids.append(bm['Ebs']['VolumeId'])
+    return ebs_ids
+
 
-    volume_details = {}
-    if ebs_ids: volume_details = ec2client.describe_volumes(VolumeIds=ebs_ids)#TODO:add support for pagination
-    if 'Volumes' in volume_details:
-        for v in volume_details['Volumes']:
-            volume_type = v['VolumeType']
-            if volume_type in result:
-                result[volume_type] = result[volume_type] + int(v['Size'])
-            else:
-                result[volume_type] = int(v['Size'])
-            if volume_type == 'io1': iops = iops + int(v['Iops'])
+#Returns the EBS volumes attached to the EC2 instances - {volume id: volume}
+def get_ebs_volumes(instance_dict):
+    result = {}
+    ebs_ids = get_ebs_volume_ids(instance_dict)
+    if ebs_ids:
+        for v in paginate(ec2client, 'describe_volumes', 'Volumes', VolumeIds=ebs_ids):
+            result[v['VolumeId']] = v
+    return result
+
+
+def get_storage_by_ebs_type(instance_dict, volumes):
+    result = {}
+    iops = 0
+    for volume_id in get_ebs_volume_ids(instance_dict):
+        if volume_id not in volumes: continue
+        v = volumes[volume_id]
+        volume_type = v['VolumeType']
+        if volume_type in result:
+            result[volume_type] = result[volume_type] + int(v['Size'])
+        else:
+            result[volume_type] = int(v['Size'])
+        if volume_type == 'io1': iops = iops + int(v['Iops'])
 
     return result, iops
 
 
 def get_total_snapshot_storage(tagkey, tagvalue):
     result = 0
-    snapshots = ec2client.describe_snapshots(Filters=[{'Name': 'tag:'+tagkey,'Values': [tagvalue]}])
-    if 'Snapshots' in snapshots:
-        for s in snapshots['Snapshots']:
-            result = result + s['VolumeSize']
+    for s in paginate(ec2client, 'describe_snapshots', 'Snapshots', Filters=[{'Name': 'tag:'+tagkey,'Values': [tagvalue]}]):
+        result = result + s['VolumeSize']
 
     #log.info("total snapshot size:["+str(result)+"]")
     return result
@@ -581,32 +696,12 @@ def get_total_snapshot_storage(tagkey, tagvalue):
 For each EC2 instance registered to an ELB, get the following metrics: NetworkIn, NetworkOut.
 Then add them up and use them to calculate the total data processed by the ELB
 """
-def calculate_elb_data_processed(start, end, elb_instances):
+def calculate_elb_data_processed(metrics, elb_instances):
     result = 0
 
     for instance_id in elb_instances.keys():
-        metricsNetworkIn = cwclient.get_metric_statistics(
-            Namespace='AWS/EC2',
-            MetricName='NetworkIn',
-            Dimensions=[{'Name': 'InstanceId','Value': instance_id}],
-            StartTime=start,
-            EndTime=end,
-            Period=60*METRIC_WINDOW,
-            Statistics = ['Sum']
-        )
-        metricsNetworkOut = cwclient.get_metric_statistics(
-            Namespace='AWS/EC2',
-            MetricName='NetworkOut',
-            Dimensions=[{'Name': 'InstanceId','Value': instance_id}],
-            StartTime=start,
-            EndTime=end,
-            Period=60*METRIC_WINDOW,
-            Statistics = ['Sum']
-        )
-        for datapoint in metricsNetworkIn['Datapoints']:
-            if 'Sum' in datapoint: result = result + datapoint['Sum']
-        for datapoint in metricsNetworkOut['Datapoints']:
-            if 'Sum' in datapoint: result = result + datapoint['Sum']
+        result += sum(metrics.get_values(METRIC_EC2_NETWORK_IN, instance_id))
+        result += sum(metrics.get_values(METRIC_EC2_NETWORK_OUT, instance_id))
 
     log.info ("Total Bytes processed by ELBs in time window of ["+str(METRIC_WINDOW)+"] minutes :["+str(result)+"]")
 
@@ -617,22 +712,12 @@ For each ALB, get the value for the ConsumedLCUs metric
 """
 
 
-def calculate_alb_lcus(start, end, albs):
+def calculate_alb_lcus(metrics, albs):
     result = 0
 
     for a in albs:
         log.info("Getting ConsumedLCUs for ALB: [{}]".format(a))
-        metricsLcus = cwclient.get_metric_statistics(
-            Namespace='AWS/ApplicationELB',
-            MetricName='ConsumedLCUs',
-            Dimensions=[{'Name': 'LoadBalancer','Value': "app/{}".format(a)}],
-            StartTime=start,
-            EndTime=end,
-            Period=60*METRIC_WINDOW,
-            Statistics = ['Sum']
-        )
-        for datapoint in metricsLcus['Datapoints']:
-            result += datapoint.get('Sum',0)
+        result += sum(metrics.get_values(METRIC_ALB_CONSUMED_LCUS, "app/{}".format(a)))
 
     log.info ("Total ConsumedLCUs consumed by ALBs in time window of ["+str(METRIC_WINDOW)+"] minutes :["+str(result)+"]")
 
@@ -642,47 +727,18 @@ def calculate_alb_lcus(start, end, albs):
 
 
 
-def calculate_lambda_executions(start, end, func):
-    result = 0
-
-    invocations = cwclient.get_metric_statistics(
-            Namespace='AWS/Lambda',
-            MetricName='Invocations',
-            #Dimensions=[{'Name': 'FunctionName','Value': func['name']}],
-            Dimensions=[{'Name': 'FunctionName','Value': func.id}],
-            StartTime=start,
-            EndTime=end,
-            Period=60*METRIC_WINDOW,
-            Statistics = ['Sum']
-        )
-    for datapoint in invocations['Datapoints']:
-      if 'Sum' in datapoint: result = result + datapoint['Sum']
+def calculate_lambda_executions(metrics, func):
+    result = sum(metrics.get_values(METRIC_LAMBDA_INVOCATIONS, func.id))
 
     log.debug("calculate_lambda_executions: [{}]".format(result))
     return result
 
 
-def calculate_lambda_duration(start, end, func):
+def calculate_lambda_duration(metrics, func):
     result = 0
 
-    invocations = cwclient.get_metric_statistics(
-            Namespace='AWS/Lambda',
-            MetricName='Duration',
-            #Dimensions=[{'Name': 'FunctionName','Value': func['name']}],
-            Dimensions=[{'Name': 'FunctionName','Value': func.id}],
-            StartTime=start,
-            EndTime=end,
-            Period=60*METRIC_WINDOW,
-            Statistics = ['Average']
-        )
-    count = 0
-    total = 0
-    for datapoint in invocations['Datapoints']:
-      if 'Average' in datapoint:
-          count+=1
-          total+=datapoint['Average']
-
-    if count: result = total / count
+    values = metrics.get_values(METRIC_LAMBDA_DURATION, func.id)
+    if values: result = sum(values) / len(values)
 
     log.debug("calculate_lambda_duration: [{}]".format(result))
 
@@ -705,6 +761,7 @@ def get_lambda_memory(functionname, qualifier):
     return result
 
 
+#Tables that can't be described (i.e. they were deleted after they were found) have no provisioned capacity units
 def get_ddb_capacity_units(tablename):
     read = 0
     write = 0
@@ -713,11 +770,12 @@ def get_ddb_capacity_units(tablename):
         if 'Table' in r:
             read = r['Table']['ProvisionedThroughput']['ReadCapacityUnits']
             write = r['Table']['ProvisionedThroughput']['WriteCapacityUnits']
-        return read, write
 
     except Exception as e:
         log.error("{}".format(e))
 
+    return read, write
+
 
 def get_kinesis_stream_shards(streamName):
     shardCount = 0
@@ -744,7 +802,7 @@ as well as the total bytes entering the stream. There is no accurate way to calc
 25KB chunks going into the stream.
 
 """
-def calculate_kinesis_put_payload_units(start, end, streamName):
+def calculate_kinesis_put_payload_units(metrics, streamName):
     totalRecords = 0
     totalBytesAvg = 0
     totalPutPayloadUnits = 0
@@ -752,34 +810,13 @@ def calculate_kinesis_put_payload_units(start, end, streamName):
 
 
     try:
-        incomingRecords = cwclient.get_metric_statistics(
-                Namespace='AWS/Kinesis',
-                MetricName='IncomingRecords',
-                Dimensions=[{'Name': 'StreamName','Value': streamName}],
-                StartTime=start,
-                EndTime=end,
-                Period=60*METRIC_WINDOW,
-                Statistics = ['Sum']
-            )
-
-        for datapoint in incomingRecords['Datapoints']:
-          if 'Sum' in datapoint: totalRecords = totalRecords + datapoint['Sum']
-
-        incomingBytes = cwclient.get_metric_statistics(
-                Namespace='AWS/Kinesis',
-                MetricName='IncomingBytes',
-                Dimensions=[{'Name': 'StreamName','Value': streamName}],
-                StartTime=start,
-                EndTime=end,
-                Period=60*METRIC_WINDOW,
-                Statistics = ['Average']
-            )
-
-        for datapoint in incomingBytes['Datapoints']:
-          if 'Average' in datapoint:
-              chunkCount += int(math.ceil(datapoint['Average']/25000))
-
-        bytesDatapoints = len(incomingBytes['Datapoints'])
+        totalRecords = sum(metrics.get_values(METRIC_KINESIS_INCOMING_RECORDS, streamName))
+
+        incomingBytes = metrics.get_values(METRIC_KINESIS_INCOMING_BYTES, streamName)
+        for average in incomingBytes:
+            chunkCount += int(math.ceil(average/25000))
+
+        bytesDatapoints = len(incomingBytes)
         if not bytesDatapoints: bytesDatapoints = 1 #avoid zerodiv
         totalPutPayloadUnits = totalRecords * chunkCount/bytesDatapoints
         log.info("get_kinesis_stream_puts - incomingRecords:[{}] - chunkAvg:[{}] - totalPutPayloadUnits:[{}]".format(totalRecords, chunkCount/bytesDatapoints, totalPutPayloadUnits))
@@ -839,26 +876,151 @@ def init_clients(context):
     tagsclient = boto3.client('resourcegroupstaggingapi', region)
 
 
-class ResourceManager():
-    def __init__(self, tagkey, tagvalue):
-        self.resources = []
-        self.init_resources(tagkey, tagvalue)
+#Yields the items in the resultKey list of every page returned by a paginated AWS API operation
+def paginate(client, operation, resultKey, **args):
+    for page in client.get_paginator(operation).paginate(**args):
+        for item in page.get(resultKey, []):
+            yield item
+
+
+"""
+Publishes datapoints to CloudWatch with as few API calls as possible. Datapoints are accumulated during an invocation
+and published by flush, in PutMetricData calls with up to MAX_PUT_METRIC_DATA datapoints each.
+Calls that are throttled are retried with exponential backoff.
+"""
+class MetricEmitter():
+    def __init__(self):
+        self.datums = []
+
 
+    def add(self, datum):
+        self.datums.append(datum)
 
-    def init_resources(self, tagkey, tagvalue):
-        #TODO: Implement pagination
-        response = tagsclient.get_resources(
-                            TagsPerPage = 500,
-                            TagFilters=[{'Key': tagkey,'Values': [tagvalue]}],
-                            ResourceTypeFilters=self.get_resource_type_filters(SERVICE_RESOURCE_MAP)
-                    )
 
-        if 'ResourceTagMappingList' in response:
-            for r in response['ResourceTagMappingList']:
-                res = self.extract_resource(r['ResourceARN'])
-                if res:
-                    self.resources.append(res)
-                    #log.info("Tagged resource:{}".format(res.__dict__))
+    def flush(self):
+        for i in range(0, len(self.datums), MAX_PUT_METRIC_DATA):
+            self.put_metric_data(self.datums[i:i+MAX_PUT_METRIC_DATA])
+        log.info("Published [{}] datapoints to CloudWatch namespace [{}]".format(len(self.datums), CW_NAMESPACE))
+        self.datums = []
+
+
+    def put_metric_data(self, datums):
+        retries = 0
+        while True:
+            try:
+                return cwclient.put_metric_data(Namespace=CW_NAMESPACE, MetricData=datums)
+            except ClientError as e:
+                if e.response.get('Error',{}).get('Code') not in THROTTLING_ERROR_CODES or retries >= PUT_METRIC_DATA_MAX_RETRIES:
+                    raise
+                delay = PUT_METRIC_DATA_RETRY_DELAY * (2 ** retries) * random.uniform(0.5, 1)
+                log.warning("PutMetricData was throttled, retrying in [{:.2f}] seconds".format(delay))
+                time.sleep(delay)
+                retries += 1
+
+
+
+
+"""
+Gets CloudWatch metrics for many resources with as few API calls as possible. Metrics are added for each resource
+(i.e. Invocations for every Lambda function) and then requested together using GetMetricData, which accepts up to
+MAX_METRIC_DATA_QUERIES metrics per call. Each call is paginated and calls are made concurrently if an executor is
+provided. Returns the values for each metric and resource, one per METRIC_WINDOW period, like the datapoints
+returned by GetMetricStatistics.
+"""
+class MetricCollector():
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.queryIds = {}
+        self.queries = []
+        self.values = {}
+
+
+    #metric is one of the METRIC_* constants - (namespace, metric name, dimension name, statistic)
+    def add(self, metric, dimensionValue):
+        key = (metric, dimensionValue)
+        if key in self.queryIds: return
+        #Query ids must start with a lowercase letter
+        queryId = "m{}".format(len(self.queries))
+        self.queryIds[key] = queryId
+        namespace, metricName, dimensionName, statistic = metric
+        self.queries.append({'Id': queryId,
+                             'MetricStat': {'Metric': {'Namespace': namespace, 'MetricName': metricName,
+                                                       'Dimensions': [{'Name': dimensionName, 'Value': dimensionValue}]},
+                                            'Period': 60*METRIC_WINDOW,
+                                            'Stat': statistic},
+                             'ReturnData': True})
+
+
+    def collect(self, executor=None):
+        batches = [self.queries[i:i+MAX_METRIC_DATA_QUERIES] for i in range(0, len(self.queries), MAX_METRIC_DATA_QUERIES)]
+        if executor: results = executor.map(self.get_metric_data, batches)
+        else: results = map(self.get_metric_data, batches)
+        for r in results: self.values.update(r)
+        log.info("Collected [{}] metrics in [{}] GetMetricData requests".format(len(self.queries), len(batches)))
+
+
+    def get_metric_data(self, queries):
+        result = {}
+        args = {'MetricDataQueries': queries, 'StartTime': self.start, 'EndTime': self.end}
+        while True:
+            response = cwclient.get_metric_data(**args)
+            for r in response.get('MetricDataResults', []):
+                if r.get('StatusCode') == 'InternalError':
+                    log.error("Error getting metric data for query [{}]: {}".format(r['Id'], r.get('Messages')))
+                result.setdefault(r['Id'], []).extend(r.get('Values', []))
+            if not response.get('NextToken'): break
+            args['NextToken'] = response['NextToken']
+        return result
+
+
+    def get_values(self, metric, dimensionValue):
+        return self.values.get(self.queryIds.get((metric, dimensionValue)), [])
+
+
+
+
+"""
+Finds the resources that have any of a list of tags (key, value), using the Resource Groups Tagging API.
+Tag filters with different keys would only match resources that have all of them, therefore tags with the same key
+are searched together and there's one search for each key. Each resource keeps the tags it was found with.
+Resources are indexed by service and resource type as they're found, so getting the resources of a type doesn't
+scan all resources.
+"""
+class ResourceManager():
+    def __init__(self, tags):
+        self.resources = []
+        self.resourcesByType = {}
+        self.init_resources(tags)
+
+
+    def init_resources(self, tags):
+        for res in self.discover_resources(tags):
+            self.resources.append(res)
+            self.resourcesByType.setdefault((res.service, res.type), []).append(res)
+            #log.info("Tagged resource:{}".format(res.__dict__))
+
+
+    #Yields each tagged resource once, as pages of results arrive
+    def discover_resources(self, tags):
+        resourcesByArn = {}
+        tagvalues = {}
+        for tagkey, tagvalue in tags: tagvalues.setdefault(tagkey, []).append(tagvalue)
+        for tagkey, values in tagvalues.items():
+            for i in range(0, len(values), MAX_TAG_FILTER_VALUES):
+                for r in paginate(tagsclient, 'get_resources', 'ResourceTagMappingList', TagsPerPage=500,
+                                  TagFilters=[{'Key': tagkey,'Values': values[i:i+MAX_TAG_FILTER_VALUES]}],
+                                  ResourceTypeFilters=self.get_resource_type_filters(SERVICE_RESOURCE_MAP)):
+                    res = resourcesByArn.get(r['ResourceARN'])
+                    isNew = res is None
+                    if isNew:
+                        res = self.extract_resource(r['ResourceARN'])
+                        if not res: continue
+                        resourcesByArn[r['ResourceARN']] = res
+                    for t in r.get('Tags', []):
+                        if t['Key'] == tagkey and t['Value'] in values: res.tags.add((t['Key'], t['Value']))
+                    if tagkey == "": res.tags.add(("", ""))
+                    if isNew: yield res
 
     #Return a service:resource list in the format the ResourceGroupTagging API expects it
     def get_resource_type_filters(self, service_resource_map):
@@ -890,22 +1052,15 @@ class ResourceManager():
 
         return None
 
-    def get_resources(self, service, resourceType):
-        result = []
-        if self.resources:
-            for r in self.resources:
-                if r.service == service and r.type == resourceType:
-                    result.append(r)
-        return result
+    #Returns the resources of a service and type, for all tags or only the ones with a particular tag (key, value)
+    def get_resources(self, service, resourceType, tag=None):
+        resources = self.resourcesByType.get((service, resourceType), [])
+        if tag is None: return list(resources)
+        return [r for r in resources if tag in r.tags]
 
 
-    def get_resource_ids(self, service, resourceType):
-        result = []
-        if self.resources:
-            for r in self.resources:
-                if r.service == service and r.type == resourceType:
-                    result.append(r.id)
-        return result
+    def get_resource_ids(self, service, resourceType, tag=None):
+        return [r.id for r in self.get_resources(service, resourceType, tag)]
 
 
 
@@ -916,3 +1071,4 @@ class ResourceManager():
             self.type = type
             self.id = id
             self.arn = arn
+            self.tags = set()
@@ -1,10 +1,14 @@
 #!/usr/bin/python
-import os, sys, getopt, json, csv, ssl
-import urllib.request
+import os, sys, getopt, json, csv, ssl, time, socket, hashlib
+import http.client
+import urllib.request, urllib.error
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 sys.path.insert(0, os.path.abspath('..'))
 from awspricecalculator.common import consts as consts
 from awspricecalculator.common import phelper as phelper
+from awspricecalculator.common import pricetable as pricetable
 
 
 if (not os.environ.get('PYTHONHTTPSVERIFY', '') and
@@ -15,6 +19,26 @@ if (not os.environ.get('PYTHONHTTPSVERIFY', '') and
 __location__ = os.path.dirname(os.path.realpath(__file__))
 dataindexpath = os.path.join(os.path.split(__location__)[0],"awspricecalculator", "data")
 
+#The Price List API endpoint can be replaced (i.e. with a local server that has copies of the index files)
+OFFER_INDEX_URL = os.environ.get('OFFER_INDEX_URL', 'https://pricing.us-east-1.amazonaws.com/offers/v1.0/aws/{serviceIndex}/current/index.')
+
+#Partition files that are kept open at the same time while an index is split (the rest are reopened when needed)
+MAX_OPEN_PARTITION_FILES = 64
+PARTITION_FILE_BUFFER_SIZE = 64 * 1024
+PARTITION_TMP_SUFFIX = '.tmp'
+
+#The first rows in a CSV index file are metadata (FormatVersion, Disclaimer, Publication Date, Version, OfferCode)
+INDEX_METADATA_ROWS = 5
+INDEX_METADATA_FIRST_FIELD = '"FormatVersion"'
+#Partitions, SKUs and prices that changed in the last split
+PARTITION_CHANGELOG_FILE = 'index_changelog.json'
+
+#Index files are streamed to disk in chunks, interrupted downloads are resumed up to DOWNLOAD_RETRIES times
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_TIMEOUT = 60 #seconds
+DOWNLOAD_PROGRESS_INTERVAL = 5 #seconds
+
 """
 This script gets the latest index files from the AWS Price List API.
 """
@@ -26,18 +50,19 @@ def main(argv):
                         consts.SERVICE_DYNAMODB, consts.SERVICE_KINESIS, consts.SERVICE_DATA_TRANSFER, consts.SERVICE_EMR,
                         consts.SERVICE_REDSHIFT, consts.SERVICE_ALL)
   SUPPORTED_FORMATS = ('json','csv')
-  OFFER_INDEX_URL = 'https://pricing.us-east-1.amazonaws.com/offers/v1.0/aws/{serviceIndex}/current/index.'
 
 
   service = ''
   format = ''
   region = ''
   tenancy = ''
+  workers = 1
+  force = False
 
-  help_message = 'Script usage: \nget-latest-index.py --service=<s3|ec2|rds|etc> --format=<csv|json>'
+  help_message = 'Script usage: \nget-latest-index.py --service=<s3|ec2|rds|etc> --format=<csv|json> [--tenancy=<shared,dedicated,host>] [--workers=<number of parallel downloads/splits>] [--force]'
 
   try:
-    opts, args = getopt.getopt(argv,"hr:s:f:t",["region=","service=","format=","tenancy="])
+    opts, args = getopt.getopt(argv,"hr:s:f:t:w:",["region=","service=","format=","tenancy=","workers=","force"])
     print ('opts: ' + str(opts))
   except getopt.GetoptError:
     print (help_message)
@@ -55,6 +80,10 @@ def main(argv):
       region = opt[1]
     if opt[0] in ("-t","--tenancy"): #comma-separated tenancies (host, dedicated, shared)
       tenancy= opt[1].split(',')
+    if opt[0] in ("-w","--workers"): #non-numeric values are rejected below, with the rest of the validations
+      workers = int(opt[1]) if opt[1].isdigit() else 0
+    if opt[0] == "--force": #download and split index files even if they haven't changed
+      force = True
 
 
   if not format: format = 'csv'
@@ -66,6 +95,8 @@ def main(argv):
     validation_ok = False
   if format not in SUPPORTED_FORMATS:
     validation_ok = False
+  if workers < 1:
+    validation_ok = False
 
   if not validation_ok:
     print (help_message)
@@ -78,165 +109,537 @@ def main(argv):
   term  = '' #all terms
 
   extraArgs = {}
-  if tenancy: extraArgs['tenancies']=[tenancy]
-  else: extraArgs['tenancies']=consts.EC2_TENANCY_MAP.keys()
+  #Tenancies are given as script values (shared, dedicated, host) and partitions use the values in the index
+  if tenancy: extraArgs['tenancies']=[consts.EC2_TENANCY_MAP.get(t, t) for t in tenancy]
+  else: extraArgs['tenancies']=list(consts.EC2_TENANCY_MAP.values())
+
+  refresh_indexes([s for s in services if s != 'all'], format, region, term, workers, force, **extraArgs)
+
+
+"""
+Downloads and splits the index files for a list of services, then prints how long each stage took per service.
+With more than 1 worker, index files are downloaded concurrently and each one is split in a separate process
+as soon as its download finishes. Index files that haven't changed since the last download are not split again,
+unless force is set.
+"""
+def refresh_indexes(services, format, region, term, workers=1, force=False, **extraArgs):
+  ts = phelper.Timestamp()
+  ts.start('refreshIndexes')
+  timings = OrderedDict((s, OrderedDict()) for s in services)
+
+  if workers <= 1:
+    for s in services:
+      timings[s]['download'], pending = download_index(s, format, force)
+      if format == 'csv' and pending: timings[s].update(process_index(s, region, term, **extraArgs))
+
+  else:
+    with ThreadPoolExecutor(max_workers=workers) as downloads, ProcessPoolExecutor(max_workers=workers) as splits:
+      downloadFutures = {downloads.submit(download_index, s, format, force):s for s in services}
+      splitFutures = {}
+      for f in as_completed(downloadFutures):
+        s = downloadFutures[f]
+        timings[s]['download'], pending = f.result()
+        if format == 'csv' and pending: splitFutures[splits.submit(process_index, s, region, term, **extraArgs)] = s
+      for f in as_completed(splitFutures):
+        timings[splitFutures[f]].update(f.result())
+
+  for s in timings:
+    print ("Timings for service [{}]: {}".format(s, ' - '.join("{}:[{:.2f}s]".format(k, v) for k, v in timings[s].items())))
+  print ("Total time to refresh indexes: [{}]".format(ts.finish('refreshIndexes')))
+  return timings
+
+
+"""
+Downloads the index file for a service. Returns the elapsed time in seconds and whether the index has to be
+processed: a new file was downloaded, or the CSV file from a previous download wasn't split successfully.
+
+The file is streamed to disk in chunks. The ETag and Last-Modified headers of each download are kept in
+index_download.json, so that:
+ - an index that hasn't changed since the last complete download is skipped (conditional request)
+ - an interrupted download continues where it stopped (Range request), as long as the index didn't change
+process_index records in the same file when the index was split, so a failed split is retried in the next run.
+"""
+def download_index(service, format, force=False):
+  start = time.time()
+  offerIndexUrl = OFFER_INDEX_URL.replace('{serviceIndex}',consts.SERVICE_INDEX_MAP[service]) + format
+  print ('Downloading offerIndexUrl:['+offerIndexUrl+']...')
+
+  servicedatapath = dataindexpath + "/" + service
+  print ("servicedatapath:[{}]".format(servicedatapath))
+
+  if not os.path.exists(servicedatapath): os.mkdir(servicedatapath)
+  filename = servicedatapath+"/index."+format
+  statefilename = get_download_state_file_name(service)
+
+  state = read_download_state(statefilename)
+  if state.get('url') != offerIndexUrl or (force and state.get('complete')): state = {'url':offerIndexUrl}
+
+  attempt = 0
+  while True:
+    try:
+      downloaded = stream_download(offerIndexUrl, filename, statefilename, state)
+      break
+    except (urllib.error.URLError, http.client.HTTPException, ConnectionError, socket.timeout) as e:
+      if isinstance(e, urllib.error.HTTPError) and e.code < 500: raise
+      attempt += 1
+      if attempt > DOWNLOAD_RETRIES: raise
+      print ("Download of [{}] failed ({}) - retrying in [{}] seconds".format(offerIndexUrl, e, 2 ** attempt))
+      time.sleep(2 ** attempt)
+
+  if not downloaded:
+    print ("Index file for service [{}] hasn't changed since the last download".format(service))
+    if format == 'csv' and not state.get('split'):
+      print ("Index file for service [{}] wasn't split after the last download, it will be split again".format(service))
+      return time.time() - start, True
+  return time.time() - start, downloaded
+
+
+def stream_download(url, filename, statefilename, state):
+  partfilename = filename + ".part"
+  validator = state.get('etag') or state.get('lastModified')
+  headers = {}
+  offset = 0
+  if state.get('complete'):
+    if os.path.exists(filename):
+      if state.get('etag'): headers['If-None-Match'] = state['etag']
+      if state.get('lastModified'): headers['If-Modified-Since'] = state['lastModified']
+  elif validator and os.path.exists(partfilename):
+    offset = os.path.getsize(partfilename)
+    headers['Range'] = 'bytes={}-'.format(offset)
+    headers['If-Range'] = validator
+
+  try:
+    response = urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=DOWNLOAD_TIMEOUT)
+  except urllib.error.HTTPError as e:
+    if e.code == 304: return False
+    #The partial file doesn't match the index anymore, start again
+    if e.code == 416:
+      os.remove(partfilename)
+      state.clear()
+      state['url'] = url
+      return stream_download(url, filename, statefilename, state)
+    raise
+
+  with response:
+    #The server sends the whole file when the index changed since the partial download (or if it doesn't support ranges)
+    if response.getcode() != 206: offset = 0
+    else: print ("Resuming download of [{}] at byte [{}]".format(url, offset))
+    state.update({'url':url, 'etag':response.headers.get('ETag'), 'lastModified':response.headers.get('Last-Modified'), 'complete':False})
+    write_download_state(statefilename, state)
+
+    contentLength = response.headers.get('Content-Length')
+    total = int(contentLength) + offset if contentLength else None
+    received = offset
+    start = lastReport = time.time()
+    with open(partfilename, 'ab' if offset else 'wb') as f:
+      while True:
+        chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+        if not chunk: break
+        f.write(chunk)
+        received += len(chunk)
+        if time.time() - lastReport >= DOWNLOAD_PROGRESS_INTERVAL:
+          lastReport = time.time()
+          print_download_progress(url, received, total, received - offset, lastReport - start)
+
+  if total is not None and received < total:
+    raise ConnectionError("received [{}] of [{}] bytes".format(received, total))
+
+  print_download_progress(url, received, total, received - offset, time.time() - start)
+  os.replace(partfilename, filename)
+  #The index is only marked as split by process_index, once the split succeeds
+  state['complete'] = True
+  state['split'] = False
+  write_download_state(statefilename, state)
+  return True
+
+
+def print_download_progress(url, received, total, transferred, elapsed):
+  mb = 1024 * 1024
+  throughput = transferred / mb / elapsed if elapsed else 0
+  totalMb = "{:.1f}".format(total / mb) if total else '?'
+  print ("Downloaded [{:.1f}] of [{}] MB from [{}] - [{:.2f}] MB/s".format(received / mb, totalMb, url, throughput))
+
+
+def get_download_state_file_name(service):
+  return dataindexpath + "/" + service + "/index_download.json"
+
+
+def read_download_state(statefilename):
+  try:
+    with open(statefilename) as f: return json.load(f)
+  except (IOError, ValueError):
+    return {}
 
 
-  for s in services:
-      if s != 'all':
-          offerIndexUrl = OFFER_INDEX_URL.replace('{serviceIndex}',consts.SERVICE_INDEX_MAP[s]) + format
-          print ('Downloading offerIndexUrl:['+offerIndexUrl+']...')
+def write_download_state(statefilename, state):
+  with open(statefilename, 'w') as f: json.dump(state, f, indent=4)
 
-          servicedatapath = dataindexpath + "/" + s
-          print ("servicedatapath:[{}]".format(servicedatapath))
 
-          if not os.path.exists(servicedatapath): os.mkdir(servicedatapath)
-          filename = servicedatapath+"/index."+format
+#Extracts the metadata from a downloaded CSV index and splits it into partitions. Returns the elapsed time for each step.
+def process_index(service, region, term, **extraArgs):
+  result = OrderedDict()
+  start = time.time()
+  extract_metadata(dataindexpath + "/" + service + "/index.csv")
+  result['extractMetadata'] = time.time() - start
 
-          with open(filename, "wb") as f: f.write(urllib.request.urlopen(offerIndexUrl).read())
+  start = time.time()
+  split_index(service, region, term, **extraArgs)
+  result['split'] = time.time() - start
 
-          if format == 'csv':
-            remove_metadata(filename)
-            split_index(s, region, term, **extraArgs)
+  statefilename = get_download_state_file_name(service)
+  state = read_download_state(statefilename)
+  if state.get('complete'):
+    state['split'] = True
+    write_download_state(statefilename, state)
+  return result
 
 
 """
 The first rows in the PriceList index.csv are metadata.
-This method removes the metadata from the index files and writes it in a separate .json file,
+This method reads the metadata from the index files and writes it in a separate .json file,
  so the metadata can be accessed by other modules. For example, the PriceList Version is returned
  in every price calculation.
+Only the metadata rows are read. The index file is not rewritten, split_index skips the metadata rows instead.
 """
 
-def remove_metadata(index_filename):
-  print ("Removing metadata from file [{}]".format(index_filename))
+def extract_metadata(index_filename):
+  print ("Extracting metadata from file [{}]".format(index_filename))
   metadata_filename = index_filename.replace('.csv','_metadata.json')
   metadata_dict = {}
   with open(index_filename,"r") as rf:
-    lines = rf.readlines()
-  with open(index_filename,"w") as wf:
-    i = 0
-    for l in lines:
-      #The first 5 records in the CSV file are metadata
-      if i <= 4:
-        config_record = l.replace('","','"|"').strip("\n").split("|")
-        metadata_dict[config_record[0].strip('\"')] = config_record[1].strip('\"')
-      else:
-        wf.write(l)
-      i += 1
+    for l in read_metadata_rows(rf):
+      config_record = l.replace('","','"|"').strip("\n").split("|")
+      metadata_dict[config_record[0].strip('\"')] = config_record[1].strip('\"')
   with open(metadata_filename,"w") as mf:
     print ("Creating metadata file [{}]".format(metadata_filename))
     metadata_json = json.dumps(metadata_dict,sort_keys=False,indent=4)
     print ("metadata_json: [{}]".format(metadata_json))
     mf.write(metadata_json)
 
+
+"""
+Reads the metadata rows at the beginning of an index file and leaves the file positioned at the CSV header.
+Index files that don't start with metadata (i.e. the ones stripped by older versions of this script) are left at
+the beginning.
+"""
+def read_metadata_rows(indexfile):
+  result = []
+  position = indexfile.tell()
+  if not indexfile.readline().startswith(INDEX_METADATA_FIRST_FIELD):
+    indexfile.seek(position)
+    return result
+  indexfile.seek(position)
+  for i in range(INDEX_METADATA_ROWS):
+    result.append(indexfile.readline())
+  return result
+
 """
 Some index files are too large. For example, the one for EC2 has more than 460K records.
 In order to make price lookup more efficient, awspricecalculator splits the
 index based on a combination of region, term type and product family. Each partition
-has a key, which is used by tinydb to load smaller files as databases that can be
+has a key, which is used by awspricecalculator to load smaller files as price tables that can be
 queried. This increases performance significantly.
 
+Rows are written to their partition file as the index is read, so memory usage doesn't depend on the size of the index.
 """
 
 def split_index(service, region, term, **args):
     #Split index format: region -> term type -> product family
-    indexDict = {}#contains the keys of the files that will be created
     productFamilies = {}
     usageGroupings=[]
-    partition_keys = phelper.get_partition_keys(service, region, term, **args)#All regions and all term types (On-Demand + Reserved)
+    partition_keys = set(phelper.get_partition_keys(service, region, term, **args))#All regions and all term types (On-Demand + Reserved)
     #print("partition_keys:[{}]".format(partition_keys))
-    for pk in partition_keys:
-        indexDict[pk]=[]
-
-    fieldnames = []
 
     #with open(get_index_file_name(service, 'index', 'csv'), 'rb') as csvfile:
     with open(get_index_file_name(service, 'index', 'csv'), 'r') as csvfile:
+        read_metadata_rows(csvfile)
         pricelist = csv.DictReader(csvfile, delimiter=',', quotechar='"')
+        fieldnames = get_partition_fieldnames(service, pricelist.fieldnames or [])
+        writers = PartitionWriterPool(service, fieldnames, MAX_OPEN_PARTITION_FILES)
         indexRegion = ''
+        crossRegionKeys = {}
         x = 0
-        for row in pricelist:
-            indexKey = ''
-            if x==0: fieldnames=row.keys()
-            if row.get('Location Type','') == 'AWS Region':
-                indexRegion = row['Location']
-            if row.get('Product Family','')== consts.PRODUCT_FAMILY_DATA_TRANSFER:
-                indexRegion = row['From Location']
-
-            #Determine the index partition the current row belongs to and append it to the corresponding array
-            if row.get('TermType','') == consts.TERM_TYPE_RESERVED:
-                #TODO:move the creation of the index dimensions to a common function
-                if service == consts.SERVICE_EC2:
-                    indexDimensions = (indexRegion,row['TermType'],row['Product Family'],row['OfferingClass'],row['Tenancy'], row['PurchaseOption'])
-                elif service in (consts.SERVICE_RDS, consts.SERVICE_REDSHIFT):#'Tenancy' is not part of the RDS/Redshift index, therefore default it to Shared
-                    indexDimensions = (indexRegion,row['TermType'],row['Product Family'],row['OfferingClass'],row.get('Tenancy',consts.EC2_TENANCY_SHARED),row['PurchaseOption'])
-            else:
-                if service == consts.SERVICE_EC2:
-                    indexDimensions = (indexRegion,row['TermType'],row['Product Family'],row['Tenancy'])
+        try:
+            for row in pricelist:
+                indexKey = ''
+                if row.get('Location Type','') == 'AWS Region':
+                    indexRegion = row['Location']
+                if row.get('Product Family','')== consts.PRODUCT_FAMILY_DATA_TRANSFER:
+                    indexRegion = row['From Location']
+
+                #Determine the index partition the current row belongs to and write it to the corresponding file
+                if row.get('TermType','') == consts.TERM_TYPE_RESERVED:
+                    #TODO:move the creation of the index dimensions to a common function
+                    if service == consts.SERVICE_EC2:
+                        indexDimensions = (indexRegion,row['TermType'],row['Product Family'],row['OfferingClass'],row['Tenancy'], row['PurchaseOption'])
+                    elif service in (consts.SERVICE_RDS, consts.SERVICE_REDSHIFT):#'Tenancy' is not part of the RDS/Redshift index, therefore default it to Shared
+                        indexDimensions = (indexRegion,row['TermType'],row['Product Family'],row['OfferingClass'],row.get('Tenancy',consts.EC2_TENANCY_SHARED),row['PurchaseOption'])
                 else:
-                    indexDimensions = (indexRegion,row['TermType'],row['Product Family'])
+                    if service == consts.SERVICE_EC2:
+                        indexDimensions = (indexRegion,row['TermType'],row['Product Family'],row['Tenancy'])
+                    else:
+                        indexDimensions = (indexRegion,row['TermType'],row['Product Family'])
+
+                #print ("TermType:[{}] - service:[{}] - indexDimensions:[{}]".format(row.get('TermType',''), service, indexDimensions))
+
+                indexKey = phelper.create_file_key(indexDimensions)
+                if indexKey in partition_keys:
+                    writers.write(indexKey, row)
+                    #The same partition in all regions (i.e. On-Demand Compute Instance records) is combined in a cross-region partition
+                    crossRegionKeys[indexKey] = consts.CROSS_REGION_PARTITION_PREFIX + phelper.create_file_key(indexDimensions[1:])
+
+                #Get a list of distinct product families in the index file
+                productFamily = row['Product Family']
+                if productFamily not in productFamilies:
+                    productFamilies[productFamily] = []
+                usageGroup = row.get('Group','')
+                if usageGroup not in productFamilies[productFamily]:
+                    productFamilies[productFamily].append(usageGroup)
+
+                x += 1
+                if x % 1000 == 0: print("Processed row [{}]".format(x))
+        finally:
+            writers.close()
 
-            #print ("TermType:[{}] - service:[{}] - indexDimensions:[{}]".format(row.get('TermType',''), service, indexDimensions))
+    print ("productFamilies:{}".format(productFamilies))
 
-            indexKey = phelper.create_file_key(indexDimensions)
-            if indexKey in indexDict:
-                indexDict[indexKey].append(remove_fields(service, row))
+    #Partitions are written to temporary files first. Only the ones whose contents changed since the previous split
+    #replace the existing files, so unchanged partitions (and anything that caches them) are not touched.
+    previousManifest = read_partition_manifest(service)
+    previousHashes = previousManifest.get('hashes', {})
+    partitions = sorted(writers.rowCounts)
+    hashes = {}
+    changelog = {'previousVersion':previousManifest.get('version'), 'version':get_index_version(service),
+                 'partitions':{'added':[], 'removed':[], 'changed':[]},
+                 'skus':{'added':[], 'removed':[], 'repriced':[]}}
+    changedPartitions = set()
+    for f in partitions:
+        csvfilename = get_index_file_name(service, f, 'csv')
+        binfilename = get_index_file_name(service, f, pricetable.PACKED_FILE_FORMAT)
+        tmpfilename = csvfilename + PARTITION_TMP_SUFFIX
+        hashes[f] = hash_file(tmpfilename)
+        if hashes[f] == previousHashes.get(f) and os.path.exists(csvfilename) and os.path.exists(binfilename):
+            os.remove(tmpfilename)
+            continue
+        changedPartitions.add(f)
+
+        if f in previousHashes and os.path.exists(csvfilename):
+            changelog['partitions']['changed'].append(f)
+            for k, v in get_price_changes(csvfilename, tmpfilename).items(): changelog['skus'][k].extend(v)
+        else:
+            changelog['partitions']['added'].append(f)
+            changelog['skus']['added'].extend(sorted(read_sku_prices(tmpfilename)[0]))
+        os.replace(tmpfilename, csvfilename)
+
+        #Each partition is also written in a precompiled binary format, which is what awspricecalculator loads at runtime.
+        #Records are streamed from the partition file, only the string table and the column codes are kept in memory.
+        print ("Writing binary file for key: [{}] - rows:[{}]".format(f, writers.rowCounts[f]))
+        with open(csvfilename,'r') as csvfile:
+            write_binary_partition(binfilename, fieldnames, csv.DictReader(csvfile, delimiter=',', quotechar='"'))
+
+    #Partitions that no longer have rows in the index are removed
+    for f in sorted(set(previousHashes) - set(hashes)):
+        changedPartitions.add(f)
+        changelog['partitions']['removed'].append(f)
+        for ext in ('csv', pricetable.PACKED_FILE_FORMAT):
+            filename = get_index_file_name(service, f, ext)
+            if ext == 'csv' and os.path.exists(filename): changelog['skus']['removed'].extend(sorted(read_sku_prices(filename)[0]))
+            if os.path.exists(filename): os.remove(filename)
+
+    crossRegionPartitions = write_cross_region_partitions(service, fieldnames, crossRegionKeys, previousManifest, changedPartitions)
+
+    #The manifest tells awspricecalculator which partitions exist, so it doesn't look for files that were not created.
+    #The content hashes are used to detect which partitions change in the next split.
+    with open(get_service_data_file_name(service, consts.PARTITION_MANIFEST_FILE),'w') as manifestfile:
+        json.dump({'version':changelog['version'], 'partitions':partitions + sorted(set(crossRegionPartitions.values())),
+                   'hashes':hashes, 'crossRegionPartitions':crossRegionPartitions}, manifestfile, indent=4)
+    with open(get_service_data_file_name(service, PARTITION_CHANGELOG_FILE),'w') as changelogfile:
+        json.dump(changelog, changelogfile, indent=4)
 
-            #Get a list of distinct product families in the index file
-            productFamily = row['Product Family']
-            if productFamily not in productFamilies:
-                productFamilies[productFamily] = []
-            usageGroup = row.get('Group','')
-            if usageGroup not in productFamilies[productFamily]:
-                productFamilies[productFamily].append(usageGroup)
+    print ("Number of records in main index file: [{}]".format(x))
+    print ("Number of partitions: [{}] - added:[{}] - changed:[{}] - removed:[{}]".format(len(partitions),
+            len(changelog['partitions']['added']), len(changelog['partitions']['changed']), len(changelog['partitions']['removed'])))
+    print ("SKUs added:[{}] - removed:[{}] - repriced:[{}]".format(len(changelog['skus']['added']),
+            len(changelog['skus']['removed']), len(changelog['skus']['repriced'])))
+    return
 
-            x += 1
-            if x % 1000 == 0: print("Processed row [{}]".format(x))
 
-    print ("productFamilies:{}".format(productFamilies))
+"""
+Writes a binary cross-region partition for each group of regional partitions that only differ in their region
+(i.e. On-Demand Compute Instance records in all regions), with an additional field that has the key of the regional
+partition of each record. Price comparisons across regions search a query once in the cross-region partition,
+instead of once per region. A cross-region partition is only written again if any of its regional partitions changed.
+Returns a dict with the key of the cross-region partition for each regional partition.
+"""
+def write_cross_region_partitions(service, fieldnames, crossRegionKeys, previousManifest, changedPartitions):
+    groups = {}
+    for f, crossKey in crossRegionKeys.items():
+        groups.setdefault(crossKey, []).append(f)
+    previousCrossRegionPartitions = previousManifest.get('crossRegionPartitions', {})
+    previousGroups = {}
+    for f, crossKey in previousCrossRegionPartitions.items():
+        previousGroups.setdefault(crossKey, []).append(f)
+
+    result = {}
+    for crossKey, members in sorted(groups.items()):
+        #A single region doesn't need a cross-region partition
+        if len(members) < 2: continue
+        members.sort()
+        for f in members: result[f] = crossKey
+        binfilename = get_index_file_name(service, crossKey, pricetable.PACKED_FILE_FORMAT)
+        if os.path.exists(binfilename) and sorted(previousGroups.get(crossKey, [])) == members \
+                and not changedPartitions.intersection(members):
+            continue
+        print ("Writing cross-region binary file for key: [{}] - partitions:[{}]".format(crossKey, len(members)))
+        write_binary_partition(binfilename, fieldnames + [consts.CROSS_REGION_PARTITION_FIELD], CrossRegionRows(service, members))
+
+    for crossKey in sorted(set(previousGroups) - set(result.values())):
+        filename = get_index_file_name(service, crossKey, pricetable.PACKED_FILE_FORMAT)
+        if os.path.exists(filename): os.remove(filename)
+
+    return result
 
-    i = 0
-    #Create csv files based on the partitions that were calculated when scanning the main index.csv file
-    for f in indexDict.keys():
-        if indexDict[f]:
-            i += 1
-            print ("Writing file for key: [{}]".format(f))
-            with open(get_index_file_name(service, f, 'csv'),'w') as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames, dialect='excel', quoting=csv.QUOTE_ALL)
+
+"""
+Binary partitions are memory-mapped by running processes (see PriceTable.load), so they're never rewritten in place:
+the new file is written next to the existing one and replaces it in a single step.
+"""
+def write_binary_partition(binfilename, fields, rows):
+    tmpfilename = binfilename + PARTITION_TMP_SUFFIX
+    pricetable.write_packed(tmpfilename, fields, rows)
+    os.replace(tmpfilename, binfilename)
+
+
+"""
+Records in a group of partitions, read from their CSV files, with the key of the partition each record belongs to.
+Records are read as the object is iterated, so they're never all in memory at the same time.
+"""
+class CrossRegionRows():
+
+    def __init__(self, service, partitions):
+        self.service = service
+        self.partitions = partitions
+
+    def __iter__(self):
+        for f in self.partitions:
+            with open(get_index_file_name(self.service, f, 'csv'),'r') as csvfile:
+                for row in csv.DictReader(csvfile, delimiter=',', quotechar='"'):
+                    row[consts.CROSS_REGION_PARTITION_FIELD] = f
+                    yield row
+
+
+def read_partition_manifest(service):
+    try:
+        with open(get_service_data_file_name(service, consts.PARTITION_MANIFEST_FILE)) as manifestfile:
+            return json.load(manifestfile)
+    except (IOError, ValueError):
+        return {}
+
+
+#Returns the Price List API version of the index that is being split (see extract_metadata)
+def get_index_version(service):
+    try:
+        with open(get_index_file_name(service, 'index_metadata', 'json')) as metadatafile:
+            return json.load(metadatafile).get('Version')
+    except (IOError, ValueError):
+        return None
+
+
+def hash_file(filename):
+    result = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(PARTITION_FILE_BUFFER_SIZE), b''):
+            result.update(chunk)
+    return result.hexdigest()
+
+
+#Returns the SKUs in a partition file and the price for each rate code
+def read_sku_prices(filename):
+    skus = set()
+    prices = {}
+    with open(filename, 'r') as csvfile:
+        for row in csv.DictReader(csvfile, delimiter=',', quotechar='"'):
+            skus.add(row.get('SKU',''))
+            prices[row.get('RateCode','')] = (row.get('SKU',''), row.get('PricePerUnit',''), row.get('PriceDescription',''))
+    return skus, prices
+
+
+#Compares two versions of a partition file and returns the SKUs that were added, removed or have a different price
+def get_price_changes(previousFilename, filename):
+    previousSkus, previousPrices = read_sku_prices(previousFilename)
+    skus, prices = read_sku_prices(filename)
+    repriced = []
+    for rateCode in sorted(set(prices) & set(previousPrices)):
+        sku, price, description = prices[rateCode]
+        if price != previousPrices[rateCode][1]:
+            repriced.append({'sku':sku, 'rateCode':rateCode, 'priceDescription':description,
+                             'previousPricePerUnit':previousPrices[rateCode][1], 'pricePerUnit':price})
+    return {'added':sorted(skus - previousSkus), 'removed':sorted(previousSkus - skus), 'repriced':repriced}
+
+
+"""
+Keeps the partition CSV files open while the index is being split. When there are more partitions than
+maxOpenFiles, the least recently used file is closed and it's opened again in append mode when a new row arrives.
+"""
+class PartitionWriterPool():
+
+    def __init__(self, service, fieldnames, maxOpenFiles):
+        self.service = service
+        self.fieldnames = fieldnames
+        self.maxOpenFiles = maxOpenFiles
+        self.files = OrderedDict()
+        self.rowCounts = {}
+
+    def write(self, partitionKey, row):
+        if partitionKey in self.files:
+            self.files.move_to_end(partitionKey)
+            csvfile, writer = self.files[partitionKey]
+        else:
+            while len(self.files) >= self.maxOpenFiles:
+                self.files.popitem(last=False)[1][0].close()
+            #Files are truncated the first time a partition is written, since they might be left over from an interrupted split
+            mode = 'a' if partitionKey in self.rowCounts else 'w'
+            csvfile = open(get_index_file_name(self.service, partitionKey, 'csv') + PARTITION_TMP_SUFFIX, mode, buffering=PARTITION_FILE_BUFFER_SIZE)
+            #Columns that are not in the partition schema are dropped
+            writer = csv.DictWriter(csvfile, fieldnames=self.fieldnames, dialect='excel', quoting=csv.QUOTE_ALL, extrasaction='ignore')
+            if mode == 'w':
                 writer.writeheader()
-                for r in indexDict[f]:
-                    writer.writerow(r)
+                self.rowCounts[partitionKey] = 0
+            self.files[partitionKey] = (csvfile, writer)
 
-    print ("Number of records in main index file: [{}]".format(x))
-    print ("Number of files written: [{}]".format(i))
-    return
+        writer.writerow(row)
+        self.rowCounts[partitionKey] += 1
+
+    def close(self):
+        while self.files:
+            self.files.popitem()[1][0].close()
 
 
 def get_index_file_name(service, name, format):
-  result = '../awspricecalculator/data/'+service+'/'+name+'.'+format
+  result = dataindexpath+'/'+service+'/'+name+'.'+format
   return result
 
 
+def get_service_data_file_name(service, filename):
+  return dataindexpath+'/'+service+'/'+filename
+
+
 """
-This method removes unnecessary fields from each row in the index file. This is necessary since large index files
-become a problem when they're too large and result in Lambda functions exceeding package size or in slower warm-up
-times for Lambda.
+Returns the columns in the partition files for a service, in the same order as in the index file.
+Only the columns in consts.PARTITION_COLUMNS_BY_SERVICE_DICT are kept. Large index files become a problem
+when they're too large and result in Lambda functions exceeding package size or in slower warm-up times for Lambda.
+If the index doesn't have one of those columns, the price calculations for the service would stop working,
+therefore the split fails.
 """
 
-def remove_fields(service, row):
-    #don't exclude: 'Product Family', 'operation' (used by ELB)
-    EXCLUDE_FIELD_DICT = {
-          consts.SERVICE_EC2:['Location Type', 'Storage', 'Location', 'Memory', 'Physical Processor',
-                              'Dedicated EBS Throughput', 'Processor Features', 'ECU', 'serviceName', 'Network Performance',
-                              'Instance Family', 'Current Generation',
-                              'serviceCode','TermType','Tenancy','OfferingClass','PurchaseOption' #these fields are implicit in the DB file name, therefore they're not necessary in the file itself
-                              ]
-                  }
-
-    for f in EXCLUDE_FIELD_DICT.get(service, []):
-        row.pop(f,'')
+def get_partition_fieldnames(service, fieldnames):
+    columns = consts.PARTITION_COLUMNS_BY_SERVICE_DICT.get(service)
+    if columns is None: return list(fieldnames)
 
-    return row
+    missing = [c for c in columns if c not in fieldnames]
+    if missing:
+        raise ValueError("Index file for service [{}] doesn't have the required columns {}".format(service, missing))
+    return [f for f in fieldnames if f in columns]
 
 
 
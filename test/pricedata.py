@@ -0,0 +1,51 @@
+import os, sys, shutil, tempfile, unittest
+import importlib.util
+from contextlib import redirect_stdout
+from io import StringIO
+
+__location__ = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.split(__location__)[0])
+from awspricecalculator.common import consts, phelper
+
+FIXTURES_DIR = os.path.join(__location__, 'fixtures')
+SCRIPT_FILE = os.path.join(os.path.split(__location__)[0], 'scripts', 'get-latest-index.py')
+
+
+"""
+Base class for tests that calculate prices. The fixture indexes of SERVICES are split with get-latest-index.py into a
+temporary data directory, which replaces the data directory of the price calculator while the tests run.
+"""
+class PriceDataTestCase(unittest.TestCase):
+
+    SERVICES = []
+
+    @classmethod
+    def setUpClass(cls):
+        spec = importlib.util.spec_from_file_location('get_latest_index', SCRIPT_FILE)
+        script = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(script)
+
+        cls.datadir = tempfile.mkdtemp()
+        script.dataindexpath = cls.datadir
+        for s in cls.SERVICES:
+            os.makedirs(os.path.join(cls.datadir, s))
+            shutil.copy(os.path.join(FIXTURES_DIR, consts.SERVICE_INDEX_MAP[s], 'index.csv'), os.path.join(cls.datadir, s, 'index.csv'))
+            with redirect_stdout(StringIO()):
+                script.process_index(s, '', '')
+
+        cls.originalDataDirectory = phelper.datadirectory
+        phelper.datadirectory = cls.datadir + '/'
+        cls.invalidate_services()
+
+    @classmethod
+    def tearDownClass(cls):
+        phelper.datadirectory = cls.originalDataDirectory
+        cls.invalidate_services()
+        shutil.rmtree(cls.datadir)
+
+    #Prices loaded from a different data directory are discarded
+    @classmethod
+    def invalidate_services(cls):
+        for s in cls.SERVICES:
+            phelper.invalidateService(s)
+            phelper.indexmetadatas.pop(s, None)
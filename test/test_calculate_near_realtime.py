@@ -0,0 +1,191 @@
+import os, sys, datetime, unittest
+import importlib.util
+from unittest import mock
+
+import boto3
+from botocore.stub import Stubber, ANY
+
+__location__ = os.path.dirname(os.path.realpath(__file__))
+FUNCTION_FILE = os.path.join(os.path.split(__location__)[0], 'functions', 'calculate-near-realtime.py')
+REGION = 'us-east-1'
+ACCOUNT = '123456789012'
+
+
+def table_arn(name):
+    return 'arn:aws:dynamodb:{}:{}:table/{}'.format(REGION, ACCOUNT, name)
+
+
+def describe_table_response(name, read, write):
+    return {'Table': {'TableName': name, 'ProvisionedThroughput': {'ReadCapacityUnits': read, 'WriteCapacityUnits': write}}}
+
+
+"""
+Runs the collection stage of calculate-near-realtime.py with AWS clients stubbed by botocore's Stubber, so no AWS
+API is called. Resources are collected in a single thread, so stubbed responses are returned in a known order.
+"""
+class CalculateNearRealtimeTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        spec = importlib.util.spec_from_file_location('calculate_near_realtime', FUNCTION_FILE)
+        cls.function = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(cls.function)
+
+    def setUp(self):
+        self.originalMaxWorkers = self.function.COLLECTION_MAX_WORKERS
+        self.function.COLLECTION_MAX_WORKERS = 1
+        self.stubbers = {}
+        for name, service in (('tagsclient', 'resourcegroupstaggingapi'), ('ec2client', 'ec2'), ('rdsclient', 'rds'),
+                              ('ddbclient', 'dynamodb'), ('cwclient', 'cloudwatch')):
+            client = boto3.client(service, REGION, aws_access_key_id='test', aws_secret_access_key='test')
+            setattr(self.function, name, client)
+            self.stubbers[service] = Stubber(client)
+            self.stubbers[service].activate()
+
+    def tearDown(self):
+        self.function.COLLECTION_MAX_WORKERS = self.originalMaxWorkers
+        for s in self.stubbers.values(): s.deactivate()
+
+    def collect_tag_usage(self, tags):
+        end = datetime.datetime(2019, 11, 1, 12, 0)
+        resource_manager = self.function.ResourceManager(tags)
+        usage = self.function.collect_usage(resource_manager, tags, end - datetime.timedelta(minutes=5), end)
+        return [self.function.get_tag_usage(usage, resource_manager, t) for t in tags]
+
+    def metric_data_response(self, values, nextToken=None):
+        response = {'MetricDataResults': [{'Id': i, 'Values': v, 'StatusCode': 'Complete'} for i, v in values]}
+        if nextToken: response['NextToken'] = nextToken
+        return response
+
+
+    def test_ddb_capacity_units(self):
+        self.stubbers['dynamodb'].add_response('describe_table', describe_table_response('orders', 5, 10), {'TableName': 'orders'})
+        self.assertEqual(self.function.get_ddb_capacity_units('orders'), (5, 10))
+        self.stubbers['dynamodb'].assert_no_pending_responses()
+
+
+    def test_ddb_capacity_units_error(self):
+        self.stubbers['dynamodb'].add_client_error('describe_table', 'ResourceNotFoundException', expected_params={'TableName': 'deleted'})
+        self.assertEqual(self.function.get_ddb_capacity_units('deleted'), (0, 0))
+        self.stubbers['dynamodb'].assert_no_pending_responses()
+
+
+    def test_table_error_does_not_abort_other_tags(self):
+        tags = [('app', 'billing'), ('app', 'orders')]
+        self.stubbers['resourcegroupstaggingapi'].add_response('get_resources', {'ResourceTagMappingList': [
+            {'ResourceARN': table_arn('deleted'), 'Tags': [{'Key': 'app', 'Value': 'billing'}]},
+            {'ResourceARN': table_arn('orders'), 'Tags': [{'Key': 'app', 'Value': 'orders'}]}]})
+        self.stubbers['ec2'].add_response('describe_instances', {'Reservations': []})
+        self.stubbers['dynamodb'].add_client_error('describe_table', 'ResourceNotFoundException', expected_params={'TableName': 'deleted'})
+        self.stubbers['dynamodb'].add_response('describe_table', describe_table_response('orders', 5, 10), {'TableName': 'orders'})
+
+        billing, orders = self.collect_tag_usage(tags)
+        self.assertEqual(billing['ddbCapacityUnits'], [('deleted', 0, 0)])
+        self.assertEqual(orders['ddbCapacityUnits'], [('orders', 5, 10)])
+        for s in self.stubbers.values(): s.assert_no_pending_responses()
+
+
+    def test_metric_collector_batches_and_pages(self):
+        end = datetime.datetime(2019, 11, 1, 12, 0)
+        start = end - datetime.timedelta(minutes=5)
+        metric = self.function.METRIC_LAMBDA_INVOCATIONS
+        functionCount = self.function.MAX_METRIC_DATA_QUERIES + 1
+        collector = self.function.MetricCollector(start, end)
+        for i in range(functionCount):
+            collector.add(metric, 'function{}'.format(i))
+        #Metrics that were already added are requested once
+        collector.add(metric, 'function0')
+        self.assertEqual(len(collector.queries), functionCount)
+
+        #The first batch has 2 pages. Values for the same query in different pages are added up.
+        firstBatch = {'MetricDataQueries': collector.queries[:self.function.MAX_METRIC_DATA_QUERIES], 'StartTime': start, 'EndTime': end}
+        secondBatch = {'MetricDataQueries': collector.queries[self.function.MAX_METRIC_DATA_QUERIES:], 'StartTime': start, 'EndTime': end}
+        self.stubbers['cloudwatch'].add_response('get_metric_data', self.metric_data_response([('m0', [1.0]), ('m1', [2.0])], 'page2'), firstBatch)
+        self.stubbers['cloudwatch'].add_response('get_metric_data', self.metric_data_response([('m0', [3.0]), ('m499', [4.0])]),
+                                                 dict(firstBatch, NextToken='page2'))
+        self.stubbers['cloudwatch'].add_response('get_metric_data', self.metric_data_response([('m500', [5.0])]), secondBatch)
+
+        collector.collect()
+        self.stubbers['cloudwatch'].assert_no_pending_responses()
+        self.assertEqual(collector.get_values(metric, 'function0'), [1.0, 3.0])
+        self.assertEqual(collector.get_values(metric, 'function1'), [2.0])
+        self.assertEqual(collector.get_values(metric, 'function2'), [])
+        self.assertEqual(collector.get_values(metric, 'function499'), [4.0])
+        self.assertEqual(collector.get_values(metric, 'function500'), [5.0])
+        self.assertEqual(collector.get_values(self.function.METRIC_LAMBDA_DURATION, 'function0'), [])
+
+
+    def create_datums(self, count):
+        timestamp = datetime.datetime(2019, 11, 1, 12, 0)
+        return [self.function.get_cw_metric_datum(timestamp, i, 'ec2', 'app', 'app{}'.format(i)) for i in range(count)]
+
+
+    def test_metric_emitter_chunks_datums(self):
+        datums = self.create_datums(2 * self.function.MAX_PUT_METRIC_DATA + 1)
+        emitter = self.function.MetricEmitter()
+        for d in datums: emitter.add(d)
+        for i in range(0, len(datums), self.function.MAX_PUT_METRIC_DATA):
+            self.stubbers['cloudwatch'].add_response('put_metric_data', {},
+                                                     {'Namespace': self.function.CW_NAMESPACE, 'MetricData': datums[i:i+self.function.MAX_PUT_METRIC_DATA]})
+        emitter.flush()
+        self.stubbers['cloudwatch'].assert_no_pending_responses()
+        self.assertEqual(emitter.datums, [])
+
+
+    def test_metric_emitter_retries_throttled_calls(self):
+        datums = self.create_datums(2)
+        emitter = self.function.MetricEmitter()
+        for d in datums: emitter.add(d)
+        expectedParams = {'Namespace': self.function.CW_NAMESPACE, 'MetricData': datums}
+        self.stubbers['cloudwatch'].add_client_error('put_metric_data', 'Throttling', http_status_code=400, expected_params=expectedParams)
+        self.stubbers['cloudwatch'].add_response('put_metric_data', {}, expectedParams)
+        with mock.patch.object(self.function.time, 'sleep') as sleep:
+            emitter.flush()
+        self.stubbers['cloudwatch'].assert_no_pending_responses()
+        self.assertEqual(sleep.call_count, 1)
+        delay = sleep.call_args[0][0]
+        self.assertTrue(self.function.PUT_METRIC_DATA_RETRY_DELAY / 2 <= delay <= self.function.PUT_METRIC_DATA_RETRY_DELAY, delay)
+
+
+    def test_metric_emitter_raises_other_errors(self):
+        emitter = self.function.MetricEmitter()
+        emitter.add(self.create_datums(1)[0])
+        self.stubbers['cloudwatch'].add_client_error('put_metric_data', 'InvalidParameterValue', http_status_code=400)
+        with mock.patch.object(self.function.time, 'sleep') as sleep:
+            with self.assertRaises(self.function.ClientError):
+                emitter.flush()
+        self.assertFalse(sleep.called)
+
+
+    def test_discover_resources_pages_and_tag_chunks(self):
+        appValues = ['app{}'.format(i) for i in range(self.function.MAX_TAG_FILTER_VALUES + 5)]
+        tags = [('app', v) for v in appValues] + [('team', 'pricing')]
+        stubber = self.stubbers['resourcegroupstaggingapi']
+        firstChunk = {'TagsPerPage': 500, 'ResourceTypeFilters': ANY,
+                      'TagFilters': [{'Key': 'app', 'Values': appValues[:self.function.MAX_TAG_FILTER_VALUES]}]}
+        #The first chunk of values for tag key 'app' has 2 pages
+        stubber.add_response('get_resources', {'PaginationToken': 'page2', 'ResourceTagMappingList': [
+            {'ResourceARN': table_arn('orders'), 'Tags': [{'Key': 'app', 'Value': 'app0'}, {'Key': 'team', 'Value': 'pricing'}]}]}, firstChunk)
+        stubber.add_response('get_resources', {'ResourceTagMappingList': [
+            {'ResourceARN': table_arn('invoices'), 'Tags': [{'Key': 'app', 'Value': 'app1'}]},
+            {'ResourceARN': 'arn:aws:sqs:{}:{}:unsupported'.format(REGION, ACCOUNT), 'Tags': [{'Key': 'app', 'Value': 'app1'}]}]},
+            dict(firstChunk, PaginationToken='page2'))
+        stubber.add_response('get_resources', {'ResourceTagMappingList': [
+            {'ResourceARN': table_arn('reports'), 'Tags': [{'Key': 'app', 'Value': appValues[-1]}]}]},
+            {'TagsPerPage': 500, 'ResourceTypeFilters': ANY,
+             'TagFilters': [{'Key': 'app', 'Values': appValues[self.function.MAX_TAG_FILTER_VALUES:]}]})
+        #Resources found for more than one tag key are returned once, with all the tags they were found with
+        stubber.add_response('get_resources', {'ResourceTagMappingList': [
+            {'ResourceARN': table_arn('orders'), 'Tags': [{'Key': 'app', 'Value': 'app0'}, {'Key': 'team', 'Value': 'pricing'}]}]},
+            {'TagsPerPage': 500, 'ResourceTypeFilters': ANY, 'TagFilters': [{'Key': 'team', 'Values': ['pricing']}]})
+
+        resource_manager = self.function.ResourceManager(tags)
+        stubber.assert_no_pending_responses()
+        self.assertEqual([r.id for r in resource_manager.resources], ['orders', 'invoices', 'reports'])
+        self.assertEqual(resource_manager.resources[0].tags, {('app', 'app0'), ('team', 'pricing')})
+        self.assertEqual(resource_manager.get_resource_ids(self.function.SERVICE_DYNAMODB, self.function.RESOURCE_DDB_TABLE, ('team', 'pricing')), ['orders'])
+        self.assertEqual(resource_manager.get_resource_ids(self.function.SERVICE_DYNAMODB, self.function.RESOURCE_DDB_TABLE, ('app', appValues[-1])), ['reports'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+from unittest import mock
+from contextlib import redirect_stdout
+from io import StringIO
+
+from pricedata import PriceDataTestCase
+from awspricecalculator.common import consts, phelper, utils
+from awspricecalculator.common.models import DynamoDBPriceDimension
+from awspricecalculator.dynamodb import pricing as ddbpricing
+
+
+"""
+Region comparisons resolve all regions with the cross-region partition (see phelper.TierBandsCache) and return the
+same prices as calculating each region on its own, for the DynamoDB fixture index (us-east-1, us-west-2 and eu-west-1).
+"""
+class CompareByRegionTest(PriceDataTestCase):
+
+    SERVICES = [consts.SERVICE_DYNAMODB]
+    USAGE = {'readCapacityUnitHours':20000, 'writeCapacityUnitHours':20000}
+
+    def setUp(self):
+        phelper.tierbandscache.clear()
+
+    def test_compare_by_region_matches_calculate(self):
+        with mock.patch.object(phelper.tierbandscache, 'add_cross_region', wraps=phelper.tierbandscache.add_cross_region) as addCrossRegion:
+            with redirect_stdout(StringIO()):
+                comparison = utils.compare(service=consts.SERVICE_DYNAMODB, sortCriteria=consts.SORT_CRITERIA_REGION, **self.USAGE)
+        self.assertTrue(addCrossRegion.called)
+        self.assertFalse(phelper.tierbandscache.crossRegion)
+        compared = {s['priceCalculation']['region']:s['totalCost'] for s in comparison['pricingScenarios']}
+        self.assertEqual(compared, {'us-east-1':0.98, 'us-west-2':1.12, 'eu-west-1':1.4})
+
+        #Per-region calculations don't use the tier bands that were added for all regions by the comparison
+        phelper.tierbandscache.clear()
+        for region, totalCost in compared.items():
+            self.assertEqual(ddbpricing.calculate(DynamoDBPriceDimension(region=region, **self.USAGE))['totalCost'], totalCost, region)
+
+    def test_cross_region_scenarios_match_serial_scenarios(self):
+        scenarios = [dict(self.USAGE, region=r) for r in ('us-east-1', 'us-west-2', 'eu-west-1', 'ap-southeast-2')]
+        crossRegionResults = utils.calculate_scenarios(consts.SERVICE_DYNAMODB, scenarios, crossRegion=True)
+        phelper.tierbandscache.clear()
+        self.assertEqual(crossRegionResults, [utils.calculate_scenario(consts.SERVICE_DYNAMODB, s) for s in scenarios])
+
+
+if __name__ == '__main__':
+    unittest.main()
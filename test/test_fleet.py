@@ -0,0 +1,60 @@
+import math, unittest
+
+from pricedata import PriceDataTestCase
+from awspricecalculator.common import consts
+from awspricecalculator.common.errors import ValidationError
+from awspricecalculator.common.models import Ec2PriceDimension
+from awspricecalculator.ec2 import fleet
+from awspricecalculator.ec2 import pricing as ec2pricing
+
+
+"""
+fleet.calculate_fleet returns the same cost as ec2pricing.calculate for each price dimension, for the EC2 fixture
+index (t2.micro and m5.large in us-east-1 and eu-west-1).
+"""
+class FleetTest(PriceDataTestCase):
+
+    SERVICES = [consts.SERVICE_EC2]
+
+    def setUp(self):
+        fleet.pricematrices = {}
+
+    def test_calculate_fleet_matches_calculate(self):
+        pdims = []
+        for region in ('us-east-1', 'eu-west-1'):
+            for instanceType in ('t2.micro', 'm5.large'):
+                for operatingSystem in (consts.SCRIPT_OPERATING_SYSTEM_LINUX, consts.SCRIPT_OPERATING_SYSTEM_WINDOWS,
+                                        consts.SCRIPT_OPERATING_SYSTEM_WINDOWS_BYOL, consts.SCRIPT_OPERATING_SYSTEM_RHEL):
+                    for tenancy in (consts.SCRIPT_EC2_TENANCY_SHARED, consts.SCRIPT_EC2_TENANCY_DEDICATED, consts.SCRIPT_EC2_TENANCY_HOST):
+                        pdims.append(Ec2PriceDimension(region=region, instanceType=instanceType, operatingSystem=operatingSystem,
+                                                       tenancy=tenancy, instanceHours=720))
+        costs = fleet.calculate_fleet(pdims)
+        self.assertEqual(len(costs), len(pdims))
+        for p, cost in zip(pdims, costs):
+            expected = ec2pricing.calculate(p)['totalCost']
+            self.assertGreater(expected, 0)
+            self.assertAlmostEqual(cost, expected, places=2, msg=vars(p))
+
+    def test_missing_combinations_are_nan(self):
+        pdims = [Ec2PriceDimension(region='us-east-1', instanceType='t2.micro', instanceHours=10),
+                 Ec2PriceDimension(region='us-east-1', instanceType='c5.large', instanceHours=10),
+                 Ec2PriceDimension(region='eu-west-1', instanceType='m5.large', instanceHours=10)]
+        costs = fleet.calculate_fleet(pdims)
+        self.assertAlmostEqual(costs[0], 0.1)
+        self.assertTrue(math.isnan(costs[1]))
+        self.assertAlmostEqual(costs[2], 0.36)
+
+    def test_unsupported_price_dimensions_are_rejected(self):
+        reserved = Ec2PriceDimension(region='us-east-1', instanceType='t2.micro', termType=consts.SCRIPT_TERM_TYPE_RESERVED,
+                                     offeringType=consts.SCRIPT_EC2_PURCHASE_OPTION_NO_UPFRONT, instanceCount=1)
+        preInstalledSoftware = Ec2PriceDimension(region='us-east-1', instanceType='t2.micro', instanceHours=10)
+        preInstalledSoftware.preInstalledSoftware = 'SQL Web'
+        unusedCapacity = Ec2PriceDimension(region='us-east-1', instanceType='t2.micro', instanceHours=10)
+        unusedCapacity.capacityReservationStatus = consts.SCRIPT_EC2_CAPACITY_RESERVATION_STATUS_UNUSED
+        for p in (reserved, preInstalledSoftware, unusedCapacity):
+            with self.assertRaises(ValidationError):
+                fleet.calculate_fleet([Ec2PriceDimension(region='us-east-1', instanceType='t2.micro', instanceHours=10), p])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import os, sys, json, shutil, tempfile, threading, unittest
+import importlib.util
+import http.server
+import urllib.parse
+from contextlib import redirect_stdout
+from io import StringIO
+
+__location__ = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.split(__location__)[0])
+from awspricecalculator.common import consts
+
+#Copies of index files from the Price List API, served by a local HTTP server instead of the real endpoint
+FIXTURES_DIR = os.path.join(__location__, 'fixtures')
+SCRIPT_FILE = os.path.join(os.path.split(__location__)[0], 'scripts', 'get-latest-index.py')
+
+
+class FixtureRequestHandler(http.server.SimpleHTTPRequestHandler):
+
+    def translate_path(self, path):
+        return os.path.join(FIXTURES_DIR, *urllib.parse.urlparse(path).path.strip('/').split('/'))
+
+    def log_message(self, format, *args):
+        pass
+
+
+"""
+Runs get-latest-index.py against the fixture indexes, with OFFER_INDEX_URL pointing at a local HTTP server and the
+data directory replaced by a temporary one.
+"""
+class GetLatestIndexTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.HTTPServer(('127.0.0.1', 0), FixtureRequestHandler)
+        cls.serverThread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.serverThread.start()
+        os.environ['OFFER_INDEX_URL'] = 'http://127.0.0.1:{}/{{serviceIndex}}/index.'.format(cls.server.server_address[1])
+        spec = importlib.util.spec_from_file_location('get_latest_index', SCRIPT_FILE)
+        cls.script = importlib.util.module_from_spec(spec)
+        #Registered as a module, so the functions submitted to the split process pool can be pickled
+        sys.modules[spec.name] = cls.script
+        spec.loader.exec_module(cls.script)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        os.environ.pop('OFFER_INDEX_URL', None)
+        sys.modules.pop('get_latest_index', None)
+
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        self.originalDataIndexPath = self.script.dataindexpath
+        self.script.dataindexpath = self.datadir
+
+    def tearDown(self):
+        self.script.dataindexpath = self.originalDataIndexPath
+        shutil.rmtree(self.datadir)
+
+    def run_script(self, function, *args, **kwargs):
+        with redirect_stdout(StringIO()):
+            return function(*args, **kwargs)
+
+    def read_data_file(self, service, filename):
+        with open(os.path.join(self.datadir, service, filename)) as f:
+            return json.load(f)
+
+
+    def test_refresh_downloads_and_splits_index(self):
+        self.run_script(self.script.refresh_indexes, [consts.SERVICE_DYNAMODB], 'csv', '', '')
+
+        self.assertEqual(self.read_data_file(consts.SERVICE_DYNAMODB, 'index_metadata.json')['Version'], '20191101000000')
+        state = self.read_data_file(consts.SERVICE_DYNAMODB, 'index_download.json')
+        self.assertTrue(state['complete'])
+        self.assertTrue(state['split'])
+
+        manifest = self.read_data_file(consts.SERVICE_DYNAMODB, consts.PARTITION_MANIFEST_FILE)
+        regionalPartitions = [p for p in manifest['partitions'] if not p.startswith(consts.CROSS_REGION_PARTITION_PREFIX)]
+        self.assertEqual(len(regionalPartitions), 6)  #3 regions x 2 product families
+        #Cross-region partitions are only written in the binary format
+        for p in manifest['partitions']:
+            self.assertTrue(os.path.exists(os.path.join(self.datadir, consts.SERVICE_DYNAMODB, p + '.' + self.script.pricetable.PACKED_FILE_FORMAT)), p)
+        for p in regionalPartitions:
+            self.assertTrue(os.path.exists(os.path.join(self.datadir, consts.SERVICE_DYNAMODB, p + '.csv')), p)
+        #Partition files are written to temporary files first, which replace the existing ones
+        self.assertEqual([f for f in os.listdir(os.path.join(self.datadir, consts.SERVICE_DYNAMODB)) if f.endswith(self.script.PARTITION_TMP_SUFFIX)], [])
+
+
+    def test_parallel_refresh_creates_same_partitions(self):
+        self.run_script(self.script.refresh_indexes, [consts.SERVICE_DYNAMODB], 'csv', '', '')
+        serialHashes = self.read_data_file(consts.SERVICE_DYNAMODB, consts.PARTITION_MANIFEST_FILE)['hashes']
+
+        shutil.rmtree(os.path.join(self.datadir, consts.SERVICE_DYNAMODB))
+        self.run_script(self.script.refresh_indexes, [consts.SERVICE_DYNAMODB], 'csv', '', '', workers=2)
+        self.assertEqual(self.read_data_file(consts.SERVICE_DYNAMODB, consts.PARTITION_MANIFEST_FILE)['hashes'], serialHashes)
+
+
+    def test_refresh_leaves_unchanged_partitions(self):
+        self.run_script(self.script.refresh_indexes, [consts.SERVICE_DYNAMODB], 'csv', '', '')
+        self.run_script(self.script.refresh_indexes, [consts.SERVICE_DYNAMODB], 'csv', '', '', force=True)
+
+        changelog = self.read_data_file(consts.SERVICE_DYNAMODB, self.script.PARTITION_CHANGELOG_FILE)
+        self.assertEqual(changelog['partitions'], {'added':[], 'removed':[], 'changed':[]})
+
+
+    def test_invalid_workers_are_rejected(self):
+        for workers in ('x', '0', '-1', ''):
+            with self.assertRaises(SystemExit) as e:
+                self.run_script(self.script.main, ['--service=' + consts.SERVICE_DYNAMODB, '--workers=' + workers])
+            self.assertEqual(e.exception.code, 2, workers)
+        self.assertFalse(os.path.exists(os.path.join(self.datadir, consts.SERVICE_DYNAMODB)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+import os, sys, shutil, tempfile, unittest
+from unittest import mock
+
+__location__ = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.split(__location__)[0])
+from awspricecalculator.common import consts, phelper
+from awspricecalculator.common.pricetable import PriceTable, TierBands, write_packed
+
+FIELDS = ['SKU', 'Instance Type', 'Operating System', 'PricePerUnit']
+
+
+def create_rows(count):
+    return [{'SKU':'SKU{}'.format(i), 'Instance Type':'m{}.large'.format(i % 10), 'Operating System':('Linux', 'Windows')[i % 2],
+             'PricePerUnit':str(i / 100)} for i in range(count)]
+
+
+"""
+Tables written with write_packed and loaded back (memory-mapped) return the same records as tables created from the
+same rows in memory, including non-ASCII strings and empty or missing values.
+"""
+class PackedFormatTest(unittest.TestCase):
+
+    ROWS = [{'SKU':'A1', 'Location':'South America (São Paulo)', 'Operating System':'Linux', 'PricePerUnit':'0.1'},
+            {'SKU':'A2', 'Location':'EU (Zürich)', 'Operating System':'', 'PricePerUnit':'0.2'},
+            {'SKU':'A3', 'Location':'Asia Pacific (東京)', 'Operating System':'Windows', 'PricePerUnit':'0.3'},
+            {'SKU':'A4', 'Location':'EU (Zürich)', 'Operating System':'Linux', 'PricePerUnit':''},
+            {'SKU':'A5', 'Location':'US East (N. Virginia)', 'PricePerUnit':'0.5'}]
+    FIELDS = ['SKU', 'Location', 'Operating System', 'PricePerUnit']
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        filename = os.path.join(self.directory, 'partition.bin')
+        write_packed(filename, self.FIELDS, iter(self.ROWS))
+        self.packed = PriceTable.load('partition', filename)
+        self.memory = PriceTable.from_rows('partition', self.FIELDS, self.ROWS)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_rows_round_trip(self):
+        self.assertEqual(len(self.packed), len(self.ROWS))
+        for i in range(len(self.ROWS)):
+            self.assertEqual(self.packed.get_row(i), self.memory.get_row(i))
+        #Missing values are stored as empty strings
+        self.assertEqual(self.packed.get_row(4)['Operating System'], '')
+
+    def test_search_matches_in_memory_table(self):
+        queries = [{'Location':'EU (Zürich)'}, {'Location':'Asia Pacific (東京)', 'Operating System':'Windows'},
+                   {'Operating System':''}, {'PricePerUnit':''}, {'Location':'EU (Zürich)', 'Operating System':'Linux'},
+                   {'Location':'EU (Zurich)'}, {'Location':'Unknown'}, {'Unknown field':'Linux'}, {'SKU':'A0'}, {'SKU':'Z9'}]
+        for q in queries:
+            self.assertEqual(self.packed.search(q), self.memory.search(q), q)
+
+    def test_find(self):
+        strings = self.packed.strings
+        for i in range(len(strings)):
+            self.assertEqual(strings.find(strings[i]), i)
+        #Empty values sort first
+        self.assertEqual(strings.find(''), 0)
+        #Values before the first non-empty string, between strings, after the last string, and values that are not strings
+        for value in (' ', 'A', 'A11', 'EU (Zürich', 'zzz', '東京', None, 1):
+            self.assertIsNone(strings.find(value), value)
+
+
+#Billable usage, price per unit and amount for a CSV price record, as calculated before TierBands (getBillableBandCsv)
+def get_billable_band_reference(row, usageAmount):
+    billableBand = 0
+    amt = 0
+    beginRange = int(row['StartingRange']) if row['StartingRange'] else 0
+    endRange = row['EndingRange'] if row['EndingRange'] else consts.INFINITY
+    pricePerUnit = float(row['PricePerUnit'])
+    if endRange == consts.INFINITY:
+        if beginRange < usageAmount: billableBand = usageAmount - beginRange
+    else:
+        endRange = int(endRange)
+        if endRange >= usageAmount and beginRange < usageAmount: billableBand = usageAmount - beginRange
+        if endRange < usageAmount: billableBand = endRange - beginRange
+    if billableBand > 0: amt = pricePerUnit * billableBand
+    return billableBand, pricePerUnit, amt
+
+
+"""
+TierBands.evaluate and TierBands.evaluate_array return the same amounts as the band calculation they replaced.
+"""
+class TierBandsTest(unittest.TestCase):
+
+    BANDS = {'tiered':[{'StartingRange':'0', 'EndingRange':'51200', 'PricePerUnit':'0.023'},
+                       {'StartingRange':'51200', 'EndingRange':'512000', 'PricePerUnit':'0.022'},
+                       {'StartingRange':'512000', 'EndingRange':consts.INFINITY, 'PricePerUnit':'0.021'}],
+             'freeTier':[{'StartingRange':'', 'EndingRange':'18600', 'PricePerUnit':'0.0000000'},
+                         {'StartingRange':'18600', 'EndingRange':'', 'PricePerUnit':'0.0001'}],
+             'single':[{'StartingRange':'', 'EndingRange':'', 'PricePerUnit':'0.096'}],
+             'none':[]}
+    USAGE_AMOUNTS = [0, 1, 0.5, 18599, 18600, 18601, 51199.5, 51200, 51201, 512000, 512001, 10**9]
+
+    def test_evaluate_matches_reference(self):
+        for name, rows in self.BANDS.items():
+            bands = TierBands(rows)
+            for usage in self.USAGE_AMOUNTS:
+                for (r, billable, price, amt), row in zip(bands.evaluate(usage), rows):
+                    self.assertIs(r, row)
+                    self.assertEqual((billable, price, amt), get_billable_band_reference(row, usage), (name, usage, row))
+
+    def test_evaluate_array_matches_evaluate(self):
+        for name, rows in self.BANDS.items():
+            bands = TierBands(rows)
+            billable, amounts = bands.evaluate_array(self.USAGE_AMOUNTS)
+            self.assertEqual(billable.shape, (len(self.USAGE_AMOUNTS), len(rows)))
+            for i, usage in enumerate(self.USAGE_AMOUNTS):
+                evaluated = bands.evaluate(usage)
+                self.assertAlmostEqual(amounts[i], sum(amt for r, b, p, amt in evaluated), places=6, msg=(name, usage))
+                for j, (r, b, p, amt) in enumerate(evaluated):
+                    self.assertAlmostEqual(billable[i][j], b, places=6, msg=(name, usage, j))
+
+
+"""
+The partition cache accounts for the memory tables use after they're loaded (indexes and decoded strings).
+"""
+class PartitionCacheSizeTest(unittest.TestCase):
+
+    def test_index_is_charged_to_cache(self):
+        cache = phelper.PartitionCache(10, 10 * 1024 * 1024)
+        with mock.patch.object(phelper, 'loadPriceTable', lambda service, key: PriceTable.from_rows(key, FIELDS, create_rows(1000))):
+            table = cache.get('ec2', 'p1')
+        loadedSize = cache.size
+        table.search({'Instance Type':'m1.large', 'Operating System':'Windows'})
+        self.assertGreater(cache.size, loadedSize)
+        self.assertEqual(cache.size, table.size)
+
+    def test_growth_evicts_least_recently_used(self):
+        with mock.patch.object(phelper, 'loadPriceTable', lambda service, key: PriceTable.from_rows(key, FIELDS, create_rows(1000))):
+            table = PriceTable.from_rows('p', FIELDS, create_rows(1000))
+            cache = phelper.PartitionCache(10, table.size * 2 + 1)
+            first = cache.get('ec2', 'p1')
+            second = cache.get('ec2', 'p2')
+        self.assertEqual(len(cache), 2)
+        second.search({'SKU':'SKU1'})
+        self.assertEqual(list(cache.entries), [('ec2', 'p2')])
+        self.assertEqual(cache.size, second.size)
+        #Tables that were evicted are not charged anymore
+        first.search({'SKU':'SKU1'})
+        self.assertEqual(cache.size, second.size)
+
+
+if __name__ == '__main__':
+    unittest.main()